@@ -0,0 +1,39 @@
+"""Benchmark the ALS baseline solvers for increasing array lengths.
+
+Usage: python bench_baseline_als.py
+"""
+from __future__ import (absolute_import, division,
+                        print_function)
+import time
+import numpy as np
+from srttools.fit import _als
+
+# The sparse solver builds a dense LxL matrix: do not go beyond this
+MAX_SPARSE_LENGTH = 10000
+
+
+def fake_scan(length):
+    x = np.linspace(0, 10, length)
+    return np.random.normal(0, 0.1, length) + 0.3 * x + \
+        10 * np.exp(-(x - 5) ** 2 / 0.1)
+
+
+def timeit(func, *args, **kwargs):
+    t0 = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - t0, result
+
+
+print("{:>10} {:>12} {:>12} {:>12}".format("Length", "sparse (s)",
+                                          "banded (s)", "max diff"))
+for length in [1000, 3000, 10000, 100000, 1000000]:
+    y = fake_scan(length)
+    t_banded, z_banded = timeit(_als, y, 1e5, 0.001, solver='banded')
+    if length <= MAX_SPARSE_LENGTH:
+        t_sparse, z_sparse = timeit(_als, y, 1e5, 0.001, solver='sparse')
+        diff = np.max(np.abs(z_banded - z_sparse))
+        print("{:>10} {:>12.4f} {:>12.4f} {:>12.2e}".format(
+            length, t_sparse, t_banded, diff))
+    else:
+        print("{:>10} {:>12} {:>12.4f} {:>12}".format(
+            length, "-", t_banded, "-"))
@@ -0,0 +1,85 @@
+"""Benchmark the global baseline fit on a simulated map.
+
+The fit with the analytic gradient (L-BFGS-B) is compared with the fit with
+SLSQP and finite differences, for maps with an increasing number of scans.
+
+Usage: python bench_global_fit.py
+"""
+from __future__ import (absolute_import, division,
+                        print_function)
+import os
+import glob
+import shutil
+import tempfile
+import time
+import numpy as np
+from srttools.simulate import simulate_map
+from srttools.imager import ScanSet
+
+# SLSQP with finite differences takes hours beyond this number of scans
+MAX_SLSQP_SCANS = 70
+
+CONFIG = """
+[local]
+workdir : .
+datadir : .
+
+[analysis]
+projection : ARC
+interpolation : spline
+prefix : test_
+list_of_directories :
+    gauss_ra
+    gauss_dec
+pixel_size : 0.8
+"""
+
+
+def simulated_scanset(workdir, width):
+    """Simulate a map with a slope baseline, load it in a ScanSet."""
+    simulate_map(length_ra=width, length_dec=width,
+                 outdir=(os.path.join(workdir, 'gauss_ra'),
+                         os.path.join(workdir, 'gauss_dec')),
+                 mean_ra=180, mean_dec=45, speed=2., spacing=0.5,
+                 baseline="slope")
+    config_file = os.path.join(workdir, 'bench.ini')
+    with open(config_file, 'w') as fobj:
+        print(CONFIG, file=fobj)
+    return ScanSet(config_file, nosub=True)
+
+
+def timeit(func, *args, **kwargs):
+    t0 = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - t0, result
+
+
+def image_rms(scanset):
+    img = scanset.calculate_images()['Ch0']
+    return np.std(img[img != 0])
+
+
+print("{:>8} {:>14} {:>14} {:>12} {:>12}".format(
+    "Scans", "L-BFGS-B (s)", "SLSQP (s)", "rms L-BFGS", "rms SLSQP"))
+for width in [10, 15, 30, 60]:
+    workdir = tempfile.mkdtemp()
+    scanset = simulated_scanset(workdir, width)
+    nscans = len(set(scanset['Scan_id']))
+    original = scanset['Ch0'].copy()
+
+    t_lbfgs, _ = timeit(scanset.fit_full_images, chans='Ch0',
+                        method='L-BFGS-B')
+    rms_lbfgs = image_rms(scanset)
+    if nscans <= MAX_SLSQP_SCANS:
+        scanset['Ch0'] = original
+        t_slsqp, _ = timeit(scanset.fit_full_images, chans='Ch0',
+                            method='SLSQP')
+        print("{:>8} {:>14.2f} {:>14.2f} {:>12.4f} {:>12.4f}".format(
+            nscans, t_lbfgs, t_slsqp, rms_lbfgs, image_rms(scanset)))
+    else:
+        print("{:>8} {:>14.2f} {:>14} {:>12.4f} {:>12}".format(
+            nscans, t_lbfgs, "-", rms_lbfgs, "-"))
+
+    shutil.rmtree(workdir)
+    for f in glob.glob('out_iter_Ch0_*.txt'):
+        os.unlink(f)
@@ -0,0 +1,78 @@
+"""Benchmark the rolling-window statistics against the strided versions.
+
+The strided versions build a (n - w + 1) x w view of the array and compute
+the statistics of each row, as ``ref_std`` and ``ref_mad`` used to do; the
+median filter is compared with ``scipy.ndimage.median_filter``. The last
+table compares the calls made by the pipeline (``ref_mad`` with a window of
+20 samples, as in the RFI cleaning, and the median filter of 5 samples of
+``purge_outliers``) with their previous implementations.
+
+Usage: python bench_rolling.py
+"""
+from __future__ import (absolute_import, division,
+                        print_function)
+import time
+import numpy as np
+from scipy.ndimage import median_filter as scipy_median_filter
+from srttools.fit import _rolling_window, ref_mad
+from srttools.utils import mad, HAS_NUMBA
+from srttools.rolling import rolling_std, rolling_mad, median_filter
+from srttools.rolling import MIN_KERNEL_WINDOW
+
+
+def timeit(func, *args, **kwargs):
+    t0 = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - t0, result
+
+
+def strided_std(a, window):
+    return np.std(_rolling_window(a, window), 1)
+
+
+def strided_mad(a, window):
+    return mad(_rolling_window(a, window), axis=1)
+
+
+def old_ref_mad(a, window):
+    return np.median(strided_mad(a, window))
+
+
+# Compile the numba kernels before timing
+rolling_mad(np.random.normal(0, 1, 100), 10)
+
+print("Numba available: {}".format(HAS_NUMBA))
+if not HAS_NUMBA:
+    print("Numba is a dependency of srttools! Without it, the median and "
+          "MAD of windows shorter than {} samples use the strided "
+          "versions".format(MIN_KERNEL_WINDOW))
+print("{:>14} {:>8} {:>8} {:>12} {:>12} {:>10}".format(
+    "Statistic", "Length", "Window", "strided (s)", "rolling (s)",
+    "max diff"))
+for length in [1000, 16384, 100000]:
+    a = np.random.normal(0, 1, length)
+    for window in [5, 20, 200, max(length // 20, 20)]:
+        for name, old, new in [('std', strided_std, rolling_std),
+                               ('mad', strided_mad, rolling_mad),
+                               ('median_filter', scipy_median_filter,
+                                median_filter)]:
+            t_old, res_old = timeit(old, a, window)
+            t_new, res_new = timeit(new, a, window)
+            print("{:>14} {:>8} {:>8} {:>12.4f} {:>12.4f} {:>10.2e}".format(
+                name, length, window, t_old, t_new,
+                np.max(np.abs(res_old - res_new))))
+
+print()
+print("{:>14} {:>8} {:>8} {:>12} {:>12} {:>10}".format(
+    "Pipeline call", "Length", "Window", "before (s)", "now (s)",
+    "max diff"))
+for length in [1000, 16384, 100000]:
+    a = np.random.normal(0, 1, length)
+    for name, window, old, new in [
+            ('ref_mad', 20, old_ref_mad, ref_mad),
+            ('median_filter', 5, scipy_median_filter, median_filter)]:
+        t_old, res_old = timeit(old, a, window)
+        t_new, res_new = timeit(new, a, window)
+        print("{:>14} {:>8} {:>8} {:>12.4f} {:>12.4f} {:>10.2e}".format(
+            name, length, window, t_old, t_new,
+            np.max(np.abs(res_old - res_new))))
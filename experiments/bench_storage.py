@@ -0,0 +1,84 @@
+"""Benchmark the storage options of processed scansets.
+
+A simulated scanset is saved with different compression filters and
+precisions, measuring the file size and the write and read throughput.
+
+Usage: python bench_storage.py
+"""
+from __future__ import (absolute_import, division,
+                        print_function)
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+from srttools.simulate import simulate_map
+from srttools.imager import ScanSet
+
+CONFIG = """
+[local]
+workdir : .
+datadir : .
+
+[analysis]
+projection : ARC
+interpolation : spline
+prefix : test_
+list_of_directories :
+    gauss_ra
+    gauss_dec
+pixel_size : 0.8
+"""
+
+OPTIONS = [(None, 'double', None),
+           ('lzf', 'double', None),
+           ('gzip', 'double', None),
+           (None, 'single', None),
+           ('gzip', 'single', None),
+           ('gzip', 'single', 16),
+           ('gzip', 'single', 10)]
+
+
+def simulated_scanset(workdir, width):
+    simulate_map(length_ra=width, length_dec=width,
+                 outdir=(os.path.join(workdir, 'gauss_ra'),
+                         os.path.join(workdir, 'gauss_dec')),
+                 mean_ra=180, mean_dec=45, speed=2., spacing=0.5)
+    config_file = os.path.join(workdir, 'bench.ini')
+    with open(config_file, 'w') as fobj:
+        print(CONFIG, file=fobj)
+    return ScanSet(config_file, nosub=True)
+
+
+def timeit(func, *args, **kwargs):
+    t0 = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - t0, result
+
+
+workdir = tempfile.mkdtemp()
+scanset = simulated_scanset(workdir, 30)
+fname = os.path.join(workdir, 'scanset.hdf5')
+reference = None
+
+print("{:>6} {:>8} {:>5} {:>10} {:>12} {:>11} {:>11}".format(
+    "Filter", "Prec.", "Bits", "Size (MB)", "Write (MB/s)", "Read (MB/s)",
+    "Max rel.err"))
+for compression, precision, keep_bits in OPTIONS:
+    if os.path.exists(fname):
+        os.unlink(fname)
+    t_write, _ = timeit(scanset.write, fname, overwrite=True,
+                        compression=compression, precision=precision,
+                        keep_bits=keep_bits)
+    size = os.path.getsize(fname) / 1024 ** 2
+    if reference is None:
+        reference = size
+    t_read, saved = timeit(ScanSet, fname)
+    good = scanset['Ch0'] != 0
+    err = np.max(np.abs(saved['Ch0'][good] / scanset['Ch0'][good] - 1))
+    # Throughput is given with respect to the uncompressed size
+    print("{:>6} {:>8} {:>5} {:>10.2f} {:>12.1f} {:>11.1f} {:>11.2g}".format(
+        str(compression), precision, str(keep_bits), size,
+        reference / t_write, reference / t_read, err))
+
+shutil.rmtree(workdir)
@@ -118,7 +118,8 @@ package_info['package_data'][PACKAGENAME].extend(c_files)
 install_requires = [
     'scipy',
     'numpy',
-    'astropy'
+    'astropy',
+    'numba'
     ]
 
 setup(name=PACKAGENAME,
@@ -12,7 +12,11 @@ from ._astropy_init import *  # NOQA
 
 # For egg_info test builds to pass, put package imports here.
 if not _ASTROPY_SETUP_:
+    from .accumulator import *  # noqa: F401,F403
+    from .archive import *  # noqa: F401,F403
+    from .cache import *  # noqa: F401,F403
     from .calibration import *  # noqa: F401,F403
+    from .diagnostics import *  # noqa: F401,F403
     from .fit import *  # noqa: F401,F403
     from .global_fit import *  # noqa: F401,F403
     from .histograms import *  # noqa: F401,F403
@@ -21,6 +25,8 @@ if not _ASTROPY_SETUP_:
     from .interactive_filter import *  # noqa: F401,F403
     from .io import *  # noqa: F401,F403
     from .read_config import *  # noqa: F401,F403
+    from .rolling import *  # noqa: F401,F403
     from .scan import *  # noqa: F401,F403
     from .simulate import *  # noqa: F401,F403
+    from .transforms import *  # noqa: F401,F403
     from .utils import *  # noqa: F401,F403
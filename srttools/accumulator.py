@@ -0,0 +1,194 @@
+"""Incremental accumulation of data into images.
+
+The mean and standard deviation images of a map only depend on the number
+of samples falling in each pixel (exposure), their sum and the sum of their
+squares. These sums can be updated when a scan is added or removed, in a time
+proportional to the length of the scan, without going through all the data
+again.
+"""
+from __future__ import (absolute_import, division,
+                        print_function)
+import numpy as np
+
+__all__ = ["ImageAccumulator"]
+
+
+def _add_at(grid, idx, weights=None):
+    """Add weights (or ones) to the flattened grid at the given indices."""
+    flat = grid.reshape(-1)
+    if weights is None:
+        weights = np.ones(len(idx))
+    if len(idx) > flat.size // 8:
+        # Many samples: a single pass on the whole grid is faster
+        flat += np.bincount(idx, weights=weights, minlength=flat.size)
+    else:
+        np.add.at(flat, idx, weights)
+
+
+class ImageAccumulator(object):
+    """Sums of the samples falling in each pixel, per channel and direction.
+
+    For each channel and scanning direction, three grids are kept: the
+    number of samples in each pixel (exposure), the sum of their values and
+    the sum of their squared values.
+
+    Parameters
+    ----------
+    npix : [int, int]
+        Number of pixels along the x and y axes. Pixel ``i`` contains the
+        samples with coordinates in ``[i, i + 1)``, as in the images produced
+        by :func:`srttools.imager.ScanSet.calculate_images`
+
+    Attributes
+    ----------
+    grids : dict
+        For each ``(channel, direction)`` key, a dictionary containing the
+        ``expo``, ``sum`` and ``sumsq`` grids
+    meta : dict
+        Free-form information on how the data were accumulated
+
+    Examples
+    --------
+    >>> acc = ImageAccumulator([4, 3])
+    >>> acc.add('Ch0', [0.5, 0.5, 3.2], [1.1, 1.9, 0.], [1., 3., 5.])
+    >>> images = acc.images()
+    >>> images['Ch0'].shape
+    (3, 4)
+    >>> images['Ch0'][1, 0], images['Ch0-Sdev'][1, 0], images['Ch0-EXPO'][1, 0]
+    (2.0, 1.0, 2.0)
+    >>> acc.remove('Ch0', [0.5], [1.9], [3.])
+    >>> images = acc.images()
+    >>> images['Ch0'][1, 0], images['Ch0-Sdev'][1, 0], images['Ch0-EXPO'][1, 0]
+    (1.0, 0.0, 1.0)
+    """
+    def __init__(self, npix):
+        self.npix = (int(npix[0]), int(npix[1]))
+        self.grids = {}
+        self.meta = {}
+
+    @property
+    def channels(self):
+        """Sorted list of the channels accumulated so far."""
+        return sorted(set([key[0] for key in self.grids]))
+
+    def _get_grids(self, ch, direction):
+        key = (ch, direction)
+        if key not in self.grids:
+            self.grids[key] = {'expo': np.zeros(self.npix),
+                               'sum': np.zeros(self.npix),
+                               'sumsq': np.zeros(self.npix)}
+        return self.grids[key]
+
+    def _pixel_indices(self, x, y):
+        """Flattened pixel indices of the samples falling inside the map.
+
+        Returns the indices and the mask of the samples inside the map. The
+        binning is the same as ``np.histogram2d`` with unit-size bins
+        starting from zero (the upper edge is included in the last pixel).
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        nx, ny = self.npix
+        inside = (x >= 0) & (x <= nx) & (y >= 0) & (y <= ny)
+        ix = np.floor(x[inside]).astype(int)
+        iy = np.floor(y[inside]).astype(int)
+        ix[ix == nx] = nx - 1
+        iy[iy == ny] = ny - 1
+        return ix * ny + iy, inside
+
+    def add(self, ch, x, y, counts, direction=0):
+        """Add samples to the sums of a given channel and direction.
+
+        Parameters
+        ----------
+        ch : str
+            The channel
+        x : array-like
+            Pixel coordinates of the samples along the x axis
+        y : array-like
+            Pixel coordinates of the samples along the y axis
+        counts : array-like
+            The values of the samples
+
+        Other Parameters
+        ----------------
+        direction : int
+            Scanning direction (0: horizontal, 1: vertical)
+        """
+        self._update(ch, x, y, counts, direction, 1)
+
+    def remove(self, ch, x, y, counts, direction=0):
+        """Remove samples previously added with :func:`add`.
+
+        Parameters and other parameters are the same as :func:`add`. The
+        sums of pixels that are left without any sample are reset to zero
+        exactly, to avoid leaving rounding residuals.
+        """
+        self._update(ch, x, y, counts, direction, -1)
+
+    def _update(self, ch, x, y, counts, direction, sign):
+        idx, inside = self._pixel_indices(x, y)
+        counts = np.asarray(counts, dtype=float)[inside]
+        grids = self._get_grids(ch, direction)
+
+        _add_at(grids['expo'], idx, sign * np.ones(len(idx)))
+        _add_at(grids['sum'], idx, sign * counts)
+        _add_at(grids['sumsq'], idx, sign * counts ** 2)
+
+        if sign < 0:
+            empty = grids['expo'].reshape(-1)[idx] <= 0
+            for name in ['expo', 'sum', 'sumsq']:
+                grids[name].reshape(-1)[idx[empty]] = 0
+
+    def clear(self, ch=None):
+        """Delete the sums of one channel or, if ``ch`` is None, all."""
+        for key in list(self.grids.keys()):
+            if ch is None or key[0] == ch:
+                del self.grids[key]
+
+    def images(self, direction=None, channels=None):
+        """Calculate the images from the accumulated sums.
+
+        Other Parameters
+        ----------------
+        direction : int
+            Only use the samples from this scanning direction (0: horizontal,
+            1: vertical). Default: all directions
+        channels : list of str
+            Only calculate the images for these channels. Default: all
+
+        Returns
+        -------
+        images : dict
+            For each channel ``ChX``, the mean image ``ChX``, the standard
+            deviation ``ChX-Sdev`` and the number of samples per pixel
+            ``ChX-EXPO``. Following the FITS convention, the first axis of
+            the images is y.
+        """
+        if channels is None:
+            channels = self.channels
+
+        images = {}
+        for ch in channels:
+            expomap = np.zeros(self.npix)
+            img = np.zeros(self.npix)
+            img_sq = np.zeros(self.npix)
+            for (c, d), grids in self.grids.items():
+                if c != ch or (direction is not None and d != direction):
+                    continue
+                expomap += grids['expo']
+                img += grids['sum']
+                img_sq += grids['sumsq']
+
+            good = expomap > 0
+            mean = img.copy()
+            mean[good] /= expomap[good]
+            img_sdev = img_sq
+            img_sdev[good] = img_sdev[good] / expomap[good] - mean[good] ** 2
+            # Rounding errors might make the variance slightly negative
+            img_sdev[img_sdev < 0] = 0
+
+            images[ch] = mean.T
+            images['{}-Sdev'.format(ch)] = np.sqrt(img_sdev).T
+            images['{}-EXPO'.format(ch)] = expomap.T
+        return images
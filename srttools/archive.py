@@ -0,0 +1,347 @@
+"""Single-file archive of many scans.
+
+All scans are stored in a single HDF5 file, each in its own group. Every
+column is a chunked, compressed dataset, and metadata are stored as native
+HDF5 attributes where possible (only values that have no HDF5 equivalent,
+like dictionaries or times, are serialized to YAML). An index with the name
+and the length of each scan allows to read only selected scans (and
+channels), and new scans can be appended without rewriting the file.
+"""
+from __future__ import (absolute_import, division,
+                        print_function)
+import numpy as np
+import six
+import astropy.units as u
+from astropy.table import Table, MaskedColumn
+
+try:
+    import h5py
+    HAS_H5PY = True
+except ImportError:
+    HAS_H5PY = False
+
+__all__ = ["ScanArchive", "is_archive"]
+
+# Increase this when the layout of the archive changes
+ARCHIVE_FORMAT_VERSION = 1
+
+_TYPE_PREFIX = '__type__'
+# Group containing the masks of masked columns, in each scan
+_MASK_GROUP = '__masks__'
+
+
+def _to_yaml(key, value):
+    """Serialize a metadata value with the astropy YAML dumper."""
+    import yaml as pyyaml
+    from astropy.io.misc import yaml
+    try:
+        return yaml.dump(value)
+    except pyyaml.YAMLError:
+        raise TypeError("Metadata {} of type {} cannot be stored in the "
+                        "archive".format(key, type(value).__name__))
+
+
+def _from_yaml(value):
+    from astropy.io.misc import yaml
+    return yaml.load(value)
+
+
+def _encode_attrs(attrs, meta):
+    """Store a metadata dictionary in HDF5 attributes.
+
+    Strings, numbers, booleans and numeric arrays are stored as they are.
+    None, quantities and lists need an additional attribute describing how to
+    decode them. Other objects are serialized to YAML with
+    ``astropy.io.misc.yaml``, which handles the most common astropy and numpy
+    objects; a TypeError is raised for objects it cannot represent.
+    """
+    for key, value in meta.items():
+        key = str(key)
+        kind = None
+        if value is None:
+            value, kind = 0, 'none'
+        elif isinstance(value, u.Quantity):
+            value, kind = value.value, 'quantity:' + value.unit.to_string()
+        elif (isinstance(value, np.ndarray) and value.dtype.kind == 'U') or \
+                (isinstance(value, (list, tuple)) and
+                 all([isinstance(v, six.string_types) for v in value])):
+            value = np.array([v.encode('utf-8') for v in value],
+                             dtype=h5py.special_dtype(vlen=bytes))
+            kind = 'strlist'
+        elif isinstance(value, (list, tuple)):
+            try:
+                value, kind = np.array(value, dtype=float), 'list'
+            except (TypeError, ValueError):
+                value, kind = _to_yaml(key, value), 'yaml'
+        elif isinstance(value, np.ndarray):
+            if value.dtype.kind not in 'biufcS':
+                value, kind = _to_yaml(key, value), 'yaml'
+        elif not isinstance(value, (six.string_types, bool, int, float,
+                                    np.number, np.bool_)):
+            value, kind = _to_yaml(key, value), 'yaml'
+
+        attrs[key] = value
+        if kind is not None:
+            attrs[_TYPE_PREFIX + key] = kind
+
+
+def _decode_value(value, kind):
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    if kind is None:
+        return value
+    if kind == 'none':
+        return None
+    if kind.startswith('quantity:'):
+        return value * u.Unit(kind.replace('quantity:', '', 1))
+    if kind == 'strlist':
+        return [v.decode('utf-8') if isinstance(v, bytes) else v
+                for v in value]
+    if kind == 'list':
+        return list(value)
+    if kind == 'yaml':
+        return _from_yaml(value)
+    raise ValueError("Unknown metadata type: {}".format(kind))
+
+
+def _decode_attrs(attrs, skip=()):
+    """Read a metadata dictionary written with :func:`_encode_attrs`."""
+    meta = {}
+    for key in attrs.keys():
+        if key.startswith(_TYPE_PREFIX) or key in skip:
+            continue
+        kind = attrs.get(_TYPE_PREFIX + key, None)
+        if isinstance(kind, bytes):
+            kind = kind.decode('utf-8')
+        meta[key] = _decode_value(attrs[key], kind)
+    return meta
+
+
+def _is_channel_column(colname, channel):
+    return colname == channel or colname.startswith(channel + '_') or \
+        colname.startswith(channel + '-')
+
+
+def is_archive(fname):
+    """Tell if a file is a scan archive."""
+    if not HAS_H5PY:
+        return False
+    try:
+        with h5py.File(fname, 'r') as fobj:
+            return 'srttools_archive_version' in fobj.attrs
+    except (IOError, OSError):
+        return False
+
+
+class ScanArchive(object):
+    """An HDF5 file containing many scans.
+
+    Parameters
+    ----------
+    fname : str
+        The archive file
+
+    Other Parameters
+    ----------------
+    mode : str
+        ``'r'`` to read an existing archive, ``'a'`` (default) to read it
+        and append scans to it (it is created if it does not exist), ``'w'``
+        to create a new archive, overwriting any existing file
+    compression : str
+        Compression filter for the columns (any filter supported by
+        ``h5py``, e.g. ``'gzip'`` or ``'lzf'``, or None)
+
+    Attributes
+    ----------
+    meta : dict
+        Metadata of the whole archive. Changes are written to the file by
+        :func:`close` (or when exiting a ``with`` block)
+    """
+    def __init__(self, fname, mode='a', compression='gzip'):
+        if not HAS_H5PY:
+            raise ImportError('ScanArchive: h5py is not installed')
+        self.fname = fname
+        self.mode = mode
+        self.compression = compression
+        self.fobj = h5py.File(fname, mode)
+        if 'index' not in self.fobj:
+            if mode == 'r':
+                raise ValueError("{} is not a scan archive".format(fname))
+            self.fobj.attrs['srttools_archive_version'] = \
+                ARCHIVE_FORMAT_VERSION
+            index = self.fobj.create_group('index')
+            index.create_dataset('name', (0,), maxshape=(None,),
+                                 dtype=h5py.special_dtype(vlen=bytes))
+            index.create_dataset('nrows', (0,), maxshape=(None,),
+                                 dtype=np.int64)
+            self.fobj.create_group('scans')
+        self.meta = _decode_attrs(self.fobj['scans'].attrs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Write the metadata and close the file."""
+        if self.fobj is None:
+            return
+        if self.mode != 'r':
+            attrs = self.fobj['scans'].attrs
+            for key in list(attrs.keys()):
+                del attrs[key]
+            _encode_attrs(attrs, self.meta)
+        self.fobj.close()
+        self.fobj = None
+
+    def __len__(self):
+        return self.fobj['index/nrows'].shape[0]
+
+    @property
+    def names(self):
+        """Names of the scans in the archive, in order."""
+        return [n.decode('utf-8') if isinstance(n, bytes) else n
+                for n in self.fobj['index/name'][:]]
+
+    @property
+    def nrows(self):
+        """Number of rows of each scan in the archive."""
+        return np.array(self.fobj['index/nrows'][:])
+
+    def _index_of(self, scan):
+        if isinstance(scan, six.string_types):
+            return self.names.index(scan)
+        return int(scan)
+
+    def _write_group(self, group, table):
+        """Write the columns and metadata of a table in an HDF5 group."""
+        group.attrs['colnames'] = \
+            np.array([c.encode('utf-8') for c in table.colnames],
+                     dtype=h5py.special_dtype(vlen=bytes))
+        _encode_attrs(group.attrs, table.meta)
+
+        kwargs = {}
+        if len(table) > 0:
+            kwargs = dict(chunks=True, compression=self.compression)
+            if self.compression is not None:
+                kwargs['shuffle'] = True
+        for col in table.colnames:
+            data = np.ma.getdata(table[col])
+            colmeta = dict(table[col].meta)
+            if data.dtype.kind == 'U':
+                data = np.char.encode(data, 'utf-8')
+                colmeta['__encoding__'] = 'utf-8'
+            dset = group.create_dataset(col, data=data, **kwargs)
+            if table[col].unit is not None:
+                colmeta['__unit__'] = table[col].unit.to_string()
+            _encode_attrs(dset.attrs, colmeta)
+
+            mask = np.ma.getmask(table[col])
+            if np.any(mask):
+                masks = group.require_group(_MASK_GROUP)
+                masks.create_dataset(col, data=mask, **kwargs)
+
+    def append(self, table, name=''):
+        """Add a scan (or any table) at the end of the archive.
+
+        Parameters
+        ----------
+        table : ``astropy.table.Table``
+            The data. Tables with zero rows are allowed (e.g. to keep track of
+            scans that could not be loaded)
+
+        Other Parameters
+        ----------------
+        name : str
+            The name of the scan, e.g. the name of the original file
+
+        Returns
+        -------
+        index : int
+            The index of the new scan in the archive
+        """
+        index = len(self)
+        groupname = '{:06d}'.format(index)
+        group = self.fobj['scans'].create_group(groupname)
+        try:
+            self._write_group(group, table)
+        except Exception:
+            # Do not leave incomplete scans in the file
+            del self.fobj['scans'][groupname]
+            raise
+
+        for dsetname, value in [('name', name.encode('utf-8')),
+                                ('nrows', len(table))]:
+            dset = self.fobj['index/' + dsetname]
+            dset.resize((index + 1,))
+            dset[index] = value
+        return index
+
+    def read(self, scan, channels=None, columns=None):
+        """Read a scan from the archive.
+
+        Parameters
+        ----------
+        scan : int or str
+            The index or the name of the scan
+
+        Other Parameters
+        ----------------
+        channels : list of str
+            Only read the columns of these channels (e.g. ``Ch0``,
+            ``Ch0_feed``, ``Ch0-filt``), plus all the columns not related to
+            a specific channel
+        columns : list of str
+            Only read these columns
+
+        Returns
+        -------
+        table : ``astropy.table.Table``
+            The scan
+        """
+        from .scan import chan_re
+        group = self.fobj['scans/{:06d}'.format(self._index_of(scan))]
+        colnames = [c.decode('utf-8') if isinstance(c, bytes) else c
+                    for c in group.attrs['colnames']]
+        if columns is not None:
+            colnames = [c for c in colnames if c in columns]
+        if channels is not None:
+            allchans = [c for c in colnames if chan_re.match(c)]
+            excluded = [ch for ch in allchans if ch not in channels]
+            colnames = [c for c in colnames
+                        if not any([_is_channel_column(c, ch)
+                                    for ch in excluded])]
+
+        table = Table(meta=_decode_attrs(group.attrs, skip=['colnames']))
+        masks = group.get(_MASK_GROUP, {})
+        for col in colnames:
+            dset = group[col]
+            colmeta = _decode_attrs(dset.attrs)
+            unit = colmeta.pop('__unit__', None)
+            encoding = colmeta.pop('__encoding__', None)
+            data = dset[...]
+            if encoding is not None:
+                data = np.char.decode(data, encoding)
+            if col in masks:
+                table[col] = MaskedColumn(data, mask=masks[col][...])
+            else:
+                table[col] = data
+            table[col].unit = unit
+            table[col].meta.update(colmeta)
+        return table
+
+    def read_scans(self, scans=None, channels=None, columns=None):
+        """Read many scans, yielding their index and the data.
+
+        Parameters are the same as :func:`read`; ``scans`` is a list of
+        indices or names (default: all). Empty scans are skipped.
+        """
+        if scans is None:
+            scans = range(len(self))
+        nrows = self.nrows
+        for scan in scans:
+            i = self._index_of(scan)
+            if nrows[i] == 0:
+                continue
+            yield i, self.read(i, channels=channels, columns=columns)
@@ -0,0 +1,238 @@
+"""Persistent cache of processed scans.
+
+Processed scans are stored in a cache directory, under a name obtained from
+the checksum of the raw file and from the parameters used to process it.
+If any of these changes, the key changes and the scan is processed again.
+To avoid reading the whole raw file every time it is loaded, its checksum
+is remembered in a small file in the cache directory (one per raw file, so
+that concurrent processes never update the same file), together with the
+modification time and size of the raw file, and only recalculated when
+they change.
+The least recently used entries are deleted when the cache grows beyond a
+maximum size.
+"""
+from __future__ import (absolute_import, division,
+                        print_function)
+import os
+import glob
+import json
+import hashlib
+import logging
+import tempfile
+from .io import mkdir_p
+
+__all__ = ["file_checksum", "processing_key", "ScanCache"]
+
+
+# Increase this when the processing changes, to invalidate old entries
+CACHE_FORMAT_VERSION = 1
+
+
+def file_checksum(fname, blocksize=2**20):
+    """Calculate the SHA1 checksum of the contents of a file.
+
+    Parameters
+    ----------
+    fname : str
+        The file name
+
+    Other Parameters
+    ----------------
+    blocksize : int
+        Read the file in blocks of this many bytes
+
+    Returns
+    -------
+    checksum : str
+        The hexadecimal digest
+    """
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as fobj:
+        for block in iter(lambda: fobj.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def processing_key(fname, checksum=None, **params):
+    """Cache key for a file processed with a given set of parameters.
+
+    Parameters
+    ----------
+    fname : str
+        The raw data file
+
+    Other Parameters
+    ----------------
+    checksum : str
+        The checksum of the raw data file, if already known (e.g. from
+        :func:`ScanCache.checksum`). Otherwise, it is calculated here
+    params : keyword arguments
+        All the parameters affecting the result of the processing (e.g.
+        ``freqsplat``, ``nofilt``, ``noise_threshold``...). Their ``repr`` is
+        used to compute the key.
+
+    Returns
+    -------
+    key : str
+        Hexadecimal string identifying the raw data and the processing
+
+    Examples
+    --------
+    >>> key1 = processing_key(__file__, freqsplat=None, nofilt=False)
+    >>> key2 = processing_key(__file__, nofilt=False, freqsplat=None)
+    >>> key3 = processing_key(__file__, freqsplat='all', nofilt=False)
+    >>> key1 == key2
+    True
+    >>> key1 == key3
+    False
+    """
+    if checksum is None:
+        checksum = file_checksum(fname)
+    sha = hashlib.sha1()
+    sha.update(checksum.encode())
+    sha.update(repr(CACHE_FORMAT_VERSION).encode())
+    sha.update(repr(sorted(params.items())).encode())
+    return sha.hexdigest()
+
+
+class ScanCache(object):
+    """Directory containing processed scans, indexed by processing key.
+
+    Parameters
+    ----------
+    directory : str
+        The cache directory. It is created if it does not exist
+
+    Other Parameters
+    ----------------
+    max_size : int
+        Maximum total size of the cache, in bytes. When it is exceeded, the
+        least recently used entries are deleted. If None, the cache grows
+        indefinitely.
+    """
+    def __init__(self, directory, max_size=None):
+        self.directory = os.path.abspath(directory)
+        self.max_size = max_size
+        self.checksum_dir = os.path.join(self.directory, 'checksums')
+        mkdir_p(self.checksum_dir)
+
+    def path(self, key):
+        """File name of the cache entry corresponding to ``key``."""
+        return os.path.join(self.directory, key + '.hdf5')
+
+    def _checksum_file(self, fname):
+        """File containing the checksum record of a raw file."""
+        name = hashlib.sha1(fname.encode('utf-8')).hexdigest()
+        return os.path.join(self.checksum_dir, name + '.json')
+
+    def _read_checksum_record(self, fname):
+        try:
+            with open(self._checksum_file(fname)) as fobj:
+                record = json.load(fobj)
+        except (IOError, OSError, ValueError):
+            return None
+        if record.get('path') != fname:
+            return None
+        return record
+
+    def _write_checksum_record(self, fname, record):
+        # Write to a temporary file and rename it, so that readers never
+        # see partial records
+        fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=self.checksum_dir)
+        with os.fdopen(fd, 'w') as fobj:
+            json.dump(record, fobj)
+        try:
+            os.rename(tmpname, self._checksum_file(fname))
+        except OSError:
+            # Another process wrote the same record in the meantime
+            os.unlink(tmpname)
+
+    def checksum(self, fname):
+        """Checksum of a raw data file, calculated only if it changed.
+
+        The checksum is looked up in the record of the file, which also
+        contains its modification time and size. The file is read, and the
+        record rewritten, only if they don't match.
+        """
+        fname = os.path.abspath(fname)
+        stat = os.stat(fname)
+        record = self._read_checksum_record(fname)
+        if record is not None and record['mtime'] == stat.st_mtime and \
+                record['size'] == stat.st_size:
+            return record['checksum']
+
+        checksum = file_checksum(fname)
+        self._write_checksum_record(fname, {'path': fname,
+                                            'mtime': stat.st_mtime,
+                                            'size': stat.st_size,
+                                            'checksum': checksum})
+        return checksum
+
+    def entries(self):
+        """List the cache entries, from the least to the most recently used.
+        """
+        files = [f for f in glob.glob(os.path.join(self.directory, '*.hdf5'))
+                 if not f.endswith('.tmp.hdf5')]
+        return sorted(files, key=os.path.getmtime)
+
+    def size(self):
+        """Total size of the cache, in bytes."""
+        return sum([os.path.getsize(f) for f in self.entries()])
+
+    def get(self, key):
+        """Return the file name of a cache entry, or None if missing.
+
+        The modification time of the file is updated, to mark it as
+        recently used.
+        """
+        fname = self.path(key)
+        if not os.path.exists(fname):
+            return None
+        os.utime(fname, None)
+        return fname
+
+    def put(self, key, scan):
+        """Save a scan in the cache and return the file name of the entry.
+
+        The scan is written to a temporary file first and then renamed, so
+        that concurrent processes never see partial entries.
+        """
+        fname = self.path(key)
+        tmpname = \
+            fname.replace('.hdf5', '.{}.tmp.hdf5'.format(os.getpid()))
+        scan.write(tmpname, overwrite=True)
+        try:
+            os.rename(tmpname, fname)
+        except OSError:
+            # Another process saved the same entry in the meantime
+            os.unlink(tmpname)
+        self.evict()
+        return fname
+
+    def evict(self, max_size=None):
+        """Delete the least recently used entries until the size is ok.
+
+        Other Parameters
+        ----------------
+        max_size : int
+            Maximum size of the cache, in bytes. Defaults to the one given at
+            initialization.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return
+
+        entries = self.entries()
+        sizes = [os.path.getsize(f) for f in entries]
+        total = sum(sizes)
+        for fname, size in zip(entries, sizes):
+            if total <= max_size:
+                break
+            logging.info("Removing {} from the cache".format(fname))
+            try:
+                os.unlink(fname)
+            except OSError:
+                # Probably already removed by another process
+                pass
+            total -= size
@@ -15,7 +15,7 @@ from .read_config import read_config, sample_config_file, get_config_file
 from .fit import fit_baseline_plus_bell
 from .io import mkdir_p
 from .utils import standard_string, standard_byte, compare_strings
-from .utils import HAS_STATSM
+from .utils import HAS_STATSM, parallel_imap
 
 import os
 import sys
@@ -23,6 +23,7 @@ import glob
 import re
 import warnings
 import traceback
+import functools
 from scipy.optimize import curve_fit
 import logging
 import astropy.units as u
@@ -200,8 +201,10 @@ def _treat_scan(scan_path, plot=False, **kwargs):
         warnings.warn(traceback.format_exc())
         return False, None
 
-    feeds = np.arange(scan['ra'].shape[1])
     chans = scan.chan_columns()
+    # Coordinates are only calculated for the feeds used by the channels
+    feeds = sorted(set([int(f) for ch in chans
+                        for f in np.unique(scan[ch + '_feed'])]))
 
     chan_nums = np.arange(len(chans))
     F, N = np.meshgrid(feeds, chan_nums)
@@ -211,11 +214,12 @@ def _treat_scan(scan_path, plot=False, **kwargs):
     for feed, nch in zip(F, N):
         channel = chans[nch]
 
-        ras = np.degrees(scan['ra'][:, feed])
-        decs = np.degrees(scan['dec'][:, feed])
+        coords = scan.coordinates(feed)
+        ras = np.degrees(coords['ra'])
+        decs = np.degrees(coords['dec'])
         time = np.mean(scan['time'][:])
-        el = np.degrees(np.mean(scan['el'][:, feed]))
-        az = np.degrees(np.mean(scan['az'][:, feed]))
+        el = np.degrees(np.mean(coords['el']))
+        az = np.degrees(np.mean(coords['az']))
         source = scan.meta['SOURCE']
         pnt_ra = np.degrees(scan.meta['RA'])
         pnt_dec = np.degrees(scan.meta['Dec'])
@@ -351,7 +355,7 @@ class CalibratorTable(Table):
                 self.add_column(Column(name=n, dtype=d))
 
     def from_scans(self, scan_list=None, debug=False, freqsplat=None,
-                   config_file=None, nofilt=False, plot=False):
+                   config_file=None, nofilt=False, plot=False, nproc=1):
         """Load source table from a list of scans.
 
         For each scan, a fit is performed. Since we are assuming point-like
@@ -378,6 +382,9 @@ class CalibratorTable(Table):
             :class:`srttools.scan.clean_scan_using_variability`
         plot : bool
             Plot diagnostic plots? Default False, True if debug is True.
+        nproc : int
+            Number of processes used to load and fit the scans in parallel.
+            Rows are added in the same order as ``scan_list`` anyway.
 
         Returns
         -------
@@ -404,12 +411,18 @@ class CalibratorTable(Table):
             scan_list.sort()
         nscan = len(scan_list)
 
-        out_retval = False
-        for i_s, s in enumerate(scan_list):
-            logging.info('{}/{}: Loading {}'.format(i_s + 1, nscan, s))
+        if config_file is None:
+            config_file = get_config_file()
+
+        treat = functools.partial(_treat_scan, plot=plot, debug=debug,
+                                  freqsplat=freqsplat, nofilt=nofilt,
+                                  config_file=config_file)
 
-            retval, rows = _treat_scan(s, plot=plot, debug=debug,
-                                       freqsplat=freqsplat, nofilt=nofilt)
+        out_retval = False
+        for i_s, (retval, rows) in enumerate(parallel_imap(treat, scan_list,
+                                                           nproc=nproc)):
+            logging.info('{}/{}: Loaded {}'.format(i_s + 1, nscan,
+                                                   scan_list[i_s]))
 
             if retval:
                 out_retval = True
@@ -1082,7 +1095,14 @@ def main_cal(args=None):
                               "range, starting from the frequency of the first"
                               " bin. E.g. '0:1000' indicates 'from the first "
                               "bin of the spectrum up to 1000 MHz above'. ':' "
-                              "or 'all' for all the channels."))
+                              "or 'all' for all the channels. More ranges "
+                              "separated by commas (e.g. '0:100,300:400') "
+                              "give one channel per range (Ch0_b0, Ch0_b1, "
+                              "...) from a single RFI cleaning."))
+
+    parser.add_argument("--nproc", type=int, default=1,
+                        help='Number of processes used to load and process '
+                             'the scans in parallel')
 
     parser.add_argument("-o", "--output", type=str, default=None,
                         help='Output file containing the calibration')
@@ -1123,7 +1143,8 @@ def main_cal(args=None):
     if outfile is None:
         outfile = args.config.replace(".ini", "_cal.hdf5")
     caltable = CalibratorTable()
-    caltable.from_scans(scan_list, freqsplat=args.splat, nofilt=args.nofilt)
+    caltable.from_scans(scan_list, freqsplat=args.splat, nofilt=args.nofilt,
+                        nproc=args.nproc)
     caltable.update()
 
     if args.check:
@@ -1162,7 +1183,14 @@ def main_lcurve(args=None):
                               "range, starting from the frequency of the first"
                               " bin. E.g. '0:1000' indicates 'from the first "
                               "bin of the spectrum up to 1000 MHz above'. ':' "
-                              "or 'all' for all the channels."))
+                              "or 'all' for all the channels. More ranges "
+                              "separated by commas (e.g. '0:100,300:400') "
+                              "give one channel per range (Ch0_b0, Ch0_b1, "
+                              "...) from a single RFI cleaning."))
+
+    parser.add_argument("--nproc", type=int, default=1,
+                        help='Number of processes used to load and process '
+                             'the scans in parallel')
 
     parser.add_argument("-o", "--output", type=str, default=None,
                         help='Output file containing the calibration')
@@ -1180,7 +1208,7 @@ def main_lcurve(args=None):
         if args.config is None:
             raise ValueError("Please specify the config file!")
         caltable = CalibratorTable()
-        caltable.from_scans(config_file=args.config)
+        caltable.from_scans(config_file=args.config, nproc=args.nproc)
         caltable.update()
 
         outfile = args.output
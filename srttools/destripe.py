@@ -1,9 +1,5 @@
 import numpy as np
-try:
-    import matplotlib.pyplot as plt
-    HAS_MPL = True
-except ImportError:
-    HAS_MPL = False
+from .diagnostics import diagnostics_enabled, diagnostic_plot, plot_image
 
 
 def mask_zeros(image, expo=None, npix_tol=None):
@@ -155,22 +151,15 @@ def destripe_wrapper(image_hor, image_ver, alg='basket-weaving',
         masked_image, mask = mask_zeros(image_mean, expo_hor + expo_ver,
                                         npix_tol=npix_tol)
 
-    if HAS_MPL:
-        fig = plt.figure()
-        plt.imshow(image_hor[mask].reshape(masked_image.shape))
-        plt.savefig('img_hor.png')
-        plt.imshow(image_ver[mask].reshape(masked_image.shape))
-        plt.savefig('img_ver.png')
-        plt.close(fig)
-
-        fig = plt.figure()
-        plt.imshow(expo_hor[mask].reshape(masked_image.shape))
-        plt.savefig('img_expoh.png')
-        plt.imshow(expo_ver[mask].reshape(masked_image.shape))
-        plt.savefig('img_expov.png')
-        plt.imshow(image_mean[mask].reshape(masked_image.shape))
-        plt.savefig('img_initial.png')
-        plt.close(fig)
+    if diagnostics_enabled('summary'):
+        shape = masked_image.shape
+        for fname, img in [('img_hor.png', image_hor),
+                           ('img_ver.png', image_ver),
+                           ('img_expoh.png', expo_hor),
+                           ('img_expov.png', expo_ver),
+                           ('img_initial.png', image_mean)]:
+            diagnostic_plot('summary', fname, plot_image,
+                            img[mask].reshape(shape))
 
     image_mean[mask] = \
         basket_weaving(image_hor[mask].reshape(masked_image.shape),
@@ -180,9 +169,9 @@ def destripe_wrapper(image_hor, image_ver, alg='basket-weaving',
                        expo_ver=expo_ver[mask].reshape(masked_image.shape)
                        ).flatten()
 
-    if HAS_MPL:
-        plt.imshow(image_mean[mask].reshape(masked_image.shape))
-        plt.savefig('img_destr.png')
+    if diagnostics_enabled('summary'):
+        diagnostic_plot('summary', 'img_destr.png', plot_image,
+                        image_mean[mask].reshape(masked_image.shape))
 
     if alg == 'basket-weaving':
         return image_mean
@@ -0,0 +1,190 @@
+"""Deferred, opt-in diagnostic plots.
+
+Diagnostic plots are only produced if the current diagnostics level is at
+least the level of the plot (see :func:`set_diagnostics_level`). The
+default level is ``'none'``, unless the environment variable
+``SRTTOOLS_DIAGNOSTICS`` is set to a valid level, so that normal runs do not
+pay any plotting cost.
+
+Requested plots are queued and rendered in a background thread (a
+:class:`srttools.io.BackgroundWriter`), so that the numerical pipeline does
+not wait for them. At most ``MAX_PENDING_PLOTS`` plots (and their data) are
+kept in the queue; further requests wait for a free slot. Plot functions
+receive a
+``matplotlib.figure.Figure`` not attached to ``pyplot`` (and must not use
+``pyplot``, which is not thread-safe). Array arguments are copied when the
+plot is requested, so that they can be modified afterwards.
+
+Examples
+--------
+>>> set_diagnostics_level('debug', background=False)
+>>> diagnostics_enabled('summary')
+True
+>>> set_diagnostics_level('none')
+>>> diagnostics_enabled('summary')
+False
+"""
+from __future__ import (absolute_import, division,
+                        print_function)
+import os
+import atexit
+import logging
+import warnings
+import threading
+import numpy as np
+from .io import BackgroundWriter
+
+try:
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    HAS_MPL = True
+except ImportError:
+    HAS_MPL = False
+
+__all__ = ["DIAGNOSTICS_LEVELS", "set_diagnostics_level",
+           "get_diagnostics_level", "diagnostics_enabled", "diagnostic_plot",
+           "wait_for_diagnostics", "plot_image", "plot_lines"]
+
+
+DIAGNOSTICS_LEVELS = {'none': 0, 'summary': 1, 'debug': 2}
+
+# Maximum number of plots waiting to be rendered
+MAX_PENDING_PLOTS = 8
+
+
+def _level_number(level):
+    if level in DIAGNOSTICS_LEVELS:
+        return DIAGNOSTICS_LEVELS[level]
+    return int(level)
+
+
+def _level_from_environment():
+    """Diagnostics level from ``SRTTOOLS_DIAGNOSTICS``; 0 if invalid."""
+    level = os.environ.get('SRTTOOLS_DIAGNOSTICS', 'none').strip().lower()
+    try:
+        return _level_number(level)
+    except ValueError:
+        warnings.warn("Invalid value of SRTTOOLS_DIAGNOSTICS: {}. Use one "
+                      "of {} or a number. Diagnostic plots are "
+                      "disabled".format(level,
+                                        sorted(DIAGNOSTICS_LEVELS.keys())))
+        return 0
+
+
+_state = {'level': _level_from_environment(),
+          'background': True,
+          'writer': None}
+_writer_lock = threading.Lock()
+
+
+def _get_writer():
+    """The background thread rendering the plots, started if needed.
+
+    The thread is also started again in processes forked from this one.
+    """
+    with _writer_lock:
+        writer = _state['writer']
+        if writer is None or not writer.thread.is_alive():
+            writer = _state['writer'] = \
+                BackgroundWriter(maxsize=MAX_PENDING_PLOTS)
+    return writer
+
+
+def _render(fname, plot_func, args, kwargs):
+    try:
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        plot_func(fig, *args, **kwargs)
+        fig.savefig(fname)
+    except Exception as e:
+        logging.warning("Diagnostic plot {} failed: {}".format(fname, e))
+
+
+def set_diagnostics_level(level, background=True):
+    """Set which diagnostic plots are produced.
+
+    Parameters
+    ----------
+    level : str or int
+        ``'none'`` (or 0), ``'summary'`` (or 1), ``'debug'`` (or 2)
+
+    Other Parameters
+    ----------------
+    background : bool
+        Render plots in a background thread (default). If False, plots are
+        rendered when requested
+    """
+    _state['level'] = _level_number(level)
+    _state['background'] = background
+
+
+def get_diagnostics_level():
+    """Return the current diagnostics level, as a number."""
+    return _state['level']
+
+
+def diagnostics_enabled(level):
+    """Tell if plots of a given level are produced.
+
+    Useful to avoid preparing the data for a plot that will not be done.
+    """
+    return HAS_MPL and _state['level'] >= _level_number(level)
+
+
+def _copy(value):
+    if isinstance(value, np.ndarray):
+        return np.array(value)
+    return value
+
+
+def diagnostic_plot(level, fname, plot_func, *args, **kwargs):
+    """Request a diagnostic plot.
+
+    Parameters
+    ----------
+    level : str or int
+        The diagnostics level of this plot. The plot is skipped if it is
+        above the current level
+    fname : str
+        Output file
+    plot_func : function
+        Called as ``plot_func(fig, *args, **kwargs)``, where ``fig`` is an
+        empty ``matplotlib.figure.Figure``
+
+    Returns
+    -------
+    requested : bool
+        True if the plot was queued (or done)
+    """
+    if not diagnostics_enabled(level):
+        return False
+    job = (fname, plot_func, [_copy(a) for a in args],
+           dict([(k, _copy(v)) for k, v in kwargs.items()]))
+    if _state['background']:
+        _get_writer().submit(_render, *job)
+    else:
+        _render(*job)
+    return True
+
+
+def wait_for_diagnostics():
+    """Wait until all the requested plots have been saved."""
+    writer = _state['writer']
+    if writer is not None and writer.thread.is_alive():
+        writer.flush()
+
+
+atexit.register(wait_for_diagnostics)
+
+
+def plot_image(fig, image, **kwargs):
+    """Plot function showing an image (for :func:`diagnostic_plot`)."""
+    ax = fig.add_subplot(111)
+    ax.imshow(image, **kwargs)
+
+
+def plot_lines(fig, *xy):
+    """Plot function showing ``x1, y1, x2, y2, ...`` as lines."""
+    ax = fig.add_subplot(111)
+    for x, y in zip(xy[::2], xy[1::2]):
+        ax.plot(x, y)
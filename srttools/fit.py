@@ -2,18 +2,18 @@
 from __future__ import (absolute_import, division,
                         print_function)
 from scipy.optimize import curve_fit
-from scipy.ndimage import median_filter
 import numpy as np
 import traceback
 import warnings
 import collections
 from .utils import mad
+from .rolling import rolling_std, rolling_mad, median_filter
 
 
 __all__ = ["contiguous_regions", "ref_std", "ref_mad", "linear_fun",
            "linear_fit", "offset", "offset_fit", "baseline_rough",
            "purge_outliers", "baseline_als", "fit_baseline_plus_bell",
-           "total_variance", "align"]
+           "total_variance", "align", "fill_intervals"]
 
 
 def contiguous_regions(condition):
@@ -55,6 +55,77 @@ def contiguous_regions(condition):
     return idx
 
 
+def fill_intervals(y, starts, stops, left, right, kind='linear', axis=-1):
+    """Fill many intervals of an array at once, in place.
+
+    Each interval ``y[start:stop]`` is filled using the values ``y[left]``
+    and ``y[right]``. All the values used for filling are read before
+    modifying the array.
+
+    Parameters
+    ----------
+    y : array
+        The array to be modified
+    starts, stops : arrays of int
+        Start and stop (excluded) index of each interval
+    left, right : arrays of int
+        Index of the values used to fill each interval. They can coincide,
+        e.g. for intervals at the border of the array
+
+    Other Parameters
+    ----------------
+    kind : str
+        ``'linear'`` interpolates between ``y[left]`` (at index ``left``) and
+        ``y[right]`` (at index ``right``); ``'mean'`` fills the interval with
+        the mean of the two values
+    axis : int
+        The axis along which the intervals are defined
+
+    Returns
+    -------
+    y : array
+        The input array, modified
+
+    Examples
+    --------
+    >>> y = np.array([0, 10., 10, 3, 10, 10, 10, 7, 10])
+    >>> y = fill_intervals(y, [1, 4, 8], [3, 7, 9], [0, 3, 7], [3, 7, 7])
+    >>> np.allclose(y, [0, 1, 2, 3, 4, 5, 6, 7, 7])
+    True
+    >>> y = np.array([[1., 0, 3], [2., 0, 6]])
+    >>> y = fill_intervals(y, [1], [2], [0], [2], kind='mean', axis=1)
+    >>> np.allclose(y, [[1, 2, 3], [2, 4, 6]])
+    True
+    """
+    starts, stops, left, right = \
+        [np.asarray(a, dtype=int) for a in (starts, stops, left, right)]
+    lengths = stops - starts
+    if np.sum(lengths) == 0:
+        return y
+
+    # Indices of all the samples to fill, and of the interval they belong to
+    interval = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    positions = \
+        starts[interval] + np.arange(interval.size) - offsets[interval]
+
+    data = np.moveaxis(y, axis, -1)
+    yleft = data[..., left[interval]]
+    yright = data[..., right[interval]]
+    if kind == 'mean':
+        values = (yleft + yright) / 2
+    elif kind == 'linear':
+        dx = right[interval] - left[interval]
+        dx[dx == 0] = 1
+        values = \
+            (yright - yleft) / dx * (positions - left[interval]) + yleft
+    else:
+        raise ValueError("Unknown kind of interval filling: {}".format(kind))
+
+    data[..., positions] = values
+    return y
+
+
 def _rolling_window(a, window):
     """A smart rolling window.
 
@@ -93,7 +164,7 @@ def ref_std(array, window):
     if len(array) < window*5:
         return np.std(np.diff(array))
 
-    return np.min(np.std(_rolling_window(array, window), 1))
+    return np.min(rolling_std(array, window))
 
 
 def ref_mad(array, window):
@@ -118,7 +189,7 @@ def ref_mad(array, window):
     """
     if len(array) < window*3:
         return mad(array)
-    return np.median(mad(_rolling_window(array, window), axis=1))
+    return np.median(rolling_mad(array, window))
 
 
 def linear_fun(x, q, m):
@@ -285,18 +356,16 @@ def purge_outliers(y, window_size=5, up=True, down=True):
         return y
 
     bad = contiguous_regions(outliers)
-    for b in bad:
-        if b[0] == 0:
-            y[b[0]] = y[b[1]]
-        elif b[1] >= len(y):
-            y[b[0]:] = y[b[0] - 1]
-        else:
-            previous = y[b[0] - 1]
-            next_bin = y[b[1]]
-            dx = b[1] - b[0]
-            y[b[0]:b[1]] = \
-                (next_bin - previous)/(dx + 1) * \
-                np.arange(1, b[1] - b[0] + 1) + previous
+    starts, stops = bad[:, 0], bad[:, 1].copy()
+    left, right = starts - 1, stops.copy()
+    # An interval at the start only replaces its first value with the next
+    # good one; an interval at the end is filled with the previous good one.
+    at_start = starts == 0
+    left[at_start] = right[at_start]
+    stops[at_start] = 1
+    at_end = bad[:, 1] >= len(y)
+    right[at_end] = left[at_end]
+    fill_intervals(y, starts, stops, left, right, kind='linear')
 
     warnings.warn("Found {} outliers".format(len(diffs[outliers])),
                   UserWarning)
@@ -304,7 +373,104 @@ def purge_outliers(y, window_size=5, up=True, down=True):
     return y
 
 
-def _als(y, lam, p, niter=10):
+def _second_difference_band(L):
+    """Band of the matrix D^T D, with D the second-difference operator.
+
+    The result is in the upper form used by ``scipy.linalg.solveh_banded``:
+    the rows contain the second superdiagonal, the first superdiagonal and
+    the diagonal of the (symmetric, pentadiagonal) LxL matrix.
+
+    Examples
+    --------
+    >>> _second_difference_band(5)
+    array([[ 0.,  0.,  1.,  1.,  1.],
+           [ 0., -2., -4., -4., -2.],
+           [ 1.,  5.,  6.,  5.,  1.]])
+    >>> D = np.diff(np.eye(5), 2)
+    >>> DDt = D.dot(D.T)
+    >>> band = _second_difference_band(5)
+    >>> np.all(np.diag(DDt) == band[2])
+    True
+    >>> np.all(np.diag(DDt, 1) == band[1, 1:])
+    True
+    >>> np.all(np.diag(DDt, 2) == band[0, 2:])
+    True
+    """
+    coeffs = [1., -2., 1.]
+    band = np.zeros((3, L))
+    nrows = max(L - 2, 0)
+    for j in range(3):
+        band[2, j:nrows + j] += coeffs[j] ** 2
+    for j in range(2):
+        band[1, j + 1:nrows + j + 1] += coeffs[j] * coeffs[j + 1]
+    band[0, 2:nrows + 2] += coeffs[0] * coeffs[2]
+    return band
+
+
+def _als_banded(y, lam, p, niter=10):
+    """ALS baseline, exploiting the band structure of the linear system.
+
+    The matrix W + lam D D^T is symmetric and pentadiagonal. Its band is
+    calculated once, and at each iteration only the diagonal is updated with
+    the new weights before solving with a banded Cholesky decomposition, in
+    O(L) time and memory.
+
+    If ``y`` is two-dimensional (samples x channels), the channels are
+    concatenated into a single block-diagonal banded system, so that all of
+    them are fitted with one solve per iteration.
+    """
+    from scipy.linalg import solveh_banded, solve_banded, LinAlgError
+    y = np.asarray(y, dtype=np.float64)
+    shape = y.shape
+    L = shape[0]
+    nchan = 1
+    if len(shape) > 1:
+        nchan = int(np.prod(shape[1:]))
+        # Channel after channel, so that each one is a contiguous block
+        y = y.reshape((L, nchan)).T.ravel()
+    # The band of each channel has no elements coupling it with the previous
+    # one, so the tiled band is block-diagonal
+    band = np.tile(lam * _second_difference_band(L), (1, nchan))
+    diag = band[2].copy()
+    w = np.ones(L * nchan)
+    for _ in range(niter):
+        band[2] = diag + w
+        try:
+            z = solveh_banded(band, w * y, check_finite=False)
+        except LinAlgError:
+            # Not positive definite, e.g. if all weights are zero. Use the
+            # (slower) general banded solver
+            full_band = np.zeros((5, L * nchan))
+            full_band[:3] = band
+            full_band[3, :-1] = band[1, 1:]
+            full_band[4, :-2] = band[0, 2:]
+            z = solve_banded((2, 2), full_band, w * y, check_finite=False)
+        w = p * (y > z) + (1-p) * (y < z)
+    if len(shape) > 1:
+        z = z.reshape((nchan, L)).T.reshape(shape)
+    return z
+
+
+def _als_sparse(y, lam, p, niter=10):
+    """ALS baseline, solving a generic sparse system at each iteration.
+
+    This is the original implementation. It builds D from a dense LxL
+    matrix, so it is only usable for relatively short arrays.
+    """
+    from scipy import sparse
+    from scipy.sparse import linalg
+    L = len(y)
+    D = sparse.csc_matrix(np.diff(np.eye(L), 2))
+    w = np.ones(L)
+    for _ in range(niter):
+        W = sparse.spdiags(w, 0, L, L)
+        Z = W + lam * D.dot(D.transpose())
+        z = linalg.spsolve(Z, w*y)
+        w = p * (y > z) + (1-p) * (y < z)
+    return z
+
+
+def _als(y, lam, p, niter=10, solver='banded'):
     """Baseline Correction with Asymmetric Least Squares Smoothing.
 
     Modifications to the routine from Eilers & Boelens 2005
@@ -318,7 +484,8 @@ def _als(y, lam, p, niter=10):
     Parameters
     ----------
     y : array-like
-        the data series corresponding to x
+        the data series corresponding to x. If two-dimensional, each column
+        is treated as an independent channel (samples x channels)
     lam : float
         the lambda parameter of the ALS method. This control how much the
         baseline can adapt to local changes. A higher value corresponds to a
@@ -332,22 +499,25 @@ def _als(y, lam, p, niter=10):
     ----------------
     niter : int
         The number of iterations to perform
+    solver : str
+        'banded' (default) uses a banded Cholesky solver, with O(L) memory
+        and time; 'sparse' uses the original generic sparse solver, with
+        O(L^2) memory
 
     Returns
     -------
     z : array-like, same size as y
         Fitted baseline.
     """
-    from scipy import sparse
-    L = len(y)
-    D = sparse.csc_matrix(np.diff(np.eye(L), 2))
-    w = np.ones(L)
-    for _ in range(niter):
-        W = sparse.spdiags(w, 0, L, L)
-        Z = W + lam * D.dot(D.transpose())
-        z = sparse.linalg.spsolve(Z, w*y)
-        w = p * (y > z) + (1-p) * (y < z)
-    return z
+    if solver == 'banded':
+        return _als_banded(y, lam, p, niter=niter)
+    elif solver == 'sparse':
+        y = np.asarray(y)
+        if len(y.shape) > 1:
+            return np.array([_als_sparse(yc, lam, p, niter=niter)
+                             for yc in y.T]).T
+        return _als_sparse(y, lam, p, niter=niter)
+    raise ValueError('Unknown ALS solver: {}'.format(solver))
 
 
 def baseline_als(x, y, lam=None, p=None, niter=10, return_baseline=False,
@@ -360,7 +530,8 @@ def baseline_als(x, y, lam=None, p=None, niter=10, return_baseline=False,
     x : array-like
         the sample time/number/position
     y : array-like
-        the data series corresponding to x
+        the data series corresponding to x. If two-dimensional (samples x
+        channels), the baselines of all channels are fitted together
     lam : float
         the lambda parameter of the ALS method. This control how much the
         baseline can adapt to local changes. A higher value corresponds to a
@@ -383,9 +554,9 @@ def baseline_als(x, y, lam=None, p=None, niter=10, return_baseline=False,
 
     Returns
     -------
-    y_subtracted : array-like, same size as y
+    y_subtracted : array-like, same shape as y
         The initial time series, subtracted from the trend
-    baseline : array-like, same size as y
+    baseline : array-like, same shape as y
         Fitted baseline. Only returned if return_baseline is True
     """
 
@@ -396,18 +567,22 @@ def baseline_als(x, y, lam=None, p=None, niter=10, return_baseline=False,
     if p is None:
         p = 0.001
 
-    y = purge_outliers(y, up=outlier_purging[0], down=outlier_purging[1])
+    multichannel = len(np.shape(y)) > 1
+    if multichannel:
+        y = np.array([purge_outliers(yc, up=outlier_purging[0],
+                                     down=outlier_purging[1])
+                      for yc in np.asarray(y).T]).T
+    else:
+        y = purge_outliers(y, up=outlier_purging[0], down=outlier_purging[1])
 
     z = _als(y, lam, p, niter=niter)
 
     ysub = y - z
     offset = 0
-    if offset_correction:
-        std = ref_std(ysub, np.max([len(y) // 20, 20]))
-
-        good = np.abs(ysub) < 10 * std
-
-        offset = offset_fit(x[good], ysub[good], 0)
+    if offset_correction and multichannel:
+        offset = np.array([_als_offset(x, ysubc) for ysubc in ysub.T])
+    elif offset_correction:
+        offset = _als_offset(x, ysub)
 
     if return_baseline:
         return ysub - offset, z + offset
@@ -415,6 +590,15 @@ def baseline_als(x, y, lam=None, p=None, niter=10, return_baseline=False,
         return ysub - offset
 
 
+def _als_offset(x, ysub):
+    """Residual offset of a baseline-subtracted series, excluding outliers."""
+    std = ref_std(ysub, np.max([len(ysub) // 20, 20]))
+
+    good = np.abs(ysub) < 10 * std
+
+    return offset_fit(x[good], ysub[good], 0)
+
+
 def fit_baseline_plus_bell(x, y, ye=None, kind='gauss'):
     """Fit a function composed of a linear baseline plus a bell function.
 
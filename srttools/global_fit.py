@@ -9,13 +9,14 @@ try:
     HAS_MPL = True
 except ImportError:
     HAS_MPL = False
+import os
 from .fit import contiguous_regions
 from .utils import jit, vectorize
 
 from .histograms import histogram2d
 import numpy as np
 
-__all__ = ["fit_full_image", "display_intermediate"]
+__all__ = ["GlobalFitter", "fit_full_image", "display_intermediate"]
 
 
 @vectorize('(float64(float64,float64,float64,float64))', nopython=True)
@@ -24,47 +25,30 @@ def _align_fast(x, scan, m, q):
     return scan - x * m - q
 
 
-XBUFFER = None
-YBUFFER = None
-
-
 def _get_coords(xedges, yedges):
     """Get coordinates given the edges of the histogram."""
-    global XBUFFER, YBUFFER
-    if XBUFFER is None:
-        xcenters = (xedges[:-1] + xedges[1:]) / 2
-        ycenters = (yedges[:-1] + yedges[1:]) / 2
-
-        X, Y = np.meshgrid(xcenters, ycenters)
-        XBUFFER = X
-        YBUFFER = Y
-    return XBUFFER, YBUFFER
+    xcenters = (xedges[:-1] + xedges[1:]) / 2
+    ycenters = (yedges[:-1] + yedges[1:]) / 2
 
-
-EXPOMAP = None
+    X, Y = np.meshgrid(xcenters, ycenters)
+    return X, Y
 
 
 def _calculate_image(x, y, counts, bx, by, nsamp):
     """Calculate the image."""
-    global EXPOMAP
-
-    if EXPOMAP is None:
-        EXPOMAP, xedges, yedges = histogram2d(x, y, bins=(bx, by),
-                                              weights=nsamp)
-
     histograms, xedges, yedges = \
         histogram2d(x, y, bins=(bx, by),
-                    weights=[counts * nsamp, (counts) ** 2 * nsamp])
+                    weights=[nsamp, counts * nsamp, (counts) ** 2 * nsamp])
 
-    img, img_var = histograms
+    expomap, img, img_var = histograms
     X, Y = _get_coords(xedges, yedges)
 
-    good = EXPOMAP > 0
+    good = expomap > 0
     mean = img.copy()
 
-    mean[good] /= EXPOMAP[good]
+    mean[good] /= expomap[good]
 
-    img_var[good] = img_var[good] / EXPOMAP[good] - mean[good] ** 2
+    img_var[good] = img_var[good] / expomap[good] - mean[good] ** 2
 
     return X, Y, mean.T, img_var.T
 
@@ -85,17 +69,6 @@ def _align_all(newd_t, newd_c, data_idx, par):
     return _align_fast(newd_t, newd_c, ms, qs)
 
 
-def counter(initial_value=0):
-    count = initial_value
-    while True:
-        yield count
-        count += 1
-
-
-ITERATION_COUNT = counter(0)
-CURR_CHANNEL = "Ch0"
-
-
 def _save_intermediate(filename, par):
     np.savetxt(filename, par)
 
@@ -104,48 +77,109 @@ def _get_saved_pars(filename):
     return np.genfromtxt(filename)
 
 
-def _save_iteration(par):
-    iteration = next(ITERATION_COUNT)
-    print(iteration, end="\r")
-    if iteration % 2 == 0:
-        _save_intermediate("out_iter_{}_{:03d}.txt".format(CURR_CHANNEL,
-                                                           iteration), par)
+def _pixel_indices(x, y, bx, by):
+    """Flattened pixel index of each sample, as binned by ``histogram2d``.
 
+    The index of pixel ``(ix, iy)`` is ``ix * ny + iy``, with ``ny`` the
+    number of pixels along y. As in ``histogram2d``, the rightmost edge is
+    included in the last pixel. All samples are assumed to be inside the
+    edges, as for the output of :func:`_resample_scans`: rounding errors
+    that put them just outside are corrected.
+    """
+    nx, ny = len(bx) - 1, len(by) - 1
+    ix = np.clip(np.searchsorted(bx, x, "right") - 1, 0, nx - 1)
+    iy = np.clip(np.searchsorted(by, y, "right") - 1, 0, ny - 1)
+    return ix * ny + iy
+
+
+def _pixel_binning(data, bx, by, excluded=None):
+    """Precalculate the pixel of each sample and the exposure map.
 
-def _obj_fun(par, data, data_idx, excluded, bx, by):
+    Returns the flattened pixel indices of the samples, the flattened
+    exposure map and the mask of the pixels to be used in the fit (i.e.
+    outside of the excluded regions).
     """
-    This is the function we have to minimize.
+    _, _, newd_x, newd_y, _, newd_e = data
+    npix = (len(bx) - 1) * (len(by) - 1)
+    pix = _pixel_indices(newd_x, newd_y, bx, by)
+    expo = np.bincount(pix, weights=newd_e, minlength=npix)
+
+    allowed = np.ones(npix, dtype=bool)
+    if excluded is not None:
+        xcenters = (bx[:-1] + bx[1:]) / 2
+        ycenters = (by[:-1] + by[1:]) / 2
+        X, Y = np.meshgrid(xcenters, ycenters, indexing='ij')
+        for e in excluded:
+            centerx, centery, radius = e
+            filt = (X - centerx) ** 2 + (Y - centery) ** 2 < radius ** 2
+            allowed[filt.flatten()] = False
+
+    return pix, expo, allowed
+
+
+def _obj_fun_and_grad(par, data, data_idx, pix, expo, allowed):
+    """
+    This is the function we have to minimize, together with its gradient.
+
+    The objective is the sum of the variances in the good pixels of the image
+    plus the variance of the image in the good pixels, times their number.
 
     Parameters
     ----------
     par : array([m0, q0, m1, q1, ...])
         linear baseline parameters for the image.
-    data : [times, idxs, x, y, counts]
-        All five quantities are ``numpy`` ``array``s; ``time`` is time
-        from the start of the scan; ``x``, ``y`` are the image coordinates,
-        ``idx`` corresponds to the scan number and `counts` to the scan
-        values at those coordinates.
-    excluded : [[centerx0, centery0, radius0]]
-        list of circular regions to exclude from fitting (e.g. strong sources
-        that might alter the total rms)
-
+    data : [times, idxs, x, y, counts, nsamp]
+        The resampled data, as returned by :func:`_resample_scans`
+    data_idx : array
+        The start and end index of each scan in the data arrays
+    pix, expo, allowed : arrays
+        The pixel of each sample, the exposure and the mask of the pixels
+        outside the excluded regions, as returned by :func:`_pixel_binning`.
+        They do not depend on the parameters.
+
+    Calling :math:`c_k` the aligned counts of the resampled data, with
+    exposure :math:`e_k`, falling in pixel :math:`p` with exposure
+    :math:`E_p`, and :math:`M` the mean of the good pixels in the image, the
+    derivative of the objective function with respect to :math:`c_k` is
+    :math:`2 e_k (c_k - M) / E_p` (zero outside the good pixels). The
+    derivatives with respect to the slope and the offset of each scan are
+    sums over the samples of that scan, weighted respectively by
+    :math:`-t_k` and :math:`-1`.
     """
-
-    newd_t, _, newd_x, newd_y, newd_c, newd_e = data
+    newd_t, newd_i, _, _, newd_c, newd_e = data
 
     newd_c_new = _align_all(newd_t, newd_c, data_idx, par)
-    X, Y, img, img_var = _calculate_image(newd_x, newd_y, newd_c_new, bx, by,
-                                          newd_e)
 
-    good = img != 0.
-    if excluded is not None:
-        for e in excluded:
-            centerx, centery, radius = e
-            filt = (X - centerx) ** 2 + (Y - centery) ** 2 < radius ** 2
-            good[filt] = 0
+    npix = expo.size
+    img = np.bincount(pix, weights=newd_c_new * newd_e, minlength=npix)
+    img_sq = np.bincount(pix, weights=newd_c_new ** 2 * newd_e,
+                         minlength=npix)
+
+    has_expo = expo > 0
+    mean = np.zeros(npix)
+    mean[has_expo] = img[has_expo] / expo[has_expo]
+    img_var = np.zeros(npix)
+    img_var[has_expo] = img_sq[has_expo] / expo[has_expo] - \
+        mean[has_expo] ** 2
 
-    stat = np.sum(img_var[good]) + np.var(img[good]) * img[good].size
-    return stat
+    good = (mean != 0.) & allowed
+    grad = np.zeros(len(par))
+    if not np.any(good):
+        return 0., grad
+
+    mean_good = np.mean(mean[good])
+    stat = np.sum(img_var[good]) + np.var(mean[good]) * mean[good].size
+
+    pix_weight = np.zeros(npix)
+    pix_weight[good] = 2 / expo[good]
+    dstat_dc = newd_e * pix_weight[pix] * (newd_c_new - mean_good)
+
+    nscans = len(par) // 2
+    grad[::2] = -np.bincount(newd_i, weights=dstat_dc * newd_t,
+                             minlength=nscans)[:nscans]
+    grad[1::2] = -np.bincount(newd_i, weights=dstat_dc,
+                              minlength=nscans)[:nscans]
+    return stat, grad
 
 
 def _resample_scans(data):
@@ -218,7 +252,147 @@ def _get_data_idx(par, idx):
     return data_idx
 
 
-def fit_full_image(scanset, chan="Ch0", feed=0, excluded=None, par=None):
+class GlobalFitter(object):
+    """Fit linear trends to the scans of an image to minimize its scatter.
+
+    All the quantities that do not depend on the fit parameters (resampled
+    data, binning and exposure) are calculated at initialization and kept in
+    the object, so that different fitters can be used at the same time (e.g.
+    for different channels, in different processes).
+
+    Parameters
+    ----------
+    x : array-like
+        The pixel coordinates of the samples along the x axis
+    y : array-like
+        The pixel coordinates of the samples along the y axis
+    counts : array-like
+        The values of the samples
+    times : array-like
+        The times of the samples
+    scan_ids : array-like
+        The index of the scan containing each sample
+
+    Other parameters
+    ----------------
+    excluded : [[centerx0, centery0, radius0]]
+        List of circular regions to exclude from fitting (e.g. strong sources
+        that might alter the total rms)
+    chan : str
+        Name of the channel. Used in the names of the files containing the
+        intermediate parameters
+    outdir : str
+        Directory where the intermediate parameters are saved. Defaults to
+        the current directory
+    """
+    def __init__(self, x, y, counts, times, scan_ids, excluded=None,
+                 chan="Ch0", outdir=None):
+        self.chan = chan
+        if outdir is None:
+            outdir = os.curdir
+        self.outdir = outdir
+
+        counts = np.array(counts, dtype=np.float64)
+        self.count_range = np.max(counts) - np.min(counts)
+        self.counts = counts / self.count_range
+
+        self.idxs = np.array(scan_ids, dtype=int)
+        self.nscans = len(list(set(self.idxs)))
+
+        # Times from the start of each scan
+        times = np.array(times, dtype=np.float64)
+        times -= times[0]
+        for i_p in range(self.nscans):
+            good = self.idxs == i_p
+            filt_t = times[good]
+            if len(filt_t) == 0:
+                continue
+            times[good] = filt_t - filt_t[0]
+        self.times = times
+
+        self.data, self.bx, self.by = \
+            _resample_scans([self.times, self.idxs,
+                             np.array(x, dtype=np.float64),
+                             np.array(y, dtype=np.float64), self.counts])
+        self.pix, self.expo, self.allowed = \
+            _pixel_binning(self.data, self.bx, self.by, excluded)
+        self.iteration = 0
+
+    @classmethod
+    def from_scanset(cls, scanset, chan="Ch0", feed=0, **kwargs):
+        """Create a fitter for a channel and feed of a scanset.
+
+        Additional arguments are passed to the initializer.
+        """
+        coords = scanset.coordinates(feed)
+        return cls(coords['x'], coords['y'], scanset[chan],
+                   scanset['time'], scanset['Scan_id'], chan=chan, **kwargs)
+
+    def _save_iteration(self, par):
+        iteration = self.iteration
+        self.iteration += 1
+        print(iteration, end="\r")
+        if iteration % 2 == 0:
+            fname = "out_iter_{}_{:03d}.txt".format(self.chan, iteration)
+            _save_intermediate(os.path.join(self.outdir, fname),
+                               par * self.count_range)
+
+    def fit(self, par=None, method="L-BFGS-B"):
+        """Fit the linear trends.
+
+        Parameters
+        ----------
+        par : [m0, q0, m1, q1, ...] or None
+            Initial slopes of the linear trends. The intercepts are
+            initialized to the first value of each scan
+        method : str
+            Minimization method, passed to ``scipy.optimize.minimize``. The
+            analytic gradient of the objective function is used, unless
+            ``method`` is ``"SLSQP"``, that estimates it with finite
+            differences (much slower for maps with many scans)
+
+        Returns
+        -------
+        new_counts : array-like
+            The counts, with the linear trends subtracted from each scan
+        """
+        from scipy.optimize import minimize
+
+        if par is None:
+            par = np.zeros(self.nscans * 2)
+        par = np.array(par, dtype=np.float64)
+
+        data_idx = _get_data_idx(par, self.idxs)
+
+        for i_p in range(len(par) // 2):
+            good = self.idxs == i_p
+            if not np.any(good):
+                continue
+            par[i_p * 2 + 1] = self.counts[good][0]
+
+        data_idx_resamp = _get_data_idx(par, self.data[1])
+        args = (self.data, data_idx_resamp, self.pix, self.expo,
+                self.allowed)
+
+        self.iteration = 0
+        if method == "SLSQP":
+            def _obj_fun(par):
+                return _obj_fun_and_grad(par, *args)[0]
+
+            res = minimize(_obj_fun, par, method="SLSQP",
+                           callback=self._save_iteration)
+        else:
+            res = minimize(_obj_fun_and_grad, par, args=args,
+                           method=method, jac=True,
+                           callback=self._save_iteration)
+
+        new_counts = _align_all(self.times, self.counts, data_idx, res.x)
+
+        return new_counts * self.count_range
+
+
+def fit_full_image(scanset, chan="Ch0", feed=0, excluded=None, par=None,
+                   method="L-BFGS-B", outdir=None):
     """Get a clean image by subtracting linear trends from the initial scans.
 
     Parameters
@@ -238,6 +412,11 @@ def fit_full_image(scanset, chan="Ch0", feed=0, excluded=None, par=None):
     par : [m0, q0, m1, q1, ...] or None
         Initial parameters -- slope and intercept for linear trends to be
         subtracted from the scans
+    method : str
+        Minimization method. See :func:`GlobalFitter.fit`
+    outdir : str
+        Directory where the intermediate parameters are saved. Defaults to
+        the current directory
 
     Returns
     -------
@@ -245,60 +424,9 @@ def fit_full_image(scanset, chan="Ch0", feed=0, excluded=None, par=None):
         The new Counts column for scanset, where a baseline has been subtracted
         from each scan to produce the cleanest image background.
     """
-    from scipy.optimize import minimize
-    global EXPOMAP, XBUFFER, YBUFFER, ITERATION_COUNT, CURR_CHANNEL
-    CURR_CHANNEL = chan
-    EXPOMAP = None
-    XBUFFER = None
-    YBUFFER = None
-
-    X = np.array(scanset['x'][:, feed], dtype=np.float64)
-    Y = np.array(scanset['y'][:, feed], dtype=np.float64)
-    counts = np.array(scanset[chan], dtype=np.float64)
-
-    count_range = np.max(counts) - np.min(counts)
-
-    counts /= count_range
-
-    times = np.array(scanset['time'], dtype=np.float64)
-    times -= times[0]
-
-    idxs = np.array(scanset['Scan_id'], dtype=int)
-
-    if par is None:
-        par = np.zeros(len(list(set(idxs))) * 2)
-
-    data_idx = _get_data_idx(par, idxs)
-
-    par_pairs = list(zip(par[:-1:2], par[1::2]))
-    for i_p in range(len(par_pairs)):
-        good = idxs == i_p
-        filt_t = times[good]
-        if len(filt_t) == 0:
-            continue
-        filt_t -= filt_t[0]
-        times[good] = filt_t
-        par[i_p * 2 + 1] = counts[good][0]
-
-    data_to_fit = [np.array(times, dtype=np.float64), idxs, X, Y,
-                   np.array(counts, dtype=np.float64)]
-
-    data, bx, by = _resample_scans(data_to_fit)
-
-    _, i, _, _, _, _ = data
-
-    data_idx_resamp = _get_data_idx(par, i)
-
-    def _callback(x): return _save_iteration(x * count_range)
-
-    res = minimize(_obj_fun, par,
-                   args=(data, data_idx_resamp, excluded, bx, by),
-                   method="SLSQP", callback=_callback)
-
-    new_counts = _align_all(times, counts, data_idx, res.x)
-
-    ITERATION_COUNT = counter(0)
-    return new_counts * count_range
+    fitter = GlobalFitter.from_scanset(scanset, chan=chan, feed=feed,
+                                       excluded=excluded, outdir=outdir)
+    return fitter.fit(par=par, method=method)
 
 
 def display_intermediate(scanset, chan="Ch0", feed=0, excluded=None,
@@ -325,8 +453,9 @@ def display_intermediate(scanset, chan="Ch0", feed=0, excluded=None,
     """
     if not HAS_MPL:
         raise ImportError('display_intermediate: matplotlib is not installed')
-    X = np.array(scanset['x'][:, feed], dtype=np.float64)
-    Y = np.array(scanset['y'][:, feed], dtype=np.float64)
+    coords = scanset.coordinates(feed)
+    X = np.array(coords['x'], dtype=np.float64)
+    Y = np.array(coords['y'], dtype=np.float64)
     counts = np.array(scanset[chan], dtype=np.float64) * factor
 
     times = np.array(scanset['time'], dtype=np.float64)
@@ -10,15 +10,18 @@ from __future__ import (absolute_import, division,
 import numpy as np
 import astropy
 from astropy import wcs
-from astropy.table import Table, vstack, Column
+from astropy.table import Table, Column, MaskedColumn
+from astropy.utils.metadata import merge
 import astropy.io.fits as fits
 import astropy.units as u
+import os
 import sys
 import warnings
 import logging
 import traceback
 import six
 import functools
+from collections import OrderedDict
 from .scan import Scan, chan_re, list_scans
 from .read_config import read_config, sample_config_file
 
@@ -30,14 +33,22 @@ except ImportError:
     HAS_MPL = False
 
 from .fit import linear_fun
+from .utils import parallel_imap
+from .io import BackgroundWriter, write_hdf5_table, storage_options
+from .io import restore_precision, feed_column
 from .interactive_filter import select_data
 from .calibration import CalibratorTable
+from .accumulator import ImageAccumulator
+from .archive import ScanArchive, is_archive
+from .transforms import source_altaz, utc_to_tdb
+from .diagnostics import diagnostics_enabled, diagnostic_plot, plot_lines
+from .diagnostics import set_diagnostics_level
 
-from .global_fit import fit_full_image
+from .global_fit import GlobalFitter
 from .interactive_filter import create_empty_info
 
 
-__all__ = ["ScanSet"]
+__all__ = ["ScanSet", "ObservationFollower"]
 
 
 def _load_calibration(calibration, map_unit):
@@ -54,9 +65,196 @@ def _load_calibration(calibration, map_unit):
     return caltable, conversion_units
 
 
+def _load_scan_or_warn(fname, **kwargs):
+    """Load a scan, logging errors instead of raising them.
+
+    Returns None if the scan could not be loaded.
+    """
+    try:
+        return Scan(fname, **kwargs)
+    except KeyError as e:
+        logging.warning(
+            "Error while processing {}: Missing key: {}".format(fname,
+                                                                str(e))
+        )
+    except Exception as e:
+        logging.warning(traceback.format_exc())
+        logging.warning("Error while processing {}: {}".format(fname,
+                                                               str(e)))
+    return None
+
+
+def _preprocess_scan(fname, **kwargs):
+    """Process and save a single scan, without returning it."""
+    Scan(fname, **kwargs)
+
+
+def _prepare_scan(s, scan_id):
+    """Add the columns needed by the scanset to a scan.
+
+    Returns None if the scan is flagged.
+    """
+    if 'FLAG' in s.meta.keys() and s.meta['FLAG']:
+        return None
+    s['Scan_id'] = scan_id + np.zeros(len(s['time']), dtype=np.long)
+
+    coords = s.coordinates(0)
+    ras = coords['ra']
+    decs = coords['dec']
+
+    ravar = (np.max(ras) - np.min(ras)) / np.cos(np.mean(decs))
+    decvar = np.max(decs) - np.min(decs)
+    s['direction'] = np.array(ravar > decvar, dtype=bool)
+
+    del s.meta['filename']
+    del s.meta['calibrator_directories']
+    del s.meta['list_of_directories']
+    return s
+
+
+class _TableBuilder(object):
+    """Concatenate tables into preallocated, contiguous columns.
+
+    This replaces ``vstack``, which needs all the input tables and their
+    concatenation in memory at the same time. Here, each table is copied
+    into the output columns as soon as it is appended, and can be released
+    immediately afterwards. Columns are allocated for ``nrows`` rows if
+    the total length is known, otherwise for ``ntables`` times the length
+    of the first table, and grown if needed.
+
+    As in ``vstack``, columns missing from some of the tables are masked,
+    and metadata are merged (later tables take precedence).
+
+    Other Parameters
+    ----------------
+    nrows : int
+        The total number of rows, if known in advance
+    ntables : int
+        The expected number of tables, used if ``nrows`` is None
+
+    Examples
+    --------
+    >>> builder = _TableBuilder(ntables=2)
+    >>> builder.append(Table({'a': [1, 2]}))
+    >>> builder.append(Table({'a': [3], 'b': [1.]}))
+    >>> table = builder.table()
+    >>> list(table['a'])
+    [1, 2, 3]
+    >>> list(table['b'].mask)
+    [True, True, False]
+    """
+    def __init__(self, nrows=None, ntables=1):
+        self.nrows = nrows
+        self.ntables = ntables
+        self.capacity = None
+        self.length = 0
+        self.data = OrderedDict()
+        self.masks = {}
+        self.info = {}
+        self.meta = OrderedDict()
+        # True if tables sharing the buffers were returned by table()
+        self._shared = False
+
+    def _resize(self, capacity):
+        for arrays in [self.data, self.masks]:
+            for name, arr in list(arrays.items()):
+                shape = (capacity,) + arr.shape[1:]
+                if not self._shared:
+                    arr.resize(shape, refcheck=False)
+                    continue
+                # Do not reallocate buffers used by existing tables
+                nrows = min(capacity, self.length)
+                arrays[name] = np.zeros(shape, dtype=arr.dtype)
+                arrays[name][:nrows] = arr[:nrows]
+        self._shared = False
+        self.capacity = capacity
+
+    def _mask(self, name):
+        if name not in self.masks:
+            self.masks[name] = np.zeros(self.data[name].shape, dtype=bool)
+            self.masks[name][:self.length] = \
+                self.info[name].get('missing', False)
+        return self.masks[name]
+
+    def append(self, table):
+        """Copy a table at the end of the output columns."""
+        n = len(table)
+        if self.capacity is None:
+            self.capacity = self.nrows
+            if self.capacity is None:
+                self.capacity = n * self.ntables
+        if self.length + n > self.capacity:
+            self._resize(max(self.length + n, int(self.capacity * 1.5)))
+
+        rows = slice(self.length, self.length + n)
+        for name in table.colnames:
+            col = table[name]
+            data = np.ma.getdata(col)
+            if name not in self.data:
+                self.data[name] = \
+                    np.zeros((self.capacity,) + data.shape[1:],
+                             dtype=data.dtype)
+                self.info[name] = dict(unit=col.unit, meta=col.meta,
+                                       description=col.description,
+                                       missing=self.length > 0)
+                if self.length > 0:
+                    self._mask(name)
+            arr = self.data[name]
+            dtype = np.promote_types(arr.dtype, data.dtype)
+            if dtype != arr.dtype:
+                self.data[name] = arr = arr.astype(dtype)
+            arr[rows] = data
+            mask = np.ma.getmask(col)
+            if np.any(mask):
+                self._mask(name)[rows] = mask
+
+        for name in self.data:
+            if name not in table.colnames:
+                self._mask(name)[rows] = True
+
+        self.meta = merge(self.meta, table.meta, metadata_conflicts='silent')
+        self.length += n
+
+    def table(self, trim=True):
+        """Return the concatenated table, without copying the data.
+
+        Other Parameters
+        ----------------
+        trim : bool
+            If True, the buffers are shrunk to the rows appended so far.
+            Otherwise, the table uses the first rows of the buffers, and
+            their remaining capacity is used by the following appends, so
+            that the builder can keep growing.
+        """
+        if trim and self.capacity is not None and \
+                self.capacity != self.length:
+            self._resize(self.length)
+        self._shared = True
+        columns = []
+        for name, arr in self.data.items():
+            info = self.info[name]
+            mask = self.masks.get(name)
+            if mask is None:
+                mask = False
+            else:
+                mask = mask[:self.length]
+            columns.append(MaskedColumn(arr[:self.length], name=name,
+                                        mask=mask,
+                                        unit=info['unit'],
+                                        description=info['description'],
+                                        meta=info['meta']))
+        return Table(columns, meta=self.meta, masked=True, copy=False)
+
+
+def _fit_channel(fitter, **kwargs):
+    """Run a global fit, returning the new counts."""
+    return fitter.fit(**kwargs)
+
+
 class ScanSet(Table):
     def __init__(self, data=None, norefilt=True, config_file=None,
-                 freqsplat=None, nofilt=False, nosub=False, **kwargs):
+                 freqsplat=None, nofilt=False, nosub=False, nproc=1,
+                 **kwargs):
         """Class obtained by a set of scans.
 
         Once the scans are loaded, this class contains all functionality that
@@ -81,6 +279,8 @@ class ScanSet(Table):
             See :class:`srttools.scan.clean_scan_using_variability`
         nosub : bool
             See :class:`srttools.scan.Scan`
+        nproc : int
+            Number of processes used to load the scans in parallel. Default 1
 
         Other Parameters
         ----------------
@@ -99,8 +299,12 @@ class ScanSet(Table):
         self.norefilt = norefilt
         self.freqsplat = freqsplat
 
-        if isinstance(data, six.string_types) and data.endswith('hdf5'):
-            data = Table.read(data, path='scanset')
+        if isinstance(data, six.string_types) and is_archive(data):
+            data = ScanSet.from_archive(data, config_file=config_file)
+            self.scan_list = data.scan_list
+            kwargs['copy'] = False
+        elif isinstance(data, six.string_types) and data.endswith('hdf5'):
+            data = restore_precision(Table.read(data, path='scanset'))
 
             txtfile = data.meta['scan_list_file']
 
@@ -128,31 +332,20 @@ class ScanSet(Table):
 
             scan_list.sort()
 
-            tables = []
+            builder = _TableBuilder(ntables=len(scan_list))
 
             for i_s, s in self.load_scans(scan_list,
                                           freqsplat=freqsplat, nofilt=nofilt,
-                                          nosub=nosub, **kwargs):
+                                          nosub=nosub, nproc=nproc, **kwargs):
 
-                if 'FLAG' in s.meta.keys() and s.meta['FLAG']:
-                    continue
-                s['Scan_id'] = i_s + np.zeros(len(s['time']), dtype=np.long)
-
-                ras = s['ra'][:, 0]
-                decs = s['dec'][:, 0]
-
-                ravar = (np.max(ras) - np.min(ras)) / np.cos(np.mean(decs))
-                decvar = np.max(decs) - np.min(decs)
-                s['direction'] = np.array(ravar > decvar, dtype=bool)
+                s = _prepare_scan(s, i_s)
+                if s is not None:
+                    builder.append(s)
 
-                del s.meta['filename']
-                del s.meta['calibrator_directories']
-                del s.meta['list_of_directories']
-                tables.append(s)
+            if builder.length == 0:
+                raise ValueError("No valid scans found")
 
-            scan_table = Table(vstack(tables))
-
-            Table.__init__(self, scan_table)
+            Table.__init__(self, builder.table(), copy=False)
             self.scan_list = scan_list
 
             self.meta['scan_list_file'] = None
@@ -164,6 +357,7 @@ class ScanSet(Table):
         self.chan_columns = np.array([i for i in self.columns
                                       if chan_re.match(i)])
         self.current = None
+        self.accumulator = None
 
     def analyze_coordinates(self, altaz=False):
         """Save statistical information on coordinates."""
@@ -200,24 +394,44 @@ class ScanSet(Table):
             dirlist = self.meta['list_of_directories']
         return list_scans(datadir, dirlist)
 
-    def load_scans(self, scan_list, freqsplat=None, nofilt=False, **kwargs):
-        """Load the scans in the list one by ones."""
+    def load_scans(self, scan_list, freqsplat=None, nofilt=False, nproc=1,
+                   **kwargs):
+        """Load the scans in the list one by one.
+
+        With ``nproc > 1``, scans are processed in a pool of processes. In
+        both cases they are yielded in the same order as ``scan_list``,
+        together with their index in the list. Scans that cannot be loaded
+        are skipped with a warning.
+        """
+        if nproc is not None and nproc > 1 and kwargs.get('interactive'):
+            warnings.warn("Interactive filtering is not compatible with "
+                          "parallel loading. Using one process.")
+            nproc = 1
+
+        if 'config_file' not in kwargs and 'config_file' in self.meta:
+            kwargs['config_file'] = self.meta['config_file']
+
+        # In a single process, processed scans are saved in the background
+        # while the next one is processed. Errors in writing are raised at
+        # the end.
+        writer = None
+        if (nproc is None or nproc <= 1) and kwargs.get('writer') is None:
+            writer = kwargs['writer'] = BackgroundWriter()
+
+        load = functools.partial(_load_scan_or_warn, norefilt=self.norefilt,
+                                 freqsplat=freqsplat, nofilt=nofilt, **kwargs)
+
         nscan = len(scan_list)
-        for i, f in enumerate(scan_list):
-            print("{}/{}".format(i + 1, nscan), end="\r")
-            try:
-                s = Scan(f, norefilt=self.norefilt, freqsplat=freqsplat,
-                         nofilt=nofilt, **kwargs)
+        try:
+            for i, s in enumerate(parallel_imap(load, scan_list,
+                                                nproc=nproc)):
+                print("{}/{}".format(i + 1, nscan), end="\r")
+                if s is None:
+                    continue
                 yield i, s
-            except KeyError as e:
-                logging.warning(
-                    "Error while processing {}: Missing key: {}".format(f,
-                                                                        str(e))
-                )
-            except Exception as e:
-                logging.warning(traceback.format_exc())
-                logging.warning("Error while processing {}: {}".format(f,
-                                                                       str(e)))
+        finally:
+            if writer is not None:
+                writer.close()
 
     def get_coordinates(self, altaz=False):
         """Give the coordinates as pairs of RA, DEC."""
@@ -228,6 +442,23 @@ class ScanSet(Table):
             return np.array(np.dstack([self['ra'],
                                        self['dec']]))
 
+    def coordinates(self, feed):
+        """Return a dictionary with the coordinates of a feed.
+
+        It contains the ``ra``, ``dec``, ``az``, ``el`` and, if calculated,
+        the ``x``, ``y``, ``delta_az``, ``delta_el`` of the feed. Only the
+        coordinates of feed 0 and of the feeds used by the channels are
+        available (see :func:`srttools.io.feed_column`).
+        """
+        column = feed_column(self, feed)
+        if column is None:
+            raise ValueError('The coordinates of feed {} are not '
+                             'available'.format(feed))
+        return dict([(coord, np.asarray(self[coord][:, column]))
+                     for coord in ['ra', 'dec', 'az', 'el', 'x', 'y',
+                                   'delta_az', 'delta_el']
+                     if coord in self.colnames])
+
     def get_obstimes(self):
         """Get `astropy.Time` object for time at the telescope location."""
         from astropy.time import Time
@@ -259,44 +490,37 @@ class ScanSet(Table):
             self[out_column] = retval
         return retval
 
-    def calculate_delta_altaz(self):
+    def calculate_delta_altaz(self, start=0):
         """Construction of delta altaz coordinates.
 
         Calculate the delta of altazimutal coordinates wrt the position
-        of the source
+        of the source. Only the rows from ``start`` on are calculated.
         """
-        from astropy.coordinates import SkyCoord
-
-        from .io import locations
-
-        ref_coords = SkyCoord(ra=self.meta['reference_ra'],
-                              dec=self.meta['reference_dec'],
-                              obstime=self.get_obstimes(),
-                              location=locations[self.meta['site']])
-        ref_altaz_coords = ref_coords.altaz
-        ref_az = ref_altaz_coords.az.to(u.rad)
-        ref_el = ref_altaz_coords.alt.to(u.rad)
+        ref_az, ref_el = source_altaz(self.meta['reference_ra'],
+                                      self.meta['reference_dec'],
+                                      self['time'][start:], self.meta['site'])
+        ref_az = ref_az * u.rad
+        ref_el = ref_el * u.rad
 
         self.meta['reference_delta_az'] = 0*u.rad
         self.meta['reference_delta_el'] = 0*u.rad
-        self['delta_az'] = np.zeros_like(self['az'])
-        self['delta_el'] = np.zeros_like(self['el'])
-        for f in range(len(self['el'][0, :])):
-            self['delta_az'][:, f] = \
-                (self['az'][:, f] - ref_az) * np.cos(ref_el)
-            self['delta_el'][:, f] = self['el'][:, f] - ref_el
-
-        if HAS_MPL:
-            fig1 = plt.figure("adsfasdfasd")
-            plt.plot(self['delta_az'], self['delta_el'])
-            plt.savefig('delta_altaz.png')
-            plt.close(fig1)
-
-            fig2 = plt.figure("adsfasdf")
-            plt.plot(self['az'], self['el'])
-            plt.plot(ref_az, ref_el)
-            plt.savefig('altaz_with_src.png')
-            plt.close(fig2)
+        if 'delta_az' not in self.colnames:
+            self['delta_az'] = np.zeros_like(self['az'])
+            self['delta_el'] = np.zeros_like(self['el'])
+        # All the coordinate columns are calculated at once
+        column_az = ref_az[:, np.newaxis]
+        column_el = ref_el[:, np.newaxis]
+        self['delta_az'][start:] = \
+            (self['az'][start:] - column_az) * np.cos(column_el)
+        self['delta_el'][start:] = self['el'][start:] - column_el
+
+        if diagnostics_enabled('summary'):
+            diagnostic_plot('summary', 'delta_altaz.png', plot_lines,
+                            np.asarray(self['delta_az']),
+                            np.asarray(self['delta_el']))
+            diagnostic_plot('summary', 'altaz_with_src.png', plot_lines,
+                            np.asarray(self['az']), np.asarray(self['el']),
+                            ref_az.value, ref_el.value)
 
     def create_wcs(self, altaz=False):
         """Create a wcs object from the pointing information."""
@@ -352,123 +576,201 @@ class ScanSet(Table):
 
         self['x'] = np.zeros_like(self[hor])
         self['y'] = np.zeros_like(self[ver])
-        coords = np.degrees(self.get_coordinates(altaz=altaz))
-        for f in range(len(self[hor][0, :])):
-            pixcrd = self.wcs.wcs_world2pix(coords[:, f], 0)
-
-            self['x'][:, f] = pixcrd[:, 0]
-            self['y'][:, f] = pixcrd[:, 1]
+        self._world_to_pixel(altaz)
         self['x'].meta['altaz'] = altaz
         self['y'].meta['altaz'] = altaz
-
-    def calculate_images(self, no_offsets=False, altaz=False,
-                         calibration=None, elevation=None, map_unit="Jy/beam",
-                         calibrate_scans=False, direction=None):
-        """Obtain image from all scans.
-
-        no_offsets:      use positions from feed 0 for all feeds.
-        direction:       0 if horizontal, 1 if vertical
+        # Pixel coordinates changed: the accumulated sums are not valid
+        self.accumulator = None
+
+    def _channel_feed(self, ch, no_offsets=False):
+        """Feed whose coordinates are used to image a channel."""
+        feeds = self[ch+'_feed']
+        allfeeds = list(set(feeds))
+        if not len(allfeeds) == 1:
+            raise ValueError('Feeds are mixed up in channels')
+        if no_offsets:
+            return 0
+        return feeds[0]
+
+    def _accumulate_channel(self, ch, rows=None, counts=None, rel_err=None,
+                            remove=False):
+        """Add the samples of a channel to the accumulator, or remove them.
+
+        Only the samples in ``rows`` (default: all; a boolean mask or a
+        slice) that pass the channel filter are used. The samples are split
+        by scanning direction. If ``rel_err`` (the relative calibration
+        error of each sample) is given, its sum over the same samples is
+        kept in ``accumulator.meta['cal_rel_err']``.
         """
-        if altaz != self['x'].meta['altaz']:
-            self.convert_coordinates(altaz)
-
-        images = {}
-
-        xbins = np.linspace(0,
-                            self.meta['npix'][0],
-                            self.meta['npix'][0] + 1)
-        ybins = np.linspace(0,
-                            self.meta['npix'][1],
-                            self.meta['npix'][1] + 1)
+        acc = self.accumulator
+        feed = acc.meta['feeds'][ch]
+        if rows is None:
+            rows = slice(None)
+
+        if counts is None:
+            counts = np.asarray(self[ch])
+        counts = counts[rows]
+        good = np.ones(len(counts), dtype=bool)
+        if '{}-filt'.format(ch) in self.colnames:
+            good &= np.asarray(self['{}-filt'.format(ch)], dtype=bool)[rows]
+
+        if 'direction' in self.colnames:
+            horizontal = np.asarray(self['direction'], dtype=bool)[rows]
+        else:
+            horizontal = np.ones(len(counts), dtype=bool)
+
+        coords = self.coordinates(feed)
+        x = coords['x'][rows]
+        y = coords['y'][rows]
+        if rel_err is not None:
+            rel_err = np.asarray(rel_err)[rows]
+
+        update = acc.remove if remove else acc.add
+        sign = -1 if remove else 1
+        for direction, in_dir in enumerate([horizontal,
+                                            np.logical_not(horizontal)]):
+            sel = good & in_dir
+            update(ch, x[sel], y[sel], counts[sel], direction=direction)
+            if rel_err is None:
+                continue
+            sums = acc.meta['cal_rel_err'].setdefault((ch, direction),
+                                                      [0., 0])
+            sums[0] += sign * np.sum(rel_err[sel])
+            sums[1] += sign * np.count_nonzero(sel)
+
+    def accumulate_images(self, no_offsets=False, calibration=None,
+                          map_unit="Jy/beam", calibrate_scans=False):
+        """Accumulate the sums needed to produce the images of all channels.
+
+        The result is stored in the ``accumulator`` attribute, an
+        :class:`srttools.accumulator.ImageAccumulator`. Images for any
+        scanning direction can then be obtained without going through the
+        data again, and single scans can be updated in place (see
+        :func:`update_scan`).
+        """
+        self.accumulator = ImageAccumulator(self.meta['npix'])
+        acc_meta = self.accumulator.meta
+        acc_meta['feeds'] = {}
+        acc_meta['cal_rel_err'] = {}
+        acc_meta['calibrated'] = calibration is not None and calibrate_scans
+
+        if acc_meta['calibrated']:
+            caltable, conversion_units = _load_calibration(calibration,
+                                                           map_unit)
+            area_conversion, final_unit = \
+                self._calculate_calibration_factors(map_unit)
 
         for ch in self.chan_columns:
-            feeds = self[ch+'_feed']
-            allfeeds = list(set(feeds))
-            if not len(allfeeds) == 1:
-                raise ValueError('Feeds are mixed up in channels')
-            if no_offsets:
-                feed = 0
-            else:
-                feed = feeds[0]
-
-            if elevation is None:
-                elevation = np.mean(self['el'][:, feed])
-
-            if '{}-filt'.format(ch) in self.keys():
-                good = self['{}-filt'.format(ch)]
-            else:
-                good = np.ones(len(self[ch]), dtype=bool)
-
-            if direction == 0:
-                good = good & self['direction']
-            elif direction == 1:
-                good = good & np.logical_not(self['direction'])
-
-            expomap, _, _ = np.histogram2d(self['x'][:, feed][good],
-                                           self['y'][:, feed][good],
-                                           bins=[xbins, ybins])
-
-            counts = np.array(self[ch][good])
-
-            if calibration is not None and calibrate_scans:
-                caltable, conversion_units = _load_calibration(calibration,
-                                                               map_unit)
-                area_conversion, final_unit = \
-                    self._calculate_calibration_factors(map_unit)
-
+            feed = self._channel_feed(ch, no_offsets)
+            acc_meta['feeds'][ch] = feed
+            elevation = self.coordinates(feed)['el']
+            if 'elevation' not in acc_meta:
+                acc_meta['elevation'] = np.mean(elevation)
+
+            counts = rel_err = None
+            if acc_meta['calibrated']:
                 Jy_over_counts, Jy_over_counts_err = conversion_units * \
                     caltable.Jy_over_counts(channel=ch, map_unit=map_unit,
-                                            elevation=self['el'][:, feed][good]
-                                            )
+                                            elevation=elevation)
 
-                counts = counts * u.ct * area_conversion * Jy_over_counts
+                counts = np.array(self[ch]) * u.ct * area_conversion * \
+                    Jy_over_counts
                 counts = counts.to(final_unit).value
-
-            img, _, _ = np.histogram2d(self['x'][:, feed][good],
-                                       self['y'][:, feed][good],
-                                       bins=[xbins, ybins],
-                                       weights=counts)
-            img_sq, _, _ = np.histogram2d(self['x'][:, feed][good],
-                                          self['y'][:, feed][good],
-                                          bins=[xbins, ybins],
-                                          weights=counts ** 2)
-
-            good = expomap > 0
-            mean = img.copy()
-            mean[good] /= expomap[good]
-            # For Numpy vs FITS image conventions...
-            images[ch] = mean.T
-            img_sdev = img_sq
-            img_sdev[good] = img_sdev[good] / expomap[good] - mean[good] ** 2
-
-            img_sdev = np.sqrt(img_sdev)
-            if calibration is not None and calibrate_scans:
-                cal_rel_err = \
-                    np.mean(Jy_over_counts_err / Jy_over_counts).value
-                img_sdev += mean * cal_rel_err
-
-            images['{}-Sdev'.format(ch)] = img_sdev.T
-            images['{}-EXPO'.format(ch)] = expomap.T
+                rel_err = (Jy_over_counts_err / Jy_over_counts).value
+                rel_err = rel_err * np.ones(len(counts))
+
+            self._accumulate_channel(ch, counts=counts, rel_err=rel_err)
+
+        return self.accumulator
+
+    def _images_from_accumulator(self, direction=None, calibration=None,
+                                 elevation=None, map_unit="Jy/beam"):
+        """Calculate the images from the sums in the accumulator."""
+        acc_meta = self.accumulator.meta
+        channels = [ch for ch in self.chan_columns
+                    if ch in acc_meta['feeds']]
+        images = self.accumulator.images(direction=direction,
+                                         channels=channels)
+        directions = [0, 1] if direction is None else [direction]
+        for ch in channels:
+            sums = [acc_meta['cal_rel_err'][(ch, d)] for d in directions
+                    if (ch, d) in acc_meta['cal_rel_err']]
+            nsamples = np.sum([n for _, n in sums])
+            if nsamples == 0:
+                continue
+            # Mean relative error of the samples that went into the image
+            cal_rel_err = np.sum([total for total, _ in sums]) / nsamples
+            images['{}-Sdev'.format(ch)] += images[ch] * cal_rel_err
 
         self.images = images
-        if calibration is not None and not calibrate_scans:
+        if calibration is not None and not acc_meta['calibrated']:
+            if elevation is None:
+                elevation = acc_meta['elevation']
             self.calibrate_images(calibration, elevation=elevation,
                                   map_unit=map_unit)
 
         return images
 
-    def destripe_images(self, niter=4, npix_tol=None, **kwargs):
+    def _world_to_pixel(self, altaz=False, start=0):
+        """Fill the pixel coordinates of the rows from ``start`` on."""
+        if altaz:
+            hor, ver = 'delta_az', 'delta_el'
+        else:
+            hor, ver = 'ra', 'dec'
+        coords = np.degrees(np.dstack([self[hor][start:],
+                                       self[ver][start:]]))
+        for f in range(coords.shape[1]):
+            pixcrd = self.wcs.wcs_world2pix(coords[:, f], 0)
+
+            self['x'][start:, f] = pixcrd[:, 0]
+            self['y'][start:, f] = pixcrd[:, 1]
+
+    def calculate_images(self, no_offsets=False, altaz=False,
+                         calibration=None, elevation=None, map_unit="Jy/beam",
+                         calibrate_scans=False, direction=None):
+        """Obtain image from all scans.
+
+        no_offsets:      use positions from feed 0 for all feeds.
+        direction:       0 if horizontal, 1 if vertical
+
+        The sums used to calculate the images are kept in the
+        ``accumulator`` attribute (see :func:`accumulate_images`).
+        """
+        if altaz != self['x'].meta['altaz']:
+            self.convert_coordinates(altaz)
+
+        self.accumulate_images(no_offsets=no_offsets, calibration=calibration,
+                               map_unit=map_unit,
+                               calibrate_scans=calibrate_scans)
+
+        return self._images_from_accumulator(direction=direction,
+                                             calibration=calibration,
+                                             elevation=elevation,
+                                             map_unit=map_unit)
+
+    def destripe_images(self, niter=4, npix_tol=None, recalculate=True,
+                        **kwargs):
         from .destripe import destripe_wrapper
 
-        images = self.calculate_images(**kwargs)
+        # The accumulator already contains the sums for each direction
+        image_kwargs = dict([(key, kwargs[key])
+                             for key in ['calibration', 'elevation',
+                                         'map_unit']
+                             if key in kwargs])
+        if recalculate or getattr(self, 'accumulator', None) is None:
+            images = self.calculate_images(**kwargs)
+        else:
+            images = self._images_from_accumulator(**image_kwargs)
 
         destriped = {}
         for ch in self.chan_columns:
             if ch in images:
                 destriped[ch + '_dirty'] = images[ch]
 
-        images_hor = self.calculate_images(direction=0, **kwargs)
-        images_ver = self.calculate_images(direction=1, **kwargs)
+        images_hor = self._images_from_accumulator(direction=0,
+                                                   **image_kwargs)
+        images_ver = self._images_from_accumulator(direction=1,
+                                                   **image_kwargs)
         for ch in images_hor:
             if 'Sdev' in ch:
                 destriped[ch] = (images_hor[ch]**2 + images_ver[ch]**2) ** 0.5
@@ -511,10 +813,13 @@ class ScanSet(Table):
     def fit_full_images(self, chans=None, fname=None, save_sdev=False,
                         no_offsets=False, altaz=False,
                         calibration=None, excluded=None, par=None,
-                        map_unit="Jy/beam"):
+                        map_unit="Jy/beam", method="L-BFGS-B", nproc=1):
         """Flatten the baseline with a global fit.
 
-        Fit a linear trend to each scan to minimize the scatter in an image
+        Fit a linear trend to each scan to minimize the scatter in an image.
+        See :func:`srttools.global_fit.fit_full_image` for the ``method``
+        argument. With ``nproc > 1``, the channels are fit in parallel in a
+        pool of processes.
         """
 
         if not hasattr(self, 'images'):
@@ -527,19 +832,20 @@ class ScanSet(Table):
         else:
             chans = self.chan_columns
 
+        feeds = [self._channel_feed(ch, no_offsets) for ch in chans]
         for ch in chans:
-            print("Fitting channel {}".format(ch))
-            feeds = self[ch + '_feed']
-            allfeeds = list(set(feeds))
-            if not len(allfeeds) == 1:
-                raise ValueError('Feeds are mixed up in channels')
-            if no_offsets:
-                feed = 0
-            else:
-                feed = feeds[0]
             self[ch + "_save"] = self[ch].copy()
-            self[ch] = Column(fit_full_image(self, chan=ch, feed=feed,
-                                             excluded=excluded, par=par))
+
+        def fitters():
+            for ch, feed in zip(chans, feeds):
+                print("Fitting channel {}".format(ch))
+                yield GlobalFitter.from_scanset(self, chan=ch, feed=feed,
+                                                excluded=excluded)
+
+        fit = functools.partial(_fit_channel, par=par, method=method)
+        new_counts = list(parallel_imap(fit, fitters(), nproc=nproc))
+        for ch, counts in zip(chans, new_counts):
+            self[ch] = Column(counts)
 
         self.calculate_images(no_offsets=no_offsets,
                               altaz=altaz, calibration=calibration,
@@ -613,8 +919,14 @@ class ScanSet(Table):
             raise ImportError('interactive_display: '
                               'matplotlib is not installed')
 
-        if not hasattr(self, 'images') or recreate:
+        if not hasattr(self, 'images'):
             self.calculate_images()
+        elif recreate:
+            if getattr(self, 'accumulator', None) is None:
+                self.calculate_images()
+            else:
+                # Scans were updated in place in the accumulator
+                self._images_from_accumulator()
 
         self.display_instructions = """
         -------------------------------------------------------------
@@ -737,10 +1049,11 @@ class ScanSet(Table):
 
         # Select data inside the pixel +- 1
 
+        coords = self.coordinates(feed)
         good_entries = \
             np.logical_and(
-                np.abs(self['x'][:, feed] - x) < 1,
-                np.abs(self['y'][:, feed] - y) < 1)
+                np.abs(coords['x'] - x) < 1,
+                np.abs(coords['y'] - y) < 1)
 
         sids = list(set(self['Scan_id'][good_entries]))
 
@@ -757,8 +1070,9 @@ class ScanSet(Table):
                 chan_mask = np.zeros_like(s[ch])
 
             scan_ids[sname] = sid
-            ras = s['ra'][:, feed]
-            decs = s['dec'][:, feed]
+            coords = s.coordinates(feed)
+            ras = coords['ra']
+            decs = coords['dec']
 
             z = s[ch]
 
@@ -790,6 +1104,15 @@ class ScanSet(Table):
             s = Scan(sname)
         except Exception:
             return
+        coords = s.coordinates(feed)
+
+        acc = getattr(self, 'accumulator', None)
+        if acc is not None and acc.meta['calibrated']:
+            # Calibrated counts cannot be updated here. Start over.
+            self.accumulator = acc = None
+        update_acc = acc is not None and ch in acc.meta['feeds']
+        if update_acc:
+            self._accumulate_channel(ch, rows=mask, remove=True)
 
         resave = False
         if len(zap_info.xs) > 0:
@@ -800,14 +1123,14 @@ class ScanSet(Table):
                 intervals = list(zip(xs[:-1:2], xs[1::2]))
                 for i in intervals:
                     i = sorted(i)
-                    good[np.logical_and(s[dim][:, feed] >= i[0],
-                                        s[dim][:, feed] <= i[1])] = False
+                    good[np.logical_and(coords[dim] >= i[0],
+                                        coords[dim] <= i[1])] = False
             s['{}-filt'.format(ch)] = good
             self['{}-filt'.format(ch)][mask] = good
 
         if len(fit_info) > 1:
             resave = True
-            s[ch] -= linear_fun(s[dim][:, feed],
+            s[ch] -= linear_fun(coords[dim],
                                 *fit_info)
         # TODO: make it channel-independent
             s.meta['backsub'] = True
@@ -821,12 +1144,15 @@ class ScanSet(Table):
                                                         dtype=bool)
             s['{}-filt'.format(ch)] = np.zeros(len(s[dim]), dtype=bool)
 
+        if update_acc:
+            self._accumulate_channel(ch, rows=mask)
+
         if resave:
             s.save()
 
     def barycenter_times(self):
         """Create barytime column with observing times converted to TDB."""
-        obstimes_tdb = self.get_obstimes().tdb.mjd
+        obstimes_tdb = utc_to_tdb(self['time'], site=self.meta['site'])
         self['barytime'] = obstimes_tdb
         return obstimes_tdb
 
@@ -835,6 +1161,10 @@ class ScanSet(Table):
 
         Moreover, saves the scan list to a txt file, that will be read when
         data are reloaded. This is a *temporary solution*
+
+        The ``compression``, ``precision`` and ``keep_bits`` keywords (see
+        :func:`srttools.io.write_hdf5_table`) default to the storage options
+        in the configuration file.
         """
         import os
         f, _ = os.path.splitext(fname)
@@ -845,16 +1175,90 @@ class ScanSet(Table):
                 print(i, file=fobj)
 
         try:
-            Table.write(self, fname, path='scanset', serialize_meta=True,
-                        **kwargs)
+            write_hdf5_table(self, fname, 'scanset',
+                             **storage_options(self.meta, **kwargs))
         except astropy.io.registry.IORegistryError as e:
             raise astropy.io.registry.IORegistryError(fname + ': ' + str(e))
 
+    def write_archive(self, fname, compression='gzip'):
+        """Save the scanset in a single-file archive.
+
+        Each scan is saved separately in a
+        :class:`srttools.archive.ScanArchive`, so that selected scans and
+        channels can be read with :func:`from_archive`, and new scans can be
+        appended to the archive. Pixel coordinates are not saved, as they
+        depend on the scans that are read.
+        """
+        colnames = [c for c in self.colnames if c not in ['x', 'y']]
+        scan_ids = np.asarray(self['Scan_id'])
+        scan_list = getattr(self, 'scan_list', None)
+        if scan_list is None:
+            scan_list = [''] * (np.max(scan_ids) + 1)
+
+        order = np.argsort(scan_ids, kind='mergesort')
+        sorted_ids = scan_ids[order]
+        all_ids = np.arange(len(scan_list))
+        starts = np.searchsorted(sorted_ids, all_ids, 'left')
+        stops = np.searchsorted(sorted_ids, all_ids, 'right')
+
+        with ScanArchive(fname, mode='w', compression=compression) as archive:
+            archive.meta.update(self.meta)
+            for i, name in enumerate(scan_list):
+                rows = order[starts[i]:stops[i]]
+                archive.append(Table([self[c][rows] for c in colnames]),
+                               name=name)
+
+    @classmethod
+    def from_archive(cls, fname, scans=None, channels=None,
+                     config_file=None):
+        """Load a scanset from an archive written by :func:`write_archive`.
+
+        Parameters
+        ----------
+        fname : str
+            The archive file
+
+        Other Parameters
+        ----------------
+        scans : list of int or str
+            Only load these scans (by index or name). Default: all
+        channels : list of str
+            Only load these channels. Default: all
+        config_file : str
+            Config file whose parameters update the ones saved in the archive
+        """
+        with ScanArchive(fname, mode='r') as archive:
+            meta = archive.meta
+            scan_list = archive.names
+            indices = list(range(len(archive)))
+            if scans is not None:
+                indices = [archive._index_of(s) for s in scans]
+            builder = _TableBuilder(nrows=np.sum(archive.nrows[indices]))
+            for _, s in archive.read_scans(indices, channels=channels):
+                builder.append(s)
+
+        # Information on the coordinates depends on the scans that are read
+        for key in list(meta.keys()):
+            if key.split('_')[0] in ['mean', 'min', 'max'] or key == 'npix':
+                del meta[key]
+
+        data = builder.table()
+        data.meta.update(meta)
+        scanset = cls(data, config_file=config_file, copy=False)
+        scanset.scan_list = scan_list
+        scanset.convert_coordinates()
+        return scanset
+
     def save_ds9_images(self, fname=None, save_sdev=False, scrunch=False,
                         no_offsets=False, altaz=False, calibration=None,
                         map_unit="Jy/beam", calibrate_scans=False,
-                        destripe=False, npix_tol=None):
-        """Save a ds9-compatible file with one image per extension."""
+                        destripe=False, npix_tol=None, recalculate=True):
+        """Save a ds9-compatible file with one image per extension.
+
+        If ``recalculate`` is False and the sums in the accumulator are
+        available (see :func:`accumulate_images`), the images are obtained
+        from them instead of going through all the data again.
+        """
         if fname is None:
             tail = '.fits'
             if altaz:
@@ -871,7 +1275,12 @@ class ScanSet(Table):
             images = self.destripe_images(no_offsets=no_offsets,
                                           altaz=altaz, calibration=calibration,
                                           map_unit=map_unit, npix_tol=npix_tol,
-                                          calibrate_scans=calibrate_scans)
+                                          calibrate_scans=calibrate_scans,
+                                          recalculate=recalculate)
+        elif not recalculate and \
+                getattr(self, 'accumulator', None) is not None:
+            images = self._images_from_accumulator(calibration=calibration,
+                                                   map_unit=map_unit)
         else:
             images = self.calculate_images(no_offsets=no_offsets,
                                            altaz=altaz,
@@ -915,6 +1324,233 @@ class ScanSet(Table):
         hdulist.writeto(fname, overwrite=True)
 
 
+class ObservationFollower(object):
+    """Build a map while the observation is going on.
+
+    The directories listed in the config file are periodically searched for
+    new scans. Each new scan is processed as soon as it is completely
+    written and appended to the scanset, and its contribution is added to
+    the sums in the accumulator of the scanset (see
+    :func:`ScanSet.accumulate_images`). The pixel grid is fixed when the
+    first scans arrive: it covers their extent, enlarged by ``padding``
+    times its size on each side. In this way, the following scans are added
+    without going through the previous ones again. Samples falling outside
+    the grid are not imaged.
+
+    Parameters
+    ----------
+    config_file : str
+        Config file containing the parameters for the images and the
+        directories containing the data
+
+    Other Parameters
+    ----------------
+    altaz : bool
+        Do images in Az-El coordinates
+    nproc : int
+        Number of processes used to process the new scans in parallel.
+        Default 1
+    padding : float
+        Margin added on each side of the extent of the first scans to
+        obtain the pixel grid, as a fraction of the extent. Default 0.5
+    kwargs : additional arguments
+        These will be passed to Scan initializers
+
+    Attributes
+    ----------
+    scanset : :class:`ScanSet`
+        The scanset containing all the scans processed so far (None before
+        the first scan arrives)
+    scan_list : list of str
+        All the files processed so far, in order of arrival
+    """
+    def __init__(self, config_file, altaz=False, nproc=1, padding=0.5,
+                 **kwargs):
+        self.config_file = config_file
+        self.config = read_config(config_file)
+        self.altaz = altaz
+        self.nproc = nproc
+        self.padding = padding
+        self.scan_kwargs = kwargs
+        self.scan_list = []
+        self.scanset = None
+        self.pending = []
+        self._sizes = {}
+        self._builder = _TableBuilder()
+        self._grid_meta = None
+
+    def new_scans(self):
+        """List the new files that are completely written.
+
+        A file is considered complete when its size did not change since the
+        previous call. Files that are still being written are listed in the
+        ``pending`` attribute.
+        """
+        processed = set(self.scan_list)
+        ready = []
+        self.pending = []
+        for fname in sorted(list_scans(self.config['datadir'],
+                                       self.config['list_of_directories'])):
+            if fname in processed:
+                continue
+            size = os.path.getsize(fname)
+            if self._sizes.get(fname) == size:
+                ready.append(fname)
+            else:
+                self.pending.append(fname)
+            self._sizes[fname] = size
+        return ready
+
+    def update(self):
+        """Process the new scans and add them to the map.
+
+        Returns
+        -------
+        nscans : int
+            The number of new files that were processed
+        """
+        new_files = self.new_scans()
+        if not new_files:
+            return 0
+
+        load = functools.partial(_load_scan_or_warn,
+                                 config_file=self.config_file,
+                                 **self.scan_kwargs)
+        first_id = len(self.scan_list)
+        self.scan_list.extend(new_files)
+        nold = self._builder.length
+        for i, s in enumerate(parallel_imap(load, new_files,
+                                            nproc=self.nproc)):
+            if s is None:
+                continue
+            s = _prepare_scan(s, first_id + i)
+            if s is None:
+                continue
+            # Placeholders, to be filled when the rows are added to the map
+            s['x'] = np.zeros_like(s['ra'])
+            s['y'] = np.zeros_like(s['dec'])
+            if self.altaz:
+                s['delta_az'] = np.zeros_like(s['az'])
+                s['delta_el'] = np.zeros_like(s['el'])
+            self._builder.append(s)
+
+        if self._builder.length > nold:
+            self._add_rows(nold)
+
+        return len(new_files)
+
+    def _fix_grid(self, scanset):
+        """Pad the extent of the first scans, and remember the grid."""
+        if self.altaz:
+            scanset.calculate_delta_altaz()
+            scanset.analyze_coordinates(altaz=True)
+            coords = ['delta_az', 'delta_el']
+        else:
+            coords = ['ra', 'dec']
+
+        for coord in coords:
+            low = scanset.meta['min_' + coord]
+            high = scanset.meta['max_' + coord]
+            margin = (high - low) * self.padding
+            scanset.meta['min_' + coord] = low - margin
+            scanset.meta['max_' + coord] = high + margin
+
+        self._grid_meta = \
+            dict([(key, scanset.meta[key]) for key in scanset.meta
+                  if key.split('_')[0] in ['mean', 'min', 'max',
+                                           'reference']])
+
+    def _add_rows(self, start):
+        """Add the rows of the scanset from ``start`` on to the map."""
+        table = self._builder.table(trim=False)
+        if self._grid_meta is not None:
+            table.meta.update(self._grid_meta)
+        scanset = ScanSet(table, config_file=self.config_file, copy=False)
+        scanset.scan_list = self.scan_list
+        scanset.meta['config_file'] = self.config_file
+        scanset.meta['scan_list_file'] = None
+
+        if self._grid_meta is None:
+            self._fix_grid(scanset)
+        elif self.altaz:
+            scanset.calculate_delta_altaz(start=start)
+        scanset.create_wcs(self.altaz)
+
+        scanset._world_to_pixel(self.altaz, start=start)
+        scanset['x'].meta['altaz'] = scanset['y'].meta['altaz'] = self.altaz
+
+        previous = self.scanset
+        if previous is None or previous.accumulator is None:
+            scanset.accumulate_images()
+        else:
+            scanset.accumulator = acc = previous.accumulator
+            for ch in scanset.chan_columns:
+                if ch not in acc.meta['feeds']:
+                    acc.meta['feeds'][ch] = int(scanset[ch + '_feed'][start])
+                scanset._accumulate_channel(ch, rows=slice(start, None))
+
+        self.scanset = scanset
+
+    def save_images(self, fname=None, **kwargs):
+        """Save the current map in a ds9-compatible file.
+
+        The images are calculated from the accumulated sums. Additional
+        arguments are passed to :func:`ScanSet.save_ds9_images`
+        """
+        if self.scanset is None:
+            return
+        self.scanset.save_ds9_images(fname=fname, altaz=self.altaz,
+                                     recalculate=False, **kwargs)
+
+    def follow(self, poll_interval=10, write_interval=60, timeout=600,
+               **kwargs):
+        """Update the map until no new data arrive for some time.
+
+        Parameters
+        ----------
+        poll_interval : float
+            Seconds between two searches for new scans
+        write_interval : float
+            Minimum number of seconds between two writes of the images
+        timeout : float
+            Stop following the observation when no new files appear for
+            this number of seconds
+
+        Other Parameters
+        ----------------
+        kwargs : additional arguments
+            These will be passed to :func:`save_images`
+
+        Returns
+        -------
+        scanset : :class:`ScanSet`
+            The scanset containing all the processed scans
+        """
+        import time
+        last_activity = last_write = time.time()
+        modified = False
+        while True:
+            nscans = self.update()
+            now = time.time()
+            if nscans > 0 or self.pending:
+                last_activity = now
+            modified = modified or nscans > 0
+
+            if modified and now - last_write >= write_interval:
+                self.save_images(**kwargs)
+                last_write = now
+                modified = False
+
+            if now - last_activity > timeout:
+                break
+            time.sleep(poll_interval)
+
+        if modified:
+            self.save_images(**kwargs)
+
+        return self.scanset
+
+
 def main_imager(args=None):
     """Main function."""
     import argparse
@@ -985,12 +1621,36 @@ def main_imager(args=None):
                              ' destriped as a whole')
 
     parser.add_argument("--debug", action='store_true', default=False,
-                        help='Plot stuff and be verbose')
+                        help='Save diagnostic plots and be verbose')
+
+    parser.add_argument("--nproc", type=int, default=1,
+                        help='Number of processes used to load and process '
+                             'the scans, and to fit the channels with '
+                             '--global-fit, in parallel')
 
     parser.add_argument("--quick", action='store_true', default=False,
                         help='Calibrate after image creation, for speed '
                              '(bad when calibration depends on elevation)')
 
+    parser.add_argument("--follow", action='store_true', default=False,
+                        help='Follow an ongoing observation: process new '
+                             'scans as they are written and update the map '
+                             'until no new scans arrive for --follow-timeout '
+                             'seconds')
+
+    parser.add_argument("--follow-interval", type=float, default=10,
+                        help='Seconds between two searches for new scans '
+                             'when following an observation')
+
+    parser.add_argument("--follow-timeout", type=float, default=600,
+                        help='Stop following the observation after this '
+                             'number of seconds without new scans')
+
+    parser.add_argument("--write-interval", type=float, default=60,
+                        help='Minimum number of seconds between two updates '
+                             'of the image file when following an '
+                             'observation')
+
     parser.add_argument("--scrunch-channels", action='store_true',
                         default=False,
                         help='Sum all the images from the single channels into'
@@ -1002,10 +1662,16 @@ def main_imager(args=None):
                               "range, starting from the frequency of the first"
                               " bin. E.g. '0:1000' indicates 'from the first "
                               "bin of the spectrum up to 1000 MHz above'. ':' "
-                              "or 'all' for all the channels."))
+                              "or 'all' for all the channels. More ranges "
+                              "separated by commas (e.g. '0:100,300:400') "
+                              "give one channel per range (Ch0_b0, Ch0_b1, "
+                              "...) from a single RFI cleaning."))
 
     args = parser.parse_args(args)
 
+    if args.debug:
+        set_diagnostics_level('debug')
+
     if args.sample_config:
         sample_config_file()
         sys.exit()
@@ -1031,9 +1697,28 @@ def main_imager(args=None):
     else:
         if args.config is None:
             raise ValueError("Please specify the config file!")
-        scanset = ScanSet(args.config, norefilt=not args.refilt,
-                          freqsplat=args.splat, nosub=not args.sub,
-                          nofilt=args.nofilt, debug=args.debug)
+        if args.follow:
+            follower = \
+                ObservationFollower(args.config, altaz=args.altaz,
+                                    nproc=args.nproc,
+                                    norefilt=not args.refilt,
+                                    freqsplat=args.splat, nosub=not args.sub,
+                                    nofilt=args.nofilt, debug=args.debug)
+            scanset = \
+                follower.follow(poll_interval=args.follow_interval,
+                                write_interval=args.write_interval,
+                                timeout=args.follow_timeout,
+                                save_sdev=True, calibration=args.calibrate,
+                                map_unit=args.unit,
+                                scrunch=args.scrunch_channels)
+            if scanset is None:
+                raise ValueError("No scans were found while following the "
+                                 "observation")
+        else:
+            scanset = ScanSet(args.config, norefilt=not args.refilt,
+                              freqsplat=args.splat, nosub=not args.sub,
+                              nofilt=args.nofilt, debug=args.debug,
+                              nproc=args.nproc)
         infile = args.config
 
         if outfile is None:
@@ -1046,7 +1731,7 @@ def main_imager(args=None):
 
     if args.global_fit:
         scanset.fit_full_images(excluded=excluded, chans=args.chans,
-                                altaz=args.altaz)
+                                altaz=args.altaz, nproc=args.nproc)
         scanset.write(outfile.replace('.hdf5', '_baselinesub.hdf5'),
                       overwrite=True)
 
@@ -1083,7 +1768,11 @@ def main_preprocess(args=None):
                         help='Do not filter noisy channels')
 
     parser.add_argument("--debug", action='store_true', default=False,
-                        help='Plot stuff and be verbose')
+                        help='Save diagnostic plots and be verbose')
+
+    parser.add_argument("--nproc", type=int, default=1,
+                        help='Number of processes used to load and process '
+                             'the scans in parallel')
 
     parser.add_argument("--splat", type=str, default=None,
                         help=("Spectral scans will be scrunched into a single "
@@ -1091,17 +1780,30 @@ def main_preprocess(args=None):
                               "range, starting from the frequency of the first"
                               " bin. E.g. '0:1000' indicates 'from the first "
                               "bin of the spectrum up to 1000 MHz above'. ':' "
-                              "or 'all' for all the channels."))
+                              "or 'all' for all the channels. More ranges "
+                              "separated by commas (e.g. '0:100,300:400') "
+                              "give one channel per range (Ch0_b0, Ch0_b1, "
+                              "...) from a single RFI cleaning."))
 
     args = parser.parse_args(args)
 
+    if args.debug:
+        set_diagnostics_level('debug')
+
+    nproc = args.nproc
+    if args.interactive:
+        nproc = 1
+
     if args.files is not None and args.files:
-        for f in args.files:
-            Scan(f, freqsplat=args.splat, nosub=not args.sub, norefilt=False,
-                 debug=args.debug, interactive=args.interactive)
+        load = functools.partial(_preprocess_scan, freqsplat=args.splat,
+                                 nosub=not args.sub, norefilt=False,
+                                 debug=args.debug,
+                                 interactive=args.interactive)
+        for _ in parallel_imap(load, args.files, nproc=nproc):
+            pass
     else:
         if args.config is None:
             raise ValueError("Please specify the config file!")
         ScanSet(args.config, norefilt=False, freqsplat=args.splat,
                 nosub=not args.sub, nofilt=args.nofilt, debug=args.debug,
-                interactive=args.interactive)
+                interactive=args.interactive, nproc=nproc)
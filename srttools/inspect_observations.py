@@ -5,11 +5,12 @@ from __future__ import (absolute_import, division,
 import os
 import glob
 import logging
+import functools
 import numpy as np
 from astropy.table import Table, Column
 from astropy.time import Time
 import warnings
-from .io import read_data
+from .io import read_obs_info_fitszilla
 from .calibration import read_calibrator_config
 from .read_config import sample_config_file
 from .utils import standard_string
@@ -19,12 +20,12 @@ try:
 except ImportError:
     from configparser import ConfigParser
 
-__all__ = ["inspect_directories", "split_observation_table", "split_by_source",
-           "dump_config_files"]
+__all__ = ["inspect_directories", "ObservationCatalog",
+           "split_observation_table", "split_by_source", "dump_config_files"]
 
 
-def inspect_directories(directories, only_after=None, only_before=None):
-    import datetime
+def _empty_info_table():
+    """Create the table containing the information on each directory."""
     info = Table()
     names = ["Dir", "Sample File", "Source", "Receiver", "Backend",
              "Time", "Frequency", "Bandwidth"]
@@ -35,7 +36,12 @@ def inspect_directories(directories, only_after=None, only_before=None):
     for n, d in zip(names, dtype):
         if n not in info.keys():
             info.add_column(Column(name=n, dtype=d))
+    return info
+
 
+def _time_limits(only_after=None, only_before=None):
+    """Convert time limits from the YYYYMMDD-HHMMSS format to MJD."""
+    import datetime
     if only_after is not None:
         only_after = \
             Time(datetime.datetime.strptime(only_after, '%Y%m%d-%H%M%S'),
@@ -48,39 +54,286 @@ def inspect_directories(directories, only_after=None, only_before=None):
                  scale='utc').mjd
         logging.warning('Filter out observations after '
                         'MJD {}'.format(only_before))
+    return only_after, only_before
+
+
+def _thread_imap(func, iterable, jobs=1):
+    """Apply ``func`` to all elements of ``iterable`` in a pool of threads.
+
+    The results are yielded in the same order as the input. With
+    ``jobs <= 1``, everything runs in the current thread.
+    """
+    if jobs is None or jobs <= 1:
+        for arg in iterable:
+            yield func(arg)
+        return
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(jobs)
+    try:
+        for result in pool.imap(func, iterable):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _inspect_directory(d, only_after=None, only_before=None):
+    """Read the information from the first good file in the directory.
+
+    ``only_after`` and ``only_before`` are MJDs. Returns None if no files
+    were found.
+    """
+    fits_files = glob.glob(os.path.join(d, '*.fits'))
+
+    for f in fits_files:
+        print("Reading {}".format(f), end="\r")
+        try:
+            obs_info = read_obs_info_fitszilla(f)
+            time_start = obs_info['time_start']
+            time_end = obs_info['time_end']
+            if only_after is not None and time_start < only_after:
+                continue
+            if only_before is not None and time_end > only_before:
+                continue
 
-    for d in directories:
-        fits_files = glob.glob(os.path.join(d, '*.fits'))
+            backend = obs_info['backend']
+            receiver = obs_info['receiver']
+            frequency = obs_info['frequency']
+            bandwidth = obs_info['bandwidth']
+            source = obs_info['SOURCE']
+
+            return [d, f, source, receiver, backend,
+                    time_start, frequency, bandwidth]
+        except Exception:
+            warnings.warn("Errors while opening {}".format(f))
+            continue
+    return None
+
+
+def inspect_directories(directories, only_after=None, only_before=None,
+                        jobs=1):
+    """Read the information on the observation in each directory.
+
+    A single file is read for each directory.
+
+    Parameters
+    ----------
+    directories : list of str
+        The directories to inspect
+
+    Other Parameters
+    ----------------
+    only_after : str
+        Only use the observations after this date and time, in the format
+        YYYYMMDD-HHMMSS
+    only_before : str
+        Only use the observations before this date and time, in the format
+        YYYYMMDD-HHMMSS
+    jobs : int
+        Number of threads used to inspect the directories. The order of the
+        output does not change
+
+    Returns
+    -------
+    info : ``astropy.table.Table``
+        Table with the directory, the sample file, the source, receiver,
+        backend, starting time, frequency and bandwidth of each observation
+    """
+    info = _empty_info_table()
+
+    only_after, only_before = _time_limits(only_after, only_before)
+
+    inspect = functools.partial(_inspect_directory, only_after=only_after,
+                                only_before=only_before)
+    for row in _thread_imap(inspect, directories, jobs=jobs):
+        if row is not None:
+            info.add_row(row)
+
+    return(info)
 
-        for f in fits_files:
-            print("Reading {}".format(f), end="\r")
+
+class ObservationCatalog(object):
+    """On-disk catalog of the inspected directories, in a SQLite database.
+
+    For each directory, the catalog records the modification times of the
+    directory and of a sample file, together with the information read from
+    the sample file. When the catalog is updated, only the directories that
+    are new or have been modified are inspected again.
+
+    Parameters
+    ----------
+    fname : str
+        The SQLite database file. It is created if it does not exist
+
+    Examples
+    --------
+    >>> catalog = ObservationCatalog(':memory:')
+    >>> catalog.update([])
+    0
+    >>> len(catalog.query())
+    0
+    >>> catalog.close()
+    """
+    columns = ['dir', 'sample_file', 'source', 'receiver', 'backend',
+               'time_start', 'frequency', 'bandwidth']
+
+    def __init__(self, fname):
+        import sqlite3
+        self.fname = fname
+        self.conn = sqlite3.connect(fname)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS directories ("
+            "dir TEXT PRIMARY KEY, dir_mtime REAL, sample_file TEXT, "
+            "file_mtime REAL, source TEXT, receiver TEXT, backend TEXT, "
+            "time_start REAL, time_end REAL, frequency REAL, "
+            "bandwidth REAL)")
+        for column in ['source', 'receiver', 'backend', 'time_start']:
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_{0} ON directories "
+                "({0})".format(column))
+        self.conn.commit()
+
+    def close(self):
+        """Close the connection to the database."""
+        self.conn.close()
+
+    def _is_up_to_date(self, d, dir_mtime):
+        row = self.conn.execute(
+            "SELECT dir_mtime, sample_file, file_mtime FROM directories "
+            "WHERE dir = ?", (d,)).fetchone()
+        if row is None or row[0] != dir_mtime:
+            return False
+        sample_file, file_mtime = row[1:]
+        if sample_file is None:
+            return True
+        return os.path.exists(sample_file) and \
+            os.path.getmtime(sample_file) == file_mtime
+
+    @staticmethod
+    def _inspect(d_and_mtime):
+        """Values of the catalog entry of a directory."""
+        d, dir_mtime = d_and_mtime
+        print("Inspecting {}".format(d), end="\r")
+        values = [d, dir_mtime] + [None] * 9
+        for f in sorted(glob.glob(os.path.join(d, '*.fits'))):
             try:
-                data = read_data(f)
-                time_start = data[0]['time']
-                time_end = data[-1]['time']
-                if only_after is not None and time_start < only_after:
-                    continue
-                if only_before is not None and time_end > only_before:
-                    continue
-
-                backend = data.meta['backend']
-                receiver = data.meta['receiver']
-                frequency = data["Ch0"].meta['frequency']
-                bandwidth = data["Ch0"].meta['bandwidth']
-                source = data.meta['SOURCE']
-
-                info.add_row([d, f, source, receiver, backend,
-                              time_start, frequency, bandwidth])
-                break
+                obs_info = read_obs_info_fitszilla(f)
             except Exception:
                 warnings.warn("Errors while opening {}".format(f))
                 continue
-
-    return(info)
+            values[2:] = [f, os.path.getmtime(f), obs_info['SOURCE'],
+                          obs_info['receiver'], obs_info['backend'],
+                          obs_info['time_start'], obs_info['time_end'],
+                          obs_info['frequency'], obs_info['bandwidth']]
+            break
+        return values
+
+    def update(self, directories, jobs=1):
+        """Inspect the new or modified directories.
+
+        Parameters
+        ----------
+        directories : list of str
+            The directories to add to the catalog
+
+        Other Parameters
+        ----------------
+        jobs : int
+            Number of threads used to inspect the directories
+
+        Returns
+        -------
+        ninspected : int
+            The number of directories that were (re-)inspected
+        """
+        to_inspect = []
+        for d in directories:
+            if not os.path.isdir(d):
+                warnings.warn("{} is not a directory".format(d))
+                continue
+            d = os.path.abspath(d)
+            dir_mtime = os.path.getmtime(d)
+            if not self._is_up_to_date(d, dir_mtime):
+                to_inspect.append((d, dir_mtime))
+
+        # The database is only accessed from this thread
+        for values in _thread_imap(self._inspect, to_inspect, jobs=jobs):
+            self.conn.execute(
+                "INSERT OR REPLACE INTO directories VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", values)
+        self.conn.commit()
+        return len(to_inspect)
+
+    def query(self, directories=None, source=None, receiver=None,
+              backend=None, only_after=None, only_before=None):
+        """Select the directories in the catalog.
+
+        Other Parameters
+        ----------------
+        directories : list of str
+            Only select these directories, in this order. By default, all
+            the directories in the catalog are selected, in time order
+        source : str
+            Only select the observations of this source
+        receiver : str
+            Only select the observations with this receiver
+        backend : str
+            Only select the observations with this backend
+        only_after : str
+            Only select the observations after this date and time, in the
+            format YYYYMMDD-HHMMSS
+        only_before : str
+            Only select the observations before this date and time, in the
+            format YYYYMMDD-HHMMSS
+
+        Returns
+        -------
+        info : ``astropy.table.Table``
+            Table in the same format returned by :func:`inspect_directories`
+        """
+        conditions = ["sample_file IS NOT NULL"]
+        params = []
+        for column, value in zip(['source', 'receiver', 'backend'],
+                                 [source, receiver, backend]):
+            if value is not None:
+                conditions.append("{} = ?".format(column))
+                params.append(value)
+
+        only_after, only_before = _time_limits(only_after, only_before)
+        if only_after is not None:
+            conditions.append("time_start >= ?")
+            params.append(only_after)
+        if only_before is not None:
+            conditions.append("time_end <= ?")
+            params.append(only_before)
+
+        rows = self.conn.execute(
+            "SELECT {} FROM directories WHERE {} "
+            "ORDER BY time_start".format(", ".join(self.columns),
+                                         " AND ".join(conditions)),
+            params).fetchall()
+
+        if directories is not None:
+            rows_by_dir = dict([(row[0], row) for row in rows])
+            rows = [rows_by_dir[os.path.abspath(d)] for d in directories
+                    if os.path.abspath(d) in rows_by_dir]
+
+        info = _empty_info_table()
+        for row in rows:
+            info.add_row(row)
+        return info
 
 
 def split_observation_table(info, max_calibrator_delay=0.4,
                             max_source_delay=0.2, group_by_entries=None):
+    """Group the observations, linking each source to its calibrators.
+
+    ``info`` is a table produced by :func:`inspect_directories`, or an
+    :class:`ObservationCatalog`, whose directories are all used.
+    """
+    if isinstance(info, ObservationCatalog):
+        info = info.query()
     if group_by_entries is None:
         group_by_entries = ["Receiver", "Backend"]
     grouped_table = info.group_by(group_by_entries)
@@ -172,6 +425,11 @@ def split_by_source(info, max_calibrator_delay=0.4, max_source_delay=0.2):
 
 
 def dump_config_files(info, group_by_entries=None, options=None):
+    """Write a config file for each observation.
+
+    ``info`` is a table produced by :func:`inspect_directories`, or an
+    :class:`ObservationCatalog`, whose directories are all used.
+    """
     observation_dict = \
         split_observation_table(info, group_by_entries=group_by_entries)
     config_files = []
@@ -216,7 +474,7 @@ def main_inspector(args=None):
                    ' file is read for each directory.')
     parser = argparse.ArgumentParser(description=description)
 
-    parser.add_argument("directories", nargs='+',
+    parser.add_argument("directories", nargs='*',
                         help="Directories to inspect",
                         default=None, type=str)
     parser.add_argument("-g", "--group-by", default=None, type=str, nargs="+")
@@ -237,10 +495,46 @@ def main_inspector(args=None):
                              '``--only-before 20150510-111020`` to indicate '
                              'scans done before 11:10:20 UTC, May 10th, 2015')
 
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help='Number of threads used to inspect the '
+                             'directories (useful on network filesystems)')
+    parser.add_argument("--catalog", type=str, default=None,
+                        help='SQLite file containing a catalog of the '
+                             'inspected directories. Only new or modified '
+                             'directories are inspected, and the results are '
+                             'taken from the catalog. If no directories are '
+                             'specified, all the directories in the catalog '
+                             'are used')
+    parser.add_argument("--source", type=str, default=None,
+                        help='Only use the observations of this source '
+                             '(requires --catalog)')
+    parser.add_argument("--receiver", type=str, default=None,
+                        help='Only use the observations with this receiver '
+                             '(requires --catalog)')
+    parser.add_argument("--backend", type=str, default=None,
+                        help='Only use the observations with this backend '
+                             '(requires --catalog)')
+
     args = parser.parse_args(args)
 
-    info = inspect_directories(args.directories, args.only_after,
-                               args.only_before)
+    if args.catalog is not None:
+        catalog = ObservationCatalog(args.catalog)
+        catalog.update(args.directories, jobs=args.jobs)
+        directories = args.directories if args.directories else None
+        info = catalog.query(directories=directories, source=args.source,
+                             receiver=args.receiver, backend=args.backend,
+                             only_after=args.only_after,
+                             only_before=args.only_before)
+        catalog.close()
+    else:
+        if not args.directories:
+            parser.error("Please specify the directories to inspect, "
+                         "or a catalog")
+        if [args.source, args.receiver, args.backend] != [None] * 3:
+            parser.error("--source, --receiver and --backend require "
+                         "--catalog")
+        info = inspect_directories(args.directories, args.only_after,
+                                   args.only_before, jobs=args.jobs)
     info.write('table.csv', overwrite=True)
 
     if args.dump_config_files:
@@ -2,18 +2,28 @@
 from __future__ import (absolute_import, division,
                         print_function)
 import astropy.io.fits as fits
-from astropy.table import Table
+from astropy.table import Table, Column, MaskedColumn
 import numpy as np
 import astropy.units as u
-from astropy.coordinates import EarthLocation, AltAz, Angle, ICRS
+from astropy.coordinates import EarthLocation, Angle
 import os
-from astropy.time import Time
+import re
+import sys
 import logging
+import threading
+from collections import OrderedDict
+import six
+from six.moves import queue
+from .transforms import altaz_to_icrs, DEFAULT_TOLERANCE
 
 
 __all__ = ["mkdir_p", "detect_data_kind", "correct_offsets", "observing_angle",
-           "get_rest_angle", "print_obs_info_fitszilla", "read_data_fitszilla",
-           "read_data", "root_name"]
+           "get_rest_angle", "print_obs_info_fitszilla", "FeedCoordinates",
+           "feed_column",
+           "read_obs_info_fitszilla", "read_data_fitszilla",
+           "read_spectrum_chunks", "read_data", "root_name",
+           "BackgroundWriter", "round_mantissa", "prepare_for_storage",
+           "restore_precision", "write_hdf5_table", "storage_options"]
 
 
 locations = {'srt': EarthLocation(4865182.7660, 791922.6890, 4035137.1740,
@@ -171,11 +181,422 @@ def print_obs_info_fitszilla(fname):
     lchdulist.close()
 
 
-def read_data_fitszilla(fname):
-    """Open a fitszilla FITS file and read all relevant information."""
+def read_obs_info_fitszilla(fname):
+    """Read the general information on an observation from a fitszilla file.
+
+    Only the primary header, the ``RF INPUTS`` table and the first and last
+    rows of the (memory-mapped) ``DATA TABLE`` are read. No coordinate
+    conversion is done, and the data are not split into channels.
+
+    Parameters
+    ----------
+    fname : str
+        The name of the fitszilla file
+
+    Returns
+    -------
+    info : dict
+        Contains ``SOURCE``, ``receiver``, ``backend`` (as in the metadata
+        of the table returned by :func:`read_data_fitszilla`), ``time_start``
+        and ``time_end`` (MJD), ``frequency`` and ``bandwidth`` of channel 0
+        (MHz, as in the metadata of the ``Ch0`` column)
+    """
+    with fits.open(fname, memmap=True) as lchdulist:
+        header = lchdulist[0].header
+        info = {'SOURCE': header['SOURCE'],
+                'receiver': header['HIERARCH RECEIVER CODE']}
+        # Check. If backend is not specified, use Total Power
+        try:
+            info['backend'] = header['HIERARCH BACKEND NAME']
+        except Exception:
+            info['backend'] = 'TP'
+
+        chan_ids = list(lchdulist['SECTION TABLE'].data['id'])
+        ic = chan_ids.index(0) if 0 in chan_ids else 0
+        rf_input_data = lchdulist['RF INPUTS'].data
+        frequency = float(rf_input_data['frequency'][ic])
+        bandwidth = float(rf_input_data['bandWidth'][ic])
+        if bandwidth < 0:
+            frequency -= bandwidth
+            bandwidth *= -1
+        info['frequency'] = frequency
+        info['bandwidth'] = bandwidth
+
+        times = lchdulist['DATA TABLE'].data['time']
+        info['time_start'] = float(times[0])
+        info['time_end'] = float(times[-1])
+    return info
+
+
+def _feeds_to_correct(xoffsets, yoffsets):
+    """Indices of the feeds whose offsets need a coordinate correction.
+
+    Offsets < 0.001 arcseconds are not corrected (usually feed 0).
+    """
+    tolerance = np.radians(0.001 / 60.) * u.rad
+    return [i for i in range(len(xoffsets))
+            if np.abs(xoffsets[i]) >= tolerance or
+            np.abs(yoffsets[i]) >= tolerance]
+
+
+def _feed_coordinates_per_feed(boresight, xoffsets, yoffsets, rest_angles,
+                               site, feeds, tolerance=DEFAULT_TOLERANCE):
+    """Calculate the coordinates of off-axis feeds, one feed at a time.
+
+    This is the original implementation, calling one ``AltAz`` to ``ICRS``
+    transformation per feed. Returns a dictionary with the ``ra``, ``dec``,
+    ``az`` and ``el`` of the feeds, with shape ``(nsamples, len(feeds))``.
+    """
+    shape = (len(boresight['time']), len(feeds))
+    result = dict([(c, np.zeros(shape)) for c in ['ra', 'dec', 'az', 'el']])
+    for j, i in enumerate(feeds):
+        # Calculate observing angle
+        obs_angle = observing_angle(rest_angles[i],
+                                    boresight['derot_angle'] * u.rad)
+
+        xoffs, yoffs = correct_offsets(obs_angle, xoffsets[i], yoffsets[i])
+
+        el = boresight['el'] + yoffs.to(u.rad).value
+        az = boresight['az'] + xoffs.to(u.rad).value / np.cos(el)
+
+        # According to line_profiler, the transformation to ICRS is *by
+        # far* the longest operation in this function, taking between 80
+        # and 90% of the execution time.
+        ra, dec = altaz_to_icrs(az, el, boresight['time'], site,
+                                tolerance=tolerance)
+        result['el'][:, j] = el
+        result['az'][:, j] = az
+        result['ra'][:, j] = ra
+        result['dec'][:, j] = dec
+    return result
+
+
+def _feed_coordinates_stacked(boresight, xoffsets, yoffsets, rest_angles,
+                              site, feeds, tolerance=DEFAULT_TOLERANCE):
+    """Calculate the coordinates of off-axis feeds in one transformation.
+
+    The offsets of all feeds are applied at once, and the horizontal
+    coordinates of all feeds and samples are stacked into a single ``AltAz``
+    frame, so that the expensive ``AltAz`` to ``ICRS`` conversion (and the
+    setup of the Earth orientation for each sample time) is only done once.
+    Returns the same as :func:`_feed_coordinates_per_feed`.
+    """
+    derot_angle = \
+        np.asarray(boresight['derot_angle'])[:, np.newaxis] * u.rad
+    rest_angles = u.Quantity(rest_angles, u.rad)[feeds][np.newaxis, :]
+
+    obs_angle = observing_angle(rest_angles, derot_angle)
+    xoffs, yoffs = \
+        correct_offsets(obs_angle,
+                        xoffsets[feeds][np.newaxis, :],
+                        yoffsets[feeds][np.newaxis, :])
+
+    el = boresight['el'][:, np.newaxis] + yoffs.to(u.rad).value
+    az = boresight['az'][:, np.newaxis] + \
+        xoffs.to(u.rad).value / np.cos(el)
+
+    ra, dec = altaz_to_icrs(az, el, boresight['time'], site,
+                            tolerance=tolerance)
+
+    return {'el': el, 'az': az, 'ra': ra, 'dec': dec}
+
+
+class FeedCoordinates(object):
+    """Sky coordinates of the feeds of a (multi-feed) receiver.
+
+    Only the boresight pointing, the derotator angle and the offsets of the
+    feeds are stored. The coordinates of a feed are calculated the first
+    time they are requested, and cached. Feeds with no offset share the
+    boresight arrays.
+
+    Parameters
+    ----------
+    time : array-like
+        MJD of each sample
+    ra, dec, az, el : array-like
+        Boresight coordinates, in radians
+    derot_angle : array-like
+        Derotator angle, in radians
+    xoffsets, yoffsets : ``astropy.units.Quantity``
+        Offsets of the feeds
+    site : str
+        The observing site (a key of ``locations``)
+
+    Other Parameters
+    ----------------
+    mode : str
+        ``'stacked'`` (default) to transform all the requested feeds at once,
+        ``'feed'`` to do one transformation per feed
+    tolerance : ``astropy.units.Quantity``
+        Accuracy of the interpolated ``AltAz`` to ``ICRS`` transformation
+        (see :func:`srttools.transforms.altaz_to_icrs`). If None, all samples
+        are transformed exactly
+    """
+    def __init__(self, time, ra, dec, az, el, derot_angle, xoffsets,
+                 yoffsets, site, mode='stacked', tolerance=DEFAULT_TOLERANCE):
+        if mode not in ['stacked', 'feed']:
+            raise ValueError("Unknown coordinate correction mode: "
+                             "{}".format(mode))
+        self.boresight = {'time': np.asarray(time, dtype=float),
+                          'ra': np.asarray(ra, dtype=float),
+                          'dec': np.asarray(dec, dtype=float),
+                          'az': np.asarray(az, dtype=float),
+                          'el': np.asarray(el, dtype=float),
+                          'derot_angle': np.asarray(derot_angle,
+                                                    dtype=float)}
+        self.xoffsets = xoffsets
+        self.yoffsets = yoffsets
+        self.rest_angles = get_rest_angle(xoffsets, yoffsets)
+        self.site = site
+        self.mode = mode
+        self.tolerance = tolerance
+        self.off_axis = _feeds_to_correct(xoffsets, yoffsets)
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.boresight['time'])
+
+    def _compute(self, feeds):
+        feeds = [f for f in sorted(set(feeds))
+                 if f in self.off_axis and f not in self._cache]
+        if len(feeds) == 0:
+            return
+        if self.mode == 'stacked':
+            func = _feed_coordinates_stacked
+        else:
+            func = _feed_coordinates_per_feed
+        result = func(self.boresight, self.xoffsets, self.yoffsets,
+                      self.rest_angles, self.site, feeds,
+                      tolerance=self.tolerance)
+        for j, f in enumerate(feeds):
+            self._cache[f] = \
+                dict([(c, result[c][:, j]) for c in result.keys()])
+
+    def feed(self, feed):
+        """Return a dictionary with the ``ra``, ``dec``, ``az``, ``el`` of a
+        feed, in radians."""
+        self._compute([feed])
+        if feed in self._cache:
+            return self._cache[feed]
+        return self.boresight
+
+    def columns(self, feeds):
+        """Materialize the coordinates of some feeds as 2-D arrays.
+
+        This is the layout used by the ``ra``, ``dec``, ``az``, ``el``
+        columns of scans. Column 0 contains the boresight pointing, shared
+        by all the feeds with no offset; the following columns contain the
+        off-axis feeds in ``feeds``, in increasing order. The coordinates of
+        the other off-axis feeds are neither calculated nor stored.
+
+        Parameters
+        ----------
+        feeds : list of int
+            The feeds whose coordinates are needed (e.g., the feeds of the
+            channels in the scan)
+
+        Returns
+        -------
+        columns : dict
+            ``ra``, ``dec``, ``az`` and ``el`` arrays, with shape
+            ``(nsamples, ncolumns)``
+        feed_columns : dict
+            The index of the column containing each feed, for all the feeds
+            whose coordinates are stored (see :func:`feed_column`)
+        """
+        off_axis = [f for f in sorted(set(feeds)) if f in self.off_axis]
+        self._compute(off_axis)
+        feed_columns = dict([(f, 0) for f in range(len(self.xoffsets))
+                             if f not in self.off_axis])
+        for j, f in enumerate(off_axis):
+            feed_columns[f] = j + 1
+
+        columns = {}
+        for coord in ['ra', 'dec', 'az', 'el']:
+            arr = np.empty((len(self), len(off_axis) + 1))
+            arr[:, 0] = self.boresight[coord]
+            for j, f in enumerate(off_axis):
+                arr[:, j + 1] = self._cache[f][coord]
+            columns[coord] = arr
+        return columns, feed_columns
+
+    @classmethod
+    def from_table(cls, table, **kwargs):
+        """Recreate the feed coordinates of a scan read by
+        :func:`read_data_fitszilla`, from its boresight pointing.
+
+        Other Parameters
+        ----------------
+        kwargs : additional arguments
+            Passed to the :class:`FeedCoordinates` initializer
+        """
+        nfeeds = len(table.meta['feed_xoffsets'])
+        xoffsets = [table.meta['feed_xoffsets'][f] for f in range(nfeeds)]
+        yoffsets = [table.meta['feed_yoffsets'][f] for f in range(nfeeds)]
+        return cls(table['time'], table['ra'][:, 0], table['dec'][:, 0],
+                   table['az'][:, 0], table['el'][:, 0],
+                   table['derot_angle'], np.array(xoffsets) * u.rad,
+                   np.array(yoffsets) * u.rad, table.meta['site'], **kwargs)
+
+
+def feed_column(table, feed):
+    """Index of the coordinate columns of a scan containing a given feed.
+
+    The ``ra``, ``dec``, ``az`` and ``el`` columns of scans (and the pixel
+    and horizontal offset columns of scansets) only contain the boresight
+    pointing and the off-axis feeds used by the channels (see
+    :func:`FeedCoordinates.columns`). The ``feed_columns`` metadata map each
+    stored feed to its column; tables without them (written by older
+    versions) have one column per feed.
+
+    Returns None if the coordinates of the feed are not stored.
+    """
+    feed = int(feed)
+    feed_columns = table.meta.get('feed_columns')
+    if feed_columns is None:
+        if feed < table['ra'].shape[1]:
+            return feed
+        return None
+    return feed_columns.get(feed)
+
+
+def _iter_spectrum_blocks(datahdu, nchan, flip, chunk_size=1024):
+    """Iterate over blocks of rows of the spectrum column of a data HDU.
+
+    Parameters
+    ----------
+    datahdu : ``astropy.io.fits.BinTableHDU``
+        The DATA TABLE HDU, possibly memory-mapped
+    nchan : int
+        Number of channels the spectrum is divided into
+    flip : list of bool
+        For each channel, whether its spectrum has to be reversed (negative
+        bandwidth)
+
+    Other Parameters
+    ----------------
+    chunk_size : int
+        Number of rows per block
+
+    Yields
+    ------
+    start, stop : int
+        Limits of the block of rows
+    blocks : list of arrays
+        For each channel, a (stop - start) x nbin_per_chan array. These are
+        views of the original data, no copy is done.
+    """
+    spectrum = datahdu.data['spectrum']
+    nrows, nbins = spectrum.shape
+    nbin_per_chan = nbins // nchan
+    if nbin_per_chan * nchan != nbins:
+        raise ValueError('Something wrong with channel subdivision')
+
+    for start in range(0, nrows, chunk_size):
+        stop = min(start + chunk_size, nrows)
+        rows = spectrum[start:stop]
+        blocks = []
+        for ic in range(nchan):
+            block = rows[:, ic * nbin_per_chan:(ic + 1) * nbin_per_chan]
+            if flip[ic]:
+                block = block[:, ::-1]
+            blocks.append(block)
+        yield start, stop, blocks
+
+
+def _read_spectrum_channels(datahdu, nchan, flip, scale, chunk_size=1024):
+    """Read the spectrum of each channel, flipped and scaled if needed.
+
+    The output arrays are allocated once, and filled one block of rows at a
+    time, so that no full temporary copy of the spectrum is ever created.
+    """
+    spectrum = datahdu.data['spectrum']
+    nrows, nbins = spectrum.shape
+    dtype = np.result_type(spectrum.dtype, np.asarray(scale).dtype)
+    channels = [np.empty((nrows, nbins // nchan), dtype=dtype)
+                for _ in range(nchan)]
+    for start, stop, blocks in _iter_spectrum_blocks(datahdu, nchan, flip,
+                                                     chunk_size=chunk_size):
+        for ic, block in enumerate(blocks):
+            np.multiply(block, scale[ic], out=channels[ic][start:stop])
+    return channels
+
+
+def read_spectrum_chunks(fname, chunk_size=1024):
+    """Iterate over blocks of samples of a spectroscopic fitszilla file.
+
+    The file is memory-mapped, and only one block of samples at a time is
+    read, so that memory usage does not depend on the size of the file.
+
+    Parameters
+    ----------
+    fname : str
+        The name of the fitszilla file
+
+    Other Parameters
+    ----------------
+    chunk_size : int
+        Number of samples per block
+
+    Yields
+    ------
+    start, stop : int
+        Indices of the first and (one after) the last sample of the block
+    chunk : dict
+        Contains the ``time`` of the samples and, for each channel (e.g.
+        ``Ch0``), a (stop - start) x nbin array with the spectra, reversed
+        if the bandwidth is negative and multiplied by the relative power of
+        the feed, as done by :func:`read_data_fitszilla`
+    """
+    with fits.open(fname, memmap=True) as lchdulist:
+        datahdu = lchdulist['DATA TABLE']
+        if 'SPECTRUM' not in list(datahdu.header.values()):
+            raise ValueError('{} does not contain spectral data'.format(fname))
+        chan_ids = lchdulist['SECTION TABLE'].data['id']
+        feeds = lchdulist['RF INPUTS'].data['feed']
+        bandwidths = lchdulist['RF INPUTS'].data['bandWidth']
+        relpowers = lchdulist['FEED TABLE'].data['relativePower']
+        times = datahdu.data['time']
+
+        flip = bandwidths < 0
+        for start, stop, blocks in \
+                _iter_spectrum_blocks(datahdu, len(chan_ids), flip,
+                                      chunk_size=chunk_size):
+            chunk = {'time': np.array(times[start:stop])}
+            for ic, (ch, block) in enumerate(zip(chan_ids, blocks)):
+                chunk['Ch{}'.format(ch)] = block * relpowers[feeds[ic]]
+            yield start, stop, chunk
+
+
+def read_data_fitszilla(fname, coord_mode='stacked', chunk_size=1024,
+                        coord_tolerance=DEFAULT_TOLERANCE):
+    """Open a fitszilla FITS file and read all relevant information.
+
+    Parameters
+    ----------
+    fname : str
+        The name of the fitszilla file
+
+    Other Parameters
+    ----------------
+    coord_mode : str
+        How to calculate the sky coordinates of off-axis feeds. If
+        ``'stacked'`` (default), the horizontal coordinates of all feeds are
+        transformed to ICRS in a single operation. If ``'feed'``, one
+        transformation per feed is done (the original, slower, behavior).
+        Results are identical.
+    chunk_size : int
+        Spectroscopic data are read from the (memory-mapped) file this many
+        samples at a time, and split into channels directly into the output
+        arrays, to limit memory usage.
+    coord_tolerance : ``astropy.units.Quantity``
+        Accuracy of the sky coordinates of off-axis feeds, which are
+        interpolated in time (see :func:`srttools.transforms.altaz_to_icrs`).
+        If None, the coordinates of all samples are transformed exactly.
+    """
 
     # Open FITS file
-    lchdulist = fits.open(fname)
+    lchdulist = fits.open(fname, memmap=True)
 
     # ----------- Extract generic observation information ------------------
     source = lchdulist[0].header['SOURCE']
@@ -222,24 +643,18 @@ def read_data_fitszilla(fname):
 
     # -------------- Read data!-----------------------------------------
     datahdu = lchdulist['DATA TABLE']
-    data_table_data = Table(datahdu.data)
-    for col in data_table_data.colnames:
-        if col == col.lower():
-            continue
-        data_table_data.rename_column(col, col.lower())
-
     is_spectrum = 'SPECTRUM' in list(datahdu.header.values())
-    if is_spectrum:
-        nchan = len(chan_ids)
+    # The spectrum, if present, is read separately below
+    colnames = [col for col in datahdu.columns.names
+                if not (is_spectrum and col.lower() == 'spectrum')]
+    data_table_data = Table([datahdu.data[col] for col in colnames],
+                            names=[col.lower() for col in colnames])
 
-        _, nbins = data_table_data['spectrum'].shape
-        nbin_per_chan = nbins // nchan
-        if nbin_per_chan * nchan != nbins:
-            raise ValueError('Something wrong with channel subdivision')
-        for ic, ch in enumerate(chan_ids):
-            data_table_data['Ch{}'.format(ch).lower()] = \
-                data_table_data['spectrum'][:, ic * nbin_per_chan:
-                                            (ic + 1) * nbin_per_chan]
+    if is_spectrum:
+        flip = bandwidths < 0
+        scale = relpowers[feeds[:len(chan_ids)]]
+        spectra = _read_spectrum_channels(datahdu, len(chan_ids), flip, scale,
+                                          chunk_size=chunk_size)
 
     info_to_retrieve = ['time', 'derot_angle']
 
@@ -262,65 +677,41 @@ def read_data_fitszilla(fname):
         logging.warning('Derotator angle looks weird. Setting to 0')
         new_table['derot_angle'][:] = 0
 
-    # Duplicate raj and decj columns (in order to be corrected later)
-    new_table['ra'] = \
-        np.tile(data_table_data['raj2000'],
-                (np.max(feeds) + 1, 1)).transpose()
-    new_table['dec'] = \
-        np.tile(data_table_data['decj2000'],
-                (np.max(feeds) + 1, 1)).transpose()
-    new_table['el'] = \
-        np.tile(data_table_data['el'],
-                (np.max(feeds) + 1, 1)).transpose()
-    new_table['az'] = \
-        np.tile(data_table_data['az'],
-                (np.max(feeds) + 1, 1)).transpose()
+    coords = FeedCoordinates(new_table['time'], data_table_data['raj2000'],
+                             data_table_data['decj2000'],
+                             data_table_data['az'], data_table_data['el'],
+                             new_table['derot_angle'], xoffsets, yoffsets,
+                             site, mode=coord_mode,
+                             tolerance=coord_tolerance)
+
+    # Only the feeds used by the channels (and feed 0, used as a reference
+    # for the scan direction) are calculated and stored
+    used_feeds = [0] + [int(f) for f in feeds[:len(chan_ids)]]
+    columns, feed_columns = coords.columns(used_feeds)
+    for info in ['ra', 'dec', 'el', 'az']:
+        new_table[info] = columns[info]
+    new_table.meta['feed_columns'] = feed_columns
+    # Needed to calculate the coordinates of the other feeds, if requested
+    new_table.meta['feed_xoffsets'] = \
+        dict([(i, float(x)) for i, x in enumerate(xoffsets.to(u.rad).value)])
+    new_table.meta['feed_yoffsets'] = \
+        dict([(i, float(y)) for i, y in enumerate(yoffsets.to(u.rad).value)])
 
     for info in ['ra', 'dec', 'az', 'el', 'derot_angle']:
         new_table[info].unit = u.radian
 
-    rest_angles = get_rest_angle(xoffsets, yoffsets)
-
-    for i in range(0, new_table['el'].shape[1]):
-        # offsets < 0.001 arcseconds: don't correct (usually feed 0)
-        if np.abs(xoffsets[i]) < np.radians(0.001 / 60.) * u.rad and \
-           np.abs(yoffsets[i]) < np.radians(0.001 / 60.) * u.rad:
-            continue
-
-        # Calculate observing angle
-        obs_angle = observing_angle(rest_angles[i], new_table['derot_angle'])
-
-        xoffs, yoffs = correct_offsets(obs_angle, xoffsets[i], yoffsets[i])
-
-        new_table['el'][:, i] += yoffs.to(u.rad).value
-        new_table['az'][:, i] += \
-            xoffs.to(u.rad).value / np.cos(new_table['el'][:, i])
-
-        obstimes = Time(new_table['time'] * u.day, format='mjd', scale='utc')
-
-        coords = AltAz(az=Angle(new_table['az'][:, i]),
-                       alt=Angle(new_table['el'][:, i]),
-                       location=locations[site],
-                       obstime=obstimes)
-
-        # According to line_profiler, coords.icrs is *by far* the longest
-        # operation in this function, taking between 80 and 90% of the
-        # execution time. Need to study a way to avoid this.
-        coords_deg = coords.transform_to(ICRS)
-        new_table['ra'][:, i] = np.radians(coords_deg.ra)
-        new_table['dec'][:, i] = np.radians(coords_deg.dec)
-
     for ic, ch in enumerate(chan_ids):
+        if is_spectrum:
+            # Already reversed and scaled
+            new_table['Ch{}'.format(ch)] = spectra[ic]
+        else:
+            new_table['Ch{}'.format(ch)] = \
+                data_table_data['Ch{}'.format(ch).lower()] * \
+                relpowers[feeds[ic]]
+
         if bandwidths[ic] < 0:
             frequencies[ic] -= bandwidths[ic]
             bandwidths[ic] *= -1
-            for i in range(
-                    data_table_data['Ch{}'.format(ch).lower()].shape[0]):
-                data_table_data['Ch{}'.format(ch).lower()][i, :] = \
-                    data_table_data['Ch{}'.format(ch).lower()][i, ::-1]
-
-        new_table['Ch{}'.format(ch)] = \
-            data_table_data['Ch{}'.format(ch).lower()] * relpowers[feeds[ic]]
 
         newmeta = \
             {'polarization': polarizations[ic],
@@ -337,21 +728,286 @@ def read_data_fitszilla(fname):
             np.zeros(len(data_table_data), dtype=np.uint8) + feeds[ic]
 
         new_table['Ch{}-filt'.format(ch)] = \
-            np.ones(len(data_table_data['Ch{}'.format(ch).lower()]),
-                    dtype=bool)
+            np.ones(len(data_table_data), dtype=bool)
     lchdulist.close()
     return new_table
 
 
-def read_data(fname):
-    """Read the data, whatever the format, and return them."""
+def read_data(fname, **kwargs):
+    """Read the data, whatever the format, and return them.
+
+    Other Parameters
+    ----------------
+    kwargs : additional arguments
+        Passed to the reader of the given format (e.g.
+        :func:`read_data_fitszilla`)
+    """
     kind = detect_data_kind(fname)
     if kind == 'fitszilla':
-        return read_data_fitszilla(fname)
+        return read_data_fitszilla(fname, **kwargs)
     elif kind == 'hdf5':
-        return Table.read(fname, path='scan')
+        return restore_precision(Table.read(fname, path='scan'))
+
+
+# Columns that can be stored in single precision: counts and coordinates.
+# Times are always kept in double precision.
+_counts_re = re.compile(r'^Ch[0-9]+(_b[0-9]+)?$')
+
+
+def round_mantissa(values, keep_bits=None):
+    """Convert to single precision, keeping only some bits of the mantissa.
+
+    Zeroing the least significant bits of the mantissa (with rounding to
+    the nearest value) makes the data much more compressible. The relative
+    error is at most ``2 ** -(keep_bits + 1)``.
+
+    Parameters
+    ----------
+    values : array-like
+        Input values
+
+    Other Parameters
+    ----------------
+    keep_bits : int
+        Bits of the mantissa to keep, between 0 and 23. Default: all
+
+    Examples
+    --------
+    >>> values = np.array([1, 1.1, -3.33, 1e30, np.inf, np.nan])
+    >>> rounded = round_mantissa(values, 7)
+    >>> rounded.dtype == np.float32
+    True
+    >>> good = np.isfinite(values)
+    >>> np.all(np.abs(rounded[good] / values[good] - 1) <= 2. ** -8)
+    True
+    >>> np.isinf(rounded[4]), np.isnan(rounded[5])
+    (True, True)
+    >>> np.all(round_mantissa(values[:2]) == np.float32(values[:2]))
+    True
+    """
+    rounded = np.array(values, dtype=np.float32)
+    if keep_bits is None or keep_bits >= 23:
+        return rounded
+    drop = 23 - int(keep_bits)
+    finite = np.isfinite(rounded)
+    ints = rounded.view(np.uint32)
+    ints[finite] += np.uint32(1 << (drop - 1))
+    ints[finite] &= np.uint32((0xFFFFFFFF >> drop) << drop)
+    return rounded
+
+
+def _replace_column_data(table, name, data):
+    """Replace the data of a column, keeping its attributes."""
+    col = table[name]
+    kwargs = dict(name=name, unit=col.unit, description=col.description,
+                  meta=col.meta)
+    if isinstance(col, MaskedColumn):
+        newcol = MaskedColumn(data, mask=col.mask, **kwargs)
+    else:
+        newcol = Column(data, **kwargs)
+    table.replace_column(name, newcol)
+
+
+def prepare_for_storage(table, precision='double', keep_bits=None):
+    """Return a version of the table to be written to disk.
+
+    Parameters
+    ----------
+    table : ``astropy.table.Table``
+        Input table. It is not modified
+
+    Other Parameters
+    ----------------
+    precision : str
+        ``'double'`` (default) to store the data as they are, ``'single'``
+        to store counts (``Ch0``, ``Ch1``, ...) in single precision. The
+        names of the converted columns are saved in the metadata, so that
+        :func:`restore_precision` can convert them back
+    keep_bits : int
+        For single precision, the number of bits of the mantissa of counts
+        to keep (see :func:`round_mantissa`)
+
+    Notes
+    -----
+    The conversion is lossy: the relative error of each sample of counts
+    is up to ``2 ** -24`` in single precision, and up to
+    ``2 ** -(keep_bits + 1)`` if ``keep_bits`` is given (e.g. 8e-6 for
+    ``keep_bits=16``). Times and coordinates are always stored in double
+    precision: in single precision, an angle of a few radians would have an
+    error of up to 0.05 arcsec (or about 10 arcsec with ``keep_bits=16``).
+    """
+    if precision is None or precision == 'double':
+        return table
+    if precision != 'single':
+        raise ValueError("Unknown storage precision: {}".format(precision))
+
+    out = Table(table, copy=False)
+    out.meta = OrderedDict(table.meta)
+    columns = [c for c in out.colnames
+               if _counts_re.match(c) and out[c].dtype == np.float64]
+    for c in columns:
+        _replace_column_data(out, c,
+                             round_mantissa(np.ma.getdata(out[c]), keep_bits))
+    out.meta['reduced_precision_columns'] = columns
+    return out
+
+
+def restore_precision(table):
+    """Convert the columns stored in single precision back to double.
+
+    Tables written with double precision are returned unchanged.
+    """
+    columns = table.meta.pop('reduced_precision_columns', None)
+    if columns is None:
+        return table
+    for c in columns:
+        if c in table.colnames:
+            _replace_column_data(table, c,
+                                 np.ma.getdata(table[c]).astype(np.float64))
+    return table
+
+
+def write_hdf5_table(table, fname, path, compression=None,
+                     precision='double', keep_bits=None, **kwargs):
+    """Write a table to HDF5, with the given storage options.
+
+    Parameters
+    ----------
+    table : ``astropy.table.Table``
+        The table
+    fname : str
+        Output file
+    path : str
+        Path of the table inside the file
+
+    Other Parameters
+    ----------------
+    compression : str
+        Lossless compression filter (e.g. ``'gzip'`` or ``'lzf'``). The data
+        are automatically chunked when compressed. Default: no compression
+    precision : str
+        ``'double'`` or ``'single'``; see :func:`prepare_for_storage`
+    keep_bits : int
+        See :func:`prepare_for_storage`
+    kwargs : additional arguments
+        Passed to ``Table.write``
+    """
+    table = prepare_for_storage(table, precision=precision,
+                                keep_bits=keep_bits)
+    if compression is not None:
+        kwargs['compression'] = compression
+    Table.write(table, fname, path=path, serialize_meta=True, **kwargs)
+
+
+def storage_options(meta, **kwargs):
+    """Storage options for :func:`write_hdf5_table`.
+
+    Options not given explicitly are taken from the ``storage_compression``,
+    ``storage_precision`` and ``storage_keep_bits`` keys of the metadata
+    (that are filled from the configuration file).
+
+    Examples
+    --------
+    >>> meta = {'storage_compression': 'gzip', 'storage_keep_bits': 10}
+    >>> opts = storage_options(meta, precision='single')
+    >>> opts == {'compression': 'gzip', 'precision': 'single',
+    ...          'keep_bits': 10}
+    True
+    """
+    for key in ['compression', 'precision', 'keep_bits']:
+        if key not in kwargs:
+            kwargs[key] = meta.get('storage_' + key, None)
+    return kwargs
 
 
 def root_name(fname):
     """Return the file name without extension."""
     return os.path.splitext(fname)[0]
+
+
+class BackgroundWriter(object):
+    """Run write operations in a background thread, in order.
+
+    Used to overlap the processing of data with the writing of the previous
+    results. The queue of pending operations is bounded, so that at most
+    ``maxsize`` of them (and the data they hold) are kept in memory:
+    :func:`submit` blocks when the queue is full.
+
+    Errors are logged when they happen, and the first one is re-raised by
+    :func:`flush` or :func:`close`.
+
+    Other Parameters
+    ----------------
+    maxsize : int
+        Maximum number of pending operations
+
+    Examples
+    --------
+    >>> results = []
+    >>> with BackgroundWriter() as writer:
+    ...     writer.submit(results.append, 1)
+    ...     writer.submit(results.append, 2)
+    >>> results
+    [1, 2]
+    >>> writer = BackgroundWriter()
+    >>> writer.submit(int, 'a')
+    >>> writer.close()  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ValueError: invalid literal for int() with base 10: 'a'
+    """
+    def __init__(self, maxsize=2):
+        self.queue = queue.Queue(maxsize)
+        self.errors = []
+        self.closed = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # Do not hide the original exception
+            self.errors = []
+        self.close()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                func, args, kwargs = item
+                func(*args, **kwargs)
+            except Exception as e:
+                logging.warning("Error in background write: {}".format(e))
+                self.errors.append(sys.exc_info())
+            finally:
+                self.queue.task_done()
+
+    def _raise(self):
+        if self.errors:
+            exc_info = self.errors[0]
+            self.errors = []
+            six.reraise(*exc_info)
+
+    def submit(self, func, *args, **kwargs):
+        """Call ``func(*args, **kwargs)`` in the background thread."""
+        if self.closed:
+            raise ValueError("The writer is closed")
+        self.queue.put((func, args, kwargs))
+
+    def flush(self):
+        """Wait until all the pending operations are done."""
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        """Wait for the pending operations and stop the thread."""
+        if not self.closed:
+            self.closed = True
+            self.queue.put(None)
+            self.thread.join()
+        self._raise()
@@ -61,6 +61,30 @@ goodchans :
 ;; Percentage of channels to filter out for rough RFI filtering (Spectral data
 ;; only. PROBABLY OBSOLETE. AVOID IF UNSURE)
 filtering_factor : 0.
+
+;; Directory where processed scans are cached, so that they are only
+;; processed again if the raw data or the processing parameters change.
+;; Relative to workdir. If left empty, no cache is used
+;    cache_directory : .srt_cache
+;; Maximum size of the cache, in MB
+;    cache_max_size : 10000
+
+;; Number of samples of spectroscopic scans processed at a time during RFI
+;; cleaning, to limit the memory used for long scans. If left empty, 512
+;; samples are processed at a time
+;    rfi_chunk_size : 1000
+
+;; Storage of processed scans and scansets in HDF5 files.
+;; Lossless compression filter (gzip or lzf). If left empty, no compression
+;    storage_compression : gzip
+;; Precision of counts on disk: double or single. Times and coordinates are
+;; always saved in double precision. Single precision gives a relative error
+;; of up to 6e-8 on counts
+;    storage_precision : single
+;; In single precision, bits of the mantissa of counts to keep (at most 23).
+;; Fewer bits compress better, but the relative error on counts grows to
+;; 2^-(bits+1) (8e-6 for 16 bits). If left empty, all are kept
+;    storage_keep_bits : 16
     """
     with open(fname, 'w') as fobj:
         print(string, file=fobj)
@@ -111,6 +135,12 @@ def read_config(fname=None):
     config_output['goodchans'] = None
     config_output['filtering_factor'] = '0'
     config_output['noise_threshold'] = '5'
+    config_output['cache_directory'] = None
+    config_output['cache_max_size'] = '10000'
+    config_output['storage_compression'] = None
+    config_output['storage_precision'] = 'double'
+    config_output['storage_keep_bits'] = None
+    config_output['rfi_chunk_size'] = None
 
     # --------------------------------------------------------------------
 
@@ -164,6 +194,38 @@ def read_config(fname=None):
         config_output['goodchans'] = \
             [int(n) for n in config_output['goodchans']]
 
+    if config_output['cache_directory'] is not None:
+        if config_output['cache_directory'].strip() == '':
+            config_output['cache_directory'] = None
+        elif not config_output['cache_directory'].startswith('/'):
+            config_output['cache_directory'] = \
+                os.path.abspath(os.path.join(config_output['workdir'],
+                                             config_output['cache_directory']))
+
+    config_output['cache_max_size'] = \
+        float(config_output['cache_max_size']) * 1024 ** 2
+
+    if config_output['storage_compression'] is not None and \
+            config_output['storage_compression'].strip() in ['', 'none']:
+        config_output['storage_compression'] = None
+    config_output['storage_precision'] = \
+        config_output['storage_precision'].strip()
+    if config_output['storage_precision'] not in ['double', 'single']:
+        raise ValueError("storage_precision must be double or single")
+    if config_output['storage_keep_bits'] is not None:
+        if config_output['storage_keep_bits'].strip() == '':
+            config_output['storage_keep_bits'] = None
+        else:
+            config_output['storage_keep_bits'] = \
+                int(config_output['storage_keep_bits'])
+
+    if config_output['rfi_chunk_size'] is not None:
+        if config_output['rfi_chunk_size'].strip() == '':
+            config_output['rfi_chunk_size'] = None
+        else:
+            config_output['rfi_chunk_size'] = \
+                int(config_output['rfi_chunk_size'])
+
     config_output['noise_threshold'] = float(config_output['noise_threshold'])
     config_output['filtering_factor'] = \
         float(config_output['filtering_factor'])
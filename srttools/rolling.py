@@ -0,0 +1,324 @@
+"""Rolling-window statistics.
+
+All functions return one value for each window fully contained in the
+array (``len(a) - window + 1`` values), like the rows of a strided rolling
+view, without allocating the (n x window) matrix.
+
+The running mean and standard deviation are calculated from cumulative
+sums, in O(n) time independent of the window.
+
+The running median and median absolute deviation keep the values of the
+window in a Fenwick (binary indexed) tree of counts, indexed by the rank of
+each value. The windows starting in a block of ``w`` consecutive samples
+only contain ``2 w - 1`` values, which are ranked once per block (an
+O(w log w) sort, or O(log w) per window). Moving the window then removes
+one value from the tree and adds one, and the median is found by a
+descent of the tree, in O(log w) operations each. The MAD is found with a
+binary search over the distances of the values from the median, each step
+of which reads two values from the tree, in O(log^2 w) operations. The
+whole series takes O(n log^2 w) operations, against the O(n w) of the
+median of each row of the strided view.
+
+These kernels are compiled with numba, which is a dependency of this
+package. If numba is missing, the kernels run in the Python interpreter,
+which is slower than numpy for all but very long windows: windows shorter
+than ``MIN_KERNEL_WINDOW`` then use the median of each row of the strided
+view, calculated on blocks of rows to limit the memory used. The median
+filter of short windows (e.g. the 5 samples of
+:func:`srttools.fit.purge_outliers`) is always left to
+``scipy.ndimage.median_filter``, which is faster there.
+"""
+from __future__ import (absolute_import, division,
+                        print_function)
+import numpy as np
+from .utils import jit, HAS_NUMBA
+
+__all__ = ["rolling_mean", "rolling_std", "rolling_median", "rolling_mad",
+           "median_filter"]
+
+# Without numba, below this window the strided numpy implementation is
+# faster than the kernels (see experiments/bench_rolling.py)
+MIN_KERNEL_WINDOW = 10000
+
+# Below this window, scipy.ndimage.median_filter is faster than the kernel
+MIN_FILTER_WINDOW = 15
+
+# Without numba, maximum number of values of the strided view whose
+# statistics are calculated at once
+STRIDED_CHUNK_SIZE = 2 ** 20
+
+# Same normalization of statsmodels.robust.mad
+MAD_NORMALIZATION = 0.6744897501960817
+
+
+def _check_window(a, window):
+    a = np.asarray(a, dtype=float)
+    window = int(window)
+    if window < 1 or window > a.size:
+        raise ValueError("Invalid window: {} for an array of length "
+                         "{}".format(window, a.size))
+    return a.ravel(), window
+
+
+def _strided(a, window):
+    shape = (a.size - window + 1, window)
+    strides = a.strides + a.strides
+    return np.lib.stride_tricks.as_strided(a, shape=shape, strides=strides)
+
+
+def _window_sums(a, window):
+    csum = np.concatenate(([0.], np.cumsum(a)))
+    return csum[window:] - csum[:-window]
+
+
+def rolling_mean(a, window):
+    """Mean in a rolling window.
+
+    Examples
+    --------
+    >>> np.allclose(rolling_mean([1, 2, 3, 4, 5], 2), [1.5, 2.5, 3.5, 4.5])
+    True
+    """
+    a, window = _check_window(a, window)
+    return _window_sums(a, window) / window
+
+
+def rolling_std(a, window):
+    """Standard deviation in a rolling window.
+
+    Examples
+    --------
+    >>> a = np.random.normal(10, 1, 100)
+    >>> std = rolling_std(a, 10)
+    >>> np.allclose(std, np.std(_strided(a, 10), axis=1))
+    True
+    """
+    a, window = _check_window(a, window)
+    if window == 1:
+        # The difference of the sums would only leave rounding errors
+        return np.zeros(a.size)
+    # Subtract the mean, to limit the loss of precision of the sums
+    a = a - np.mean(a)
+    mean = _window_sums(a, window) / window
+    var = _window_sums(a ** 2, window) / window - mean ** 2
+    return np.sqrt(np.clip(var, 0, None))
+
+
+def _strided_rows(a, window, func):
+    """Apply ``func`` to blocks of rows of the strided view of ``a``."""
+    nout = a.size - window + 1
+    nrows = max(1, STRIDED_CHUNK_SIZE // window)
+    result = np.zeros(nout)
+    for start in range(0, nout, nrows):
+        stop = min(start + nrows, nout)
+        result[start:stop] = func(_strided(a[start:stop + window - 1],
+                                           window))
+    return result
+
+
+def _median_of_rows(rows):
+    return np.median(rows, axis=1)
+
+
+def _mad_of_rows(rows):
+    medians = np.median(rows, axis=1)
+    return np.median(np.abs(rows - medians[:, np.newaxis]), axis=1)
+
+
+@jit(nopython=True)
+def _tree_add(tree, rank, delta):
+    """Add ``delta`` to the count of the value of rank ``rank``."""
+    i = rank + 1
+    while i < tree.size:
+        tree[i] += delta
+        i += i & (-i)
+
+
+@jit(nopython=True)
+def _tree_select(tree, k):
+    """Rank of the k-th smallest (from 0) value counted in the tree."""
+    step = 1
+    while step * 2 < tree.size:
+        step *= 2
+    rank = 0
+    while step > 0:
+        if rank + step < tree.size and tree[rank + step] <= k:
+            rank += step
+            k -= tree[rank]
+        step //= 2
+    return rank
+
+
+@jit(nopython=True)
+def _kth_distance(tree, values, median, split, k, nvalues):
+    """k-th smallest (from 0) of the distances of the values from the median.
+
+    The ``split`` smallest of the ``nvalues`` values in the tree are not
+    larger than the median, so their distances decrease with the order; the
+    others are not smaller than the median, and their distances increase
+    with the order.
+    """
+    nleft = split
+    nright = nvalues - split
+    # Find how many of the smallest k + 1 distances are on the left
+    lo = max(0, k + 1 - nright)
+    hi = min(k + 1, nleft)
+    while lo < hi:
+        i = (lo + hi) // 2
+        left = values[_tree_select(tree, split - 1 - i)]
+        right = values[_tree_select(tree, split + k - i)]
+        if median - left < right - median:
+            lo = i + 1
+        else:
+            hi = i
+    result = -np.inf
+    if lo > 0:
+        result = median - values[_tree_select(tree, split - lo)]
+    if k - lo >= 0:
+        result = max(result,
+                     values[_tree_select(tree, split + k - lo)] - median)
+    return result
+
+
+@jit(nopython=True)
+def _block_tree(block, window, values, ranks, tree):
+    """Rank the values of a block, and count the first ``window`` in a tree.
+
+    The sorted values, the rank of each value of the block and the tree
+    are written in the ``values``, ``ranks`` and ``tree`` buffers.
+    """
+    order = np.argsort(block)
+    for j in range(block.size):
+        values[j] = block[order[j]]
+        ranks[order[j]] = j
+    tree[:] = 0
+    for j in range(window):
+        _tree_add(tree, ranks[j], 1)
+
+
+@jit(nopython=True)
+def _rolling_median_mad(a, window, medians, mads, do_mad):
+    nout = a.size - window + 1
+    split = window // 2
+    values = np.zeros(2 * window - 1)
+    ranks = np.zeros(2 * window - 1, dtype=np.int64)
+    tree = np.zeros(2 * window, dtype=np.int64)
+    for start in range(0, nout, window):
+        # The windows starting in this block only contain these values:
+        # rank them once, and keep the counts of the ranks in the window
+        _block_tree(a[start:start + 2 * window - 1], window, values, ranks,
+                    tree)
+        for i in range(start, min(start + window, nout)):
+            j = i - start
+            if j > 0:
+                _tree_add(tree, ranks[j - 1], -1)
+                _tree_add(tree, ranks[j + window - 1], 1)
+            median = values[_tree_select(tree, split)]
+            if window % 2 == 0:
+                median = (values[_tree_select(tree, split - 1)] +
+                          median) / 2
+            medians[i] = median
+            if not do_mad:
+                continue
+            if window % 2 == 1:
+                mads[i] = _kth_distance(tree, values, median, split, split,
+                                        window)
+            else:
+                mads[i] = (_kth_distance(tree, values, median, split,
+                                         split - 1, window) +
+                           _kth_distance(tree, values, median, split,
+                                         split, window)) / 2
+
+
+@jit(nopython=True)
+def _rolling_rank(a, window, rank, result):
+    """k-th smallest (from 0) value in each window."""
+    nout = a.size - window + 1
+    values = np.zeros(2 * window - 1)
+    ranks = np.zeros(2 * window - 1, dtype=np.int64)
+    tree = np.zeros(2 * window, dtype=np.int64)
+    for start in range(0, nout, window):
+        _block_tree(a[start:start + 2 * window - 1], window, values, ranks,
+                    tree)
+        for i in range(start, min(start + window, nout)):
+            j = i - start
+            if j > 0:
+                _tree_add(tree, ranks[j - 1], -1)
+                _tree_add(tree, ranks[j + window - 1], 1)
+            result[i] = values[_tree_select(tree, rank)]
+
+
+def _use_kernel(a, window):
+    return (HAS_NUMBA or window >= MIN_KERNEL_WINDOW) and \
+        not np.any(np.isnan(a))
+
+
+def rolling_median(a, window):
+    """Median in a rolling window.
+
+    Examples
+    --------
+    >>> a = np.random.normal(0, 1, 1000)
+    >>> for window in [1, 4, 5, 100]:
+    ...     med = rolling_median(a, window)
+    ...     assert np.allclose(med, np.median(_strided(a, window), axis=1))
+    """
+    a, window = _check_window(a, window)
+    if not _use_kernel(a, window):
+        return _strided_rows(a, window, _median_of_rows)
+    medians = np.zeros(a.size - window + 1)
+    _rolling_median_mad(a, window, medians, medians, False)
+    return medians
+
+
+def rolling_mad(a, window, c=MAD_NORMALIZATION):
+    """Median absolute deviation in a rolling window.
+
+    The MAD of each window is calculated with respect to the median of the
+    same window, and divided by ``c`` (as in ``statsmodels.robust.mad``).
+
+    Examples
+    --------
+    >>> a = np.random.normal(0, 1, 1000)
+    >>> for window in [1, 4, 5, 100]:
+    ...     rows = _strided(a, window)
+    ...     dev = np.abs(rows - np.median(rows, axis=1)[:, np.newaxis])
+    ...     expected = np.median(dev, axis=1) / MAD_NORMALIZATION
+    ...     assert np.allclose(rolling_mad(a, window), expected)
+    """
+    a, window = _check_window(a, window)
+    if not _use_kernel(a, window):
+        return _strided_rows(a, window, _mad_of_rows) / c
+    medians = np.zeros(a.size - window + 1)
+    mads = np.zeros(a.size - window + 1)
+    _rolling_median_mad(a, window, medians, mads, True)
+    return mads / c
+
+
+def median_filter(a, window):
+    """Running median of an array, with the same length as the array.
+
+    Same as ``scipy.ndimage.median_filter`` with the default ``'reflect'``
+    mode: each window is centered on the sample (for even windows, it
+    includes one more sample before it), the array is extended by
+    reflecting it about its edges and, for even windows, the larger of the
+    two central values is used. Windows shorter than ``MIN_FILTER_WINDOW``
+    use ``scipy.ndimage.median_filter`` directly.
+
+    Examples
+    --------
+    >>> from scipy.ndimage import median_filter as scipy_median_filter
+    >>> a = np.random.normal(0, 1, 100)
+    >>> for window in [1, 4, 5, 20, 21]:
+    ...     assert np.allclose(median_filter(a, window),
+    ...                        scipy_median_filter(a, window))
+    """
+    a = np.asarray(a, dtype=float)
+    window = int(window)
+    if window < MIN_FILTER_WINDOW or not _use_kernel(a, window):
+        from scipy.ndimage import median_filter as scipy_median_filter
+        return scipy_median_filter(a, window)
+    padded = np.pad(a, (window // 2, (window - 1) // 2), mode='symmetric')
+    result = np.zeros(a.size)
+    _rolling_rank(padded, window, window // 2, result)
+    return result
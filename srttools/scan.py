@@ -2,31 +2,41 @@
 from __future__ import (absolute_import, division,
                         print_function)
 
-from .io import read_data, root_name
+from .io import read_data, root_name, write_hdf5_table, storage_options
+from .io import FeedCoordinates, feed_column
 import glob
 from .read_config import read_config, get_config_file
-from .fit import ref_mad, contiguous_regions
+from .fit import ref_mad, contiguous_regions, fill_intervals
 import os
 import numpy as np
 from astropy.table import Table, Column
 try:
     import matplotlib.pyplot as plt
     from matplotlib.gridspec import GridSpec
+    from matplotlib.cm import get_cmap
     HAS_MPL = True
 except ImportError:
     HAS_MPL = False
 
 from .fit import baseline_rough, baseline_als, linear_fun
 from .interactive_filter import select_data
+from .cache import ScanCache, processing_key
+from .diagnostics import diagnostics_enabled, diagnostic_plot
 
 import re
 import warnings
 import logging
+import six
+from collections import OrderedDict
 
 
-__all__ = ["Scan", "interpret_frequency_range", "clean_scan_using_variability",
+__all__ = ["Scan", "interpret_frequency_range", "interpret_frequency_ranges",
+           "clean_scan_using_variability", "clean_spectra_using_variability",
            "list_scans"]
 
+# Samples of the dynamical spectra cleaned at a time, if not specified
+DEFAULT_RFI_CHUNK_SIZE = 512
+
 
 def _split_freq_splat(freqsplat):
     freqmin, freqmax = \
@@ -34,6 +44,25 @@ def _split_freq_splat(freqsplat):
     return freqmin, freqmax
 
 
+def _split_bands(freqsplat):
+    """List of the single frequency ranges in a (multi-band) specification.
+
+    Examples
+    --------
+    >>> _split_bands(None)
+    [None]
+    >>> _split_bands('100:200, 300:400')
+    ['100:200', '300:400']
+    >>> _split_bands(['all'])
+    ['all']
+    """
+    if freqsplat is None:
+        return [None]
+    if isinstance(freqsplat, six.string_types):
+        freqsplat = freqsplat.split(',')
+    return [f.strip() for f in freqsplat]
+
+
 def interpret_frequency_range(freqsplat, bandwidth, nbin):
     """Interpret the frequency range specified in freqsplat.
 
@@ -88,29 +117,284 @@ def interpret_frequency_range(freqsplat, bandwidth, nbin):
     return freqmin, freqmax, binmin, binmax
 
 
-def _clean_dyn_spec(dynamical_spectrum, bad_intervals):
-    cleaned_dynamical_spectrum = dynamical_spectrum.copy()
-    for b in bad_intervals:
-        if b[0] == 0:
-            fill_lc = np.array(dynamical_spectrum[:, b[1]])
-        elif b[1] >= dynamical_spectrum.shape[1]:
-            fill_lc = np.array(dynamical_spectrum[:, b[0]])
+def interpret_frequency_ranges(freqsplat, bandwidth, nbin):
+    """Interpret a specification of one or more frequency ranges.
+
+    Parameters
+    ----------
+    freqsplat : str or list of str
+        Frequency ranges, in any of the formats accepted by
+        :func:`interpret_frequency_range`, given as a list or separated by
+        commas (e.g. ``'100:200,500:800'``)
+    bandwidth : float
+        The bandwidth in MHz
+    nbin : int
+        The number of bins in the spectrum
+
+    Returns
+    -------
+    ranges : list of tuples
+        ``(freqmin, freqmax, binmin, binmax)`` for each range, as returned by
+        :func:`interpret_frequency_range`
+
+    Examples
+    --------
+    >>> interpret_frequency_ranges('200:400, all', 1024, 512)
+    [(200.0, 400.0, 100, 199), (0, 1024, 0, 511)]
+    >>> interpret_frequency_ranges(None, 1024, 512)
+    [(102.4, 921.6, 51, 459)]
+    """
+    return [interpret_frequency_range(f, bandwidth, nbin)
+            for f in _split_bands(freqsplat)]
+
+
+def _bad_interval_anchors(bad_intervals, nbin):
+    """Channels used to fill each bad interval of a spectrum.
+
+    Each interval is filled with the mean of the two adjacent good channels
+    or, at the borders of the spectrum, with a single channel.
+
+    Returns
+    -------
+    starts, stops, left, right : arrays of int
+        See :func:`srttools.fit.fill_intervals`
+    """
+    bad_intervals = np.asarray(bad_intervals, dtype=int).reshape((-1, 2))
+    starts = bad_intervals[:, 0]
+    stops = np.minimum(bad_intervals[:, 1], nbin)
+    left, right = starts - 1, bad_intervals[:, 1].copy()
+    at_start = starts == 0
+    left[at_start] = right[at_start]
+    at_end = bad_intervals[:, 1] >= nbin
+    left[at_end] = right[at_end] = starts[at_end]
+    return starts, stops, left, right
+
+
+def _clean_dyn_spec(dynamical_spectrum, bad_intervals, inplace=False):
+    """Replace the bad frequency intervals of a dynamical spectrum.
+
+    See :func:`_bad_interval_anchors`. If ``inplace`` is True, the input
+    array is modified instead of a copy.
+    """
+    cleaned_dynamical_spectrum = dynamical_spectrum
+    if not inplace:
+        cleaned_dynamical_spectrum = dynamical_spectrum.copy()
+    if len(bad_intervals) == 0:
+        return cleaned_dynamical_spectrum
+    starts, stops, left, right = \
+        _bad_interval_anchors(bad_intervals, dynamical_spectrum.shape[1])
+    return fill_intervals(cleaned_dynamical_spectrum, starts, stops, left,
+                          right, kind='mean', axis=1)
+
+
+def _chunks(nsamples, chunk_size):
+    """Slices covering ``nsamples`` samples, ``chunk_size`` at a time.
+
+    If ``chunk_size`` is None, ``DEFAULT_RFI_CHUNK_SIZE`` is used.
+
+    Examples
+    --------
+    >>> _chunks(5, 2)
+    [slice(0, 2, None), slice(2, 4, None), slice(4, 6, None)]
+    >>> len(_chunks(2 * DEFAULT_RFI_CHUNK_SIZE, None))
+    2
+    """
+    if chunk_size is None:
+        chunk_size = DEFAULT_RFI_CHUNK_SIZE
+    if chunk_size <= 0:
+        raise ValueError("Invalid chunk size: {}".format(chunk_size))
+    return [slice(start, start + chunk_size)
+            for start in range(0, nsamples, chunk_size)]
+
+
+def _read_chunk(dynamical_spectra, chunk_slice):
+    """Samples of many dynamical spectra, as a (samples x spectra x bins)
+    array."""
+    return np.stack([np.asarray(d[chunk_slice]) for d in dynamical_spectra],
+                    axis=1)
+
+
+def _spectral_statistics(dynamical_spectra, chunk_size=None):
+    """Mean spectrum and relative rms variability of each channel.
+
+    The dynamical spectra are read ``chunk_size`` samples at a time, and the
+    statistics of the chunks are merged with the pairwise formulas of Chan
+    et al. (a generalization of Welford's algorithm), so that only one chunk
+    is kept in memory.
+
+    Parameters
+    ----------
+    dynamical_spectra : list of 2-d arrays
+        Dynamical spectra with the same shape (samples x bins)
+
+    Returns
+    -------
+    meanspec, spectral_var : 2-d arrays
+        Mean and relative rms of each spectrum (spectra x bins)
+
+    Examples
+    --------
+    >>> dynspec = np.random.uniform(1, 2, (101, 10))
+    >>> meanspec, spectral_var = _spectral_statistics([dynspec])
+    >>> np.allclose(meanspec, np.mean(dynspec, axis=0))
+    True
+    >>> np.allclose(spectral_var, np.std(dynspec, axis=0) / meanspec)
+    True
+    >>> m, v = _spectral_statistics([dynspec], chunk_size=7)
+    >>> np.allclose(m, meanspec) and np.allclose(v, spectral_var)
+    True
+    """
+    nsamples = 0
+    mean = m2 = 0
+    for chunk_slice in _chunks(len(dynamical_spectra[0]), chunk_size):
+        chunk = _read_chunk(dynamical_spectra, chunk_slice)
+        nchunk = chunk.shape[0]
+        chunk_mean = np.sum(chunk, axis=0) / nchunk
+        chunk_m2 = np.sum((chunk - chunk_mean) ** 2, axis=0)
+        if nsamples == 0:
+            mean, m2 = chunk_mean, chunk_m2
         else:
-            previous = np.array(dynamical_spectrum[:, b[0] - 1])
-            next_bin = np.array(dynamical_spectrum[:, b[1]])
-            fill_lc = (previous + next_bin) / 2
+            total = nsamples + nchunk
+            delta = chunk_mean - mean
+            mean = mean + delta * nchunk / total
+            m2 = m2 + chunk_m2 + delta ** 2 * nsamples * nchunk / total
+        nsamples += nchunk
 
-        for bsub in range(b[0], np.min([b[1], dynamical_spectrum.shape[1]])):
-            cleaned_dynamical_spectrum[:, bsub] = fill_lc
-        if b[0] == 0 or b[1] >= dynamical_spectrum.shape[1]:
-            continue
-    return cleaned_dynamical_spectrum
+    return mean, np.sqrt(m2 / nsamples) / mean
+
+
+def _cleaned_light_curves(dynamical_spectra, bad_intervals, freqmasks,
+                          chunk_size=None):
+    """Light curves of the good channels, after cleaning the bad intervals.
+
+    Each chunk of ``chunk_size`` samples is copied, cleaned in place and
+    summed over the channels of each frequency mask, so that no full copy of
+    the dynamical spectra is needed. The bad intervals of all spectra are
+    filled together.
+
+    Returns
+    -------
+    lcs : 3-d array
+        The light curves (samples x spectra x frequency masks)
+    """
+    nspec = len(dynamical_spectra)
+    nbin = dynamical_spectra[0].shape[1]
+    anchors = [_bad_interval_anchors(b, nbin) for b in bad_intervals]
+    # In the flattened (spectra x bins) axis, spectrum i starts at i * nbin
+    starts, stops, left, right = \
+        [np.concatenate([a[j] + i * nbin for i, a in enumerate(anchors)])
+         for j in range(4)]
+
+    lcs = []
+    for chunk_slice in _chunks(len(dynamical_spectra[0]), chunk_size):
+        chunk = _read_chunk(dynamical_spectra, chunk_slice)
+        flat = chunk.reshape((chunk.shape[0], nspec * nbin))
+        fill_intervals(flat, starts, stops, left, right, kind='mean', axis=1)
+        lcs.append(np.stack([np.sum(chunk[:, :, freqmask], axis=2)
+                             for freqmask in freqmasks], axis=-1))
+    return np.concatenate(lcs)
+
+
+def _plot_spectrum_cleaning(fig, allbins, meanspec, wholemask, mask,
+                            cleaned_meanspec, varimg, cleaned_varimg,
+                            mean_varimg, std_varimg, bandwidth, spectral_var,
+                            cleaned_spectral_var, baseline, noise_threshold,
+                            stdref, median_spectral_var, lc, lc_masked,
+                            lc_corr, bad_intervals, df, freqmin, freqmax):
+    """Diagnostic plot of :func:`clean_scan_using_variability`."""
+    lcbins = np.arange(len(lc))
+
+    # Prepare subplots
+    fig.set_size_inches(15, 15)
+    gs = GridSpec(4, 3, hspace=0, wspace=0,
+                  height_ratios=(1.5, 1.5, 1.5, 1.5),
+                  width_ratios=(3, 0.3, 1.2))
+    ax_meanspec = fig.add_subplot(gs[0, 0])
+    ax_dynspec = fig.add_subplot(gs[1, 0], sharex=ax_meanspec)
+    ax_cleanspec = fig.add_subplot(gs[2, 0], sharex=ax_meanspec)
+    ax_lc = fig.add_subplot(gs[1, 2], sharey=ax_dynspec)
+    ax_cleanlc = fig.add_subplot(gs[2, 2], sharey=ax_dynspec, sharex=ax_lc)
+    ax_var = fig.add_subplot(gs[3, 0], sharex=ax_meanspec)
+    # ax_varhist = fig.add_subplot(gs[3, 1], sharey=ax_var)
+    ax_meanspec.set_ylabel('Counts')
+    ax_dynspec.set_ylabel('Sample')
+    ax_cleanspec.set_ylabel('Sample')
+    ax_var.set_ylabel('r.m.s.')
+    ax_var.set_xlabel('Frequency (MHz)')
+    ax_cleanlc.set_xlabel('Counts')
+
+    # Plot mean spectrum
+
+    ax_meanspec.plot(allbins[1:], meanspec[1:], label="Unfiltered")
+    # ax_meanspec.plot(allbins[1:], meanspec[1:], label="Whitelist applied")
+    ax_meanspec.plot(allbins[wholemask], meanspec[wholemask],
+                     label="Final mask")
+    ax_meanspec.set_ylim([np.min(cleaned_meanspec),
+                          np.max(cleaned_meanspec)])
+
+    try:
+        cmap = get_cmap("magma")
+    except Exception:
+        cmap = get_cmap("gnuplot2")
+    ax_dynspec.imshow(varimg, origin="lower", aspect='auto',
+                      cmap=cmap,
+                      vmin=mean_varimg - 5 * std_varimg,
+                      vmax=mean_varimg + 5 * std_varimg,
+                      extent=(0, bandwidth,
+                              0, varimg.shape[0]), interpolation='none')
+
+    ax_cleanspec.imshow(cleaned_varimg, origin="lower", aspect='auto',
+                        cmap=cmap,
+                        vmin=mean_varimg - 5 * std_varimg,
+                        vmax=mean_varimg + 5 * std_varimg,
+                        extent=(0, bandwidth,
+                                0, varimg.shape[0]), interpolation='none')
+
+    # Plot variability
+
+    ax_var.plot(allbins[1:], spectral_var[1:], label="Spectral rms")
+    if mask is not None:
+        ax_var.plot(allbins[mask], spectral_var[mask])
+    ax_var.plot(allbins, cleaned_spectral_var,
+                zorder=10, color="k")
+    ax_var.plot(allbins[1:], baseline[1:])
+    ax_var.plot(allbins[1:], baseline[1:] + 2 * noise_threshold * stdref)
+    minb = np.min(baseline[1:])
+    ax_var.set_ylim([minb, median_spectral_var + 10 * stdref])
+
+    # Plot light curves
+
+    ax_lc.plot(lc, lcbins, color="grey")
+    ax_lc.plot(lc_masked, lcbins, color="b")
+    ax_cleanlc.plot(lc_masked, lcbins, color="grey")
+    ax_cleanlc.plot(lc_corr, lcbins, color="k")
+    dlc = max(lc_corr) - min(lc_corr)
+    ax_lc.set_xlim([np.min(lc_corr) - dlc / 10, max(lc_corr) + dlc / 10])
+
+    # Indicate bad intervals
+
+    for b in bad_intervals:
+        maxsp = np.max(meanspec)
+        ax_meanspec.plot(b * df, [maxsp] * 2, color='k', lw=2)
+        middleimg = [varimg.shape[0] / 2]
+        ax_dynspec.plot(b * df, [middleimg] * 2, color='k', lw=2)
+        maxsp = np.max(spectral_var)
+        ax_var.plot(b * df, [maxsp] * 2, color='k', lw=2)
+
+    # Indicate freqmin and freqmax
+
+    ax_dynspec.axvline(freqmin)
+    ax_dynspec.axvline(freqmax)
+    ax_var.axvline(freqmin)
+    ax_var.axvline(freqmax)
+    ax_meanspec.axvline(freqmin)
+    ax_meanspec.axvline(freqmax)
 
 
 def clean_scan_using_variability(dynamical_spectrum, length, bandwidth,
                                  good_mask=None, freqsplat=None,
                                  noise_threshold=5, debug=True, nofilt=False,
-                                 outfile="out", label=""):
+                                 outfile="out", label="", chunk_size=None):
     """Clean a spectroscopic scan using the difference of channel variability.
 
     From the dynamical spectrum, i.e. the list of spectra obtained in each
@@ -142,18 +426,31 @@ def clean_scan_using_variability(dynamical_spectrum, length, bandwidth,
         RFI, for example because they contain spectral lines
     freqsplat : str
         List of frequencies to be merged into one. See
-        :func:`srttools.scan.interpret_frequency_range`
+        :func:`srttools.scan.interpret_frequency_range`. Several ranges can
+        be given (see :func:`srttools.scan.interpret_frequency_ranges`): the
+        RFI cleaning is done once, over the interval containing all ranges,
+        and a light curve is calculated for each range
     noise_threshold : float
         The threshold, in sigmas, over which a given channel is
         considered noisy
     debug : bool
-        Print out debugging information
+        Print out debugging information and, if the diagnostics level is
+        ``'debug'`` (see :mod:`srttools.diagnostics`), save a diagnostic plot
     nofilt : bool
         Do not filter noisy channels (set noise_threshold to 1e32)
     outfile : str
-        Root file name for the diagnostics plots (outfile_label.png)
+        Root file name for the diagnostics plots (outfile_label.pdf)
     label : str
-        Label to append to the filename (outfile_label.png)
+        Label to append to the filename (outfile_label.pdf)
+    chunk_size : int
+        Process the dynamical spectrum this number of samples at a time
+        (default ``DEFAULT_RFI_CHUNK_SIZE``): the statistics of the channels
+        are accumulated over the chunks, and each chunk is cleaned in place
+        after copying it, so that the memory used does not depend on the
+        length of the scan. The
+        dynamical spectrum can be any array-like supporting slicing (e.g. an
+        HDF5 dataset or a memory-mapped array). The full cleaned spectrum is
+        only calculated if a diagnostic plot is requested
 
     Returns
     -------
@@ -166,98 +463,193 @@ def clean_scan_using_variability(dynamical_spectrum, length, bandwidth,
             Minimum frequency in MHz, referred to local oscillator
         freqmax : float
             Maximum frequency in MHz, referred to local oscillator
+        lcs : list of array-like
+            The cleaned light curve of each frequency range. ``lc`` is the
+            first one
+        freqranges : list of tuples
+            The ``(freqmin, freqmax)`` of each frequency range
 
     See Also
     --------
     srttools.fit.baseline_als
     srttools.fit.ref_mad
+    clean_spectra_using_variability
     """
     if len(dynamical_spectrum.shape) == 1:
         return None
-    dynspec_len, nbin = dynamical_spectrum.shape
+    return clean_spectra_using_variability(
+        [dynamical_spectrum], length, bandwidth, good_mask=good_mask,
+        freqsplat=freqsplat, noise_threshold=noise_threshold, debug=debug,
+        nofilt=nofilt, outfile=outfile, labels=[label],
+        chunk_size=chunk_size)[0]
+
+
+def clean_spectra_using_variability(dynamical_spectra, length, bandwidth,
+                                    good_mask=None, freqsplat=None,
+                                    noise_threshold=5, debug=True,
+                                    nofilt=False, outfile="out", labels=None,
+                                    chunk_size=None):
+    """Clean many spectroscopic channels of a scan together.
+
+    Same as :func:`clean_scan_using_variability`, for all the channels (e.g.
+    feeds and polarizations) of a scan with the same shape and bandwidth.
+    The variability spectra of all channels are calculated in a single pass
+    over the data, their baselines are fitted with a single banded solve, and
+    the bad intervals of all channels are filled together.
+
+    Parameters
+    ----------
+    dynamical_spectra : 3-d array or list of 2-d arrays
+        The dynamical spectra of all channels, each of shape MxN, with M
+        spectra of N elements each
+    length : float
+        Duration in seconds of the scan (assumed to have constant sample time)
+    bandwidth : float
+        Bandwidth in MHz
 
-    # Calculate first light curve
+    Other parameters
+    ----------------
+    labels : list of str
+        Labels to append to the filename of the diagnostic plot of each
+        channel. Default: the channel number
+    good_mask, freqsplat, noise_threshold, debug, nofilt, outfile, chunk_size
+        See :func:`clean_scan_using_variability`
+
+    Returns
+    -------
+    results : list of objects
+        The results for each channel, as returned by
+        :func:`clean_scan_using_variability`
+    """
+    nspec = len(dynamical_spectra)
+    dynspec_len, nbin = dynamical_spectra[0].shape
+    if labels is None:
+        labels = [str(i) for i in range(nspec)]
 
     times = length * np.arange(dynspec_len) / dynspec_len
-    lc = np.sum(dynamical_spectrum, axis=1)
-    lc = baseline_als(times, lc)
-    lcbins = np.arange(len(lc))
 
-    # Calculate spectral variability curve
+    # Calculate spectral variability curves
 
-    meanspec = np.sum(dynamical_spectrum, axis=0) / dynspec_len
-    spectral_var = \
-        np.sqrt(np.sum((dynamical_spectrum - meanspec) ** 2,
-                       axis=0) / dynspec_len) / meanspec
+    meanspec, spectral_var = \
+        _spectral_statistics(dynamical_spectra, chunk_size)
 
-    df = bandwidth / len(meanspec)
-    allbins = np.arange(len(meanspec)) * df
+    df = bandwidth / nbin
+    allbins = np.arange(nbin) * df
 
-    # Mask frequencies -- avoid those excluded from splat
+    # Mask frequencies -- avoid those excluded from splat. With many bands,
+    # RFI are searched in the interval containing all of them
 
-    freqmask = np.ones(len(meanspec), dtype=bool)
-    freqmin, freqmax, binmin, binmax = \
-        interpret_frequency_range(freqsplat, bandwidth, nbin)
+    bands = interpret_frequency_ranges(freqsplat, bandwidth, nbin)
+    band_masks = []
+    for _, _, band_binmin, band_binmax in bands:
+        band_mask = np.zeros(nbin, dtype=bool)
+        band_mask[band_binmin:band_binmax] = True
+        band_masks.append(band_mask)
+
+    binmin = min([b[2] for b in bands])
+    binmax = max([b[3] for b in bands])
+    freqmask = np.ones(nbin, dtype=bool)
     freqmask[0:binmin] = False
     freqmask[binmax:] = False
 
-    # Calculate the variability image
-
-    varimg = np.sqrt((dynamical_spectrum - meanspec) ** 2) / meanspec
-
     # Set up corrected spectral var
 
     mod_spectral_var = spectral_var.copy()
-    mod_spectral_var[0:binmin] = spectral_var[binmin]
-    mod_spectral_var[binmax:] = spectral_var[binmax]
+    mod_spectral_var[:, 0:binmin] = spectral_var[:, binmin:binmin + 1]
+    mod_spectral_var[:, binmax:] = spectral_var[:, binmax:binmax + 1]
 
     # Some statistical information on spectral var
 
-    median_spectral_var = np.median(mod_spectral_var[freqmask])
-    stdref = ref_mad(mod_spectral_var[freqmask], 20)
+    stdref = np.array([ref_mad(var[freqmask], 20)
+                       for var in mod_spectral_var])
 
-    # Calculate baseline of spectral var ---------------
+    # Calculate baselines of spectral var, all together ---------------
     # Empyrical formula, with no physical meaning
     lam = 10**(-6.2 + np.log2(nbin) * 1.2)
 
     _, baseline = baseline_als(np.arange(binmax - binmin),
-                               np.array(mod_spectral_var[binmin:binmax]),
+                               mod_spectral_var[:, binmin:binmax].T,
                                return_baseline=True,
                                lam=lam,
                                p=0.001, offset_correction=False,
                                outlier_purging=(False, True), niter=30)
+    baseline = baseline.T
 
     baseline = \
-        np.concatenate((np.zeros(binmin) + baseline[0],
+        np.concatenate((np.zeros((nspec, binmin)) + baseline[:, :1],
                         baseline,
-                        np.zeros(nbin - binmax) + baseline[-1]
-                        ))
+                        np.zeros((nspec, nbin - binmax)) + baseline[:, -1:]
+                        ), axis=1)
 
     # Set threshold
 
     if nofilt:
-        wholemask = freqmask
+        mask = None
+        wholemask = np.tile(freqmask, (nspec, 1))
     else:
-        threshold = baseline + 2 * noise_threshold * stdref
+        threshold = baseline + 2 * noise_threshold * stdref[:, np.newaxis]
         mask = spectral_var < threshold
 
         wholemask = freqmask & mask
 
-    if good_mask is None:
-        good_mask = np.zeros_like(freqmask, dtype=bool)
-    wholemask[good_mask] = 1
+    if good_mask is not None:
+        wholemask[:, good_mask] = True
 
-    # Calculate frequency-masked lc
-    lc_masked = np.sum(dynamical_spectrum[:, freqmask], axis=1)
-    lc_masked = baseline_als(times, lc_masked, outlier_purging=False)
+    bad_intervals = [contiguous_regions(np.logical_not(m))
+                     for m in wholemask]
+
+    # Calculate light curves of the cleaned dynamical spectra
 
-    bad_intervals = contiguous_regions(np.logical_not(wholemask))
+    lc_corr = _cleaned_light_curves(dynamical_spectra, bad_intervals,
+                                    band_masks, chunk_size)
+    nbands = len(bands)
+    lc_corr = baseline_als(times,
+                           lc_corr.reshape((dynspec_len, nspec * nbands)),
+                           outlier_purging=False)
+    lc_corr = lc_corr.reshape((dynspec_len, nspec, nbands))
 
-    # Calculate cleaned dynamical spectrum
+    all_results = []
+    for i in range(nspec):
+        results = type('test', (), {})()  # create empty object
+        results.lcs = [lc_corr[:, i, ib] for ib in range(nbands)]
+        results.freqranges = [(b[0], b[1]) for b in bands]
+        results.lc = results.lcs[0]
+        results.freqmin, results.freqmax = results.freqranges[0]
+        all_results.append(results)
 
+        if not debug or not diagnostics_enabled('debug'):
+            continue
+        _request_cleaning_plot(
+            "{}_{}.pdf".format(outfile, labels[i]),
+            np.asarray(dynamical_spectra[i]), times, bad_intervals[i],
+            freqmask, allbins=allbins, meanspec=meanspec[i],
+            wholemask=wholemask[i],
+            mask=None if mask is None else mask[i],
+            bandwidth=bandwidth, spectral_var=spectral_var[i],
+            baseline=baseline[i], noise_threshold=noise_threshold,
+            stdref=stdref[i],
+            median_spectral_var=np.median(mod_spectral_var[i][freqmask]),
+            lc_corr=lc_corr[:, i, 0], df=df, freqmin=bands[0][0],
+            freqmax=bands[0][1])
+
+    return all_results
+
+
+def _request_cleaning_plot(fname, dynamical_spectrum, times, bad_intervals,
+                           freqmask, **kwargs):
+    """Prepare the diagnostic plot of the cleaning of one channel."""
+    dynspec_len = len(dynamical_spectrum)
+    meanspec = kwargs['meanspec']
     cleaned_dynamical_spectrum = \
         _clean_dyn_spec(dynamical_spectrum, bad_intervals)
 
+    lc = np.sum(dynamical_spectrum, axis=1)
+    lc = baseline_als(times, lc)
+    lc_masked = np.sum(dynamical_spectrum[:, freqmask], axis=1)
+    lc_masked = baseline_als(times, lc_masked, outlier_purging=False)
+
+    varimg = np.sqrt((dynamical_spectrum - meanspec) ** 2) / meanspec
+
     cleaned_meanspec = \
         np.sum(cleaned_dynamical_spectrum,
                axis=0) / len(cleaned_dynamical_spectrum)
@@ -271,110 +663,31 @@ def clean_scan_using_variability(dynamical_spectrum, length, bandwidth,
     mean_varimg = np.mean(cleaned_varimg[:, freqmask])
     std_varimg = np.std(cleaned_varimg[:, freqmask])
 
-    lc_corr = np.sum(cleaned_dynamical_spectrum[:, freqmask], axis=1)
-    lc_corr = baseline_als(times, lc_corr, outlier_purging=False)
-
-    results = type('test', (), {})()  # create empty object
-    results.lc = lc_corr
-    results.freqmin = freqmin
-    results.freqmax = freqmax
-
-    if not debug or not HAS_MPL:
-        return results
-
-    # Now, PLOT IT ALL --------------------------------
-    # Prepare subplots
-    fig = plt.figure("{}_{}".format(outfile, label), figsize=(15, 15))
-    gs = GridSpec(4, 3, hspace=0, wspace=0,
-                  height_ratios=(1.5, 1.5, 1.5, 1.5),
-                  width_ratios=(3, 0.3, 1.2))
-    ax_meanspec = plt.subplot(gs[0, 0])
-    ax_dynspec = plt.subplot(gs[1, 0], sharex=ax_meanspec)
-    ax_cleanspec = plt.subplot(gs[2, 0], sharex=ax_meanspec)
-    ax_lc = plt.subplot(gs[1, 2], sharey=ax_dynspec)
-    ax_cleanlc = plt.subplot(gs[2, 2], sharey=ax_dynspec, sharex=ax_lc)
-    ax_var = plt.subplot(gs[3, 0], sharex=ax_meanspec)
-    # ax_varhist = plt.subplot(gs[3, 1], sharey=ax_var)
-    ax_meanspec.set_ylabel('Counts')
-    ax_dynspec.set_ylabel('Sample')
-    ax_cleanspec.set_ylabel('Sample')
-    ax_var.set_ylabel('r.m.s.')
-    ax_var.set_xlabel('Frequency (MHz)')
-    ax_cleanlc.set_xlabel('Counts')
-
-    # Plot mean spectrum
-
-    ax_meanspec.plot(allbins[1:], meanspec[1:], label="Unfiltered")
-    # ax_meanspec.plot(allbins[1:], meanspec[1:], label="Whitelist applied")
-    ax_meanspec.plot(allbins[wholemask], meanspec[wholemask],
-                     label="Final mask")
-    ax_meanspec.set_ylim([np.min(cleaned_meanspec),
-                          np.max(cleaned_meanspec)])
-
-    try:
-        cmap = plt.get_cmap("magma")
-    except Exception:
-        cmap = plt.get_cmap("gnuplot2")
-    ax_dynspec.imshow(varimg, origin="lower", aspect='auto',
-                      cmap=cmap,
-                      vmin=mean_varimg - 5 * std_varimg,
-                      vmax=mean_varimg + 5 * std_varimg,
-                      extent=(0, bandwidth,
-                              0, varimg.shape[0]), interpolation='none')
-
-    ax_cleanspec.imshow(cleaned_varimg, origin="lower", aspect='auto',
-                        cmap=cmap,
-                        vmin=mean_varimg - 5 * std_varimg,
-                        vmax=mean_varimg + 5 * std_varimg,
-                        extent=(0, bandwidth,
-                                0, varimg.shape[0]), interpolation='none')
-
-    # Plot variability
-
-    ax_var.plot(allbins[1:], spectral_var[1:], label="Spectral rms")
-    ax_var.plot(allbins[mask], spectral_var[mask])
-    ax_var.plot(allbins, cleaned_spectral_var,
-                zorder=10, color="k")
-    ax_var.plot(allbins[1:], baseline[1:])
-    ax_var.plot(allbins[1:], baseline[1:] + 2 * noise_threshold * stdref)
-    minb = np.min(baseline[1:])
-    ax_var.set_ylim([minb, median_spectral_var + 10 * stdref])
-
-    # Plot light curves
-
-    ax_lc.plot(lc, lcbins, color="grey")
-    ax_lc.plot(lc_masked, lcbins, color="b")
-    ax_cleanlc.plot(lc_masked, lcbins, color="grey")
-    ax_cleanlc.plot(lc_corr, lcbins, color="k")
-    dlc = max(lc_corr) - min(lc_corr)
-    ax_lc.set_xlim([np.min(lc_corr) - dlc / 10, max(lc_corr) + dlc / 10])
-
-    # Indicate bad intervals
+    diagnostic_plot('debug', fname, _plot_spectrum_cleaning,
+                    cleaned_meanspec=cleaned_meanspec,
+                    varimg=varimg, cleaned_varimg=cleaned_varimg,
+                    mean_varimg=mean_varimg, std_varimg=std_varimg,
+                    cleaned_spectral_var=cleaned_spectral_var,
+                    lc=lc, lc_masked=lc_masked, bad_intervals=bad_intervals,
+                    **kwargs)
 
-    for b in bad_intervals:
-        maxsp = np.max(meanspec)
-        ax_meanspec.plot(b * df, [maxsp] * 2, color='k', lw=2)
-        middleimg = [varimg.shape[0] / 2]
-        ax_dynspec.plot(b * df, [middleimg] * 2, color='k', lw=2)
-        maxsp = np.max(spectral_var)
-        ax_var.plot(b * df, [maxsp] * 2, color='k', lw=2)
-
-    # Indicate freqmin and freqmax
 
-    ax_dynspec.axvline(freqmin)
-    ax_dynspec.axvline(freqmax)
-    ax_var.axvline(freqmin)
-    ax_var.axvline(freqmax)
-    ax_meanspec.axvline(freqmin)
-    ax_meanspec.axvline(freqmax)
+def _scan_processing_key(fname, config, baseline_kind, **kwargs):
+    """Cache key of a raw scan processed with the given configuration.
 
-    plt.savefig(
-        "{}_{}.pdf".format(outfile, label))
-    plt.close(fig)
-    return results
+    Includes all the parameters in the config file affecting the processing
+    of single scans, and the precision they are stored with.
+    """
+    return processing_key(fname,
+                          noise_threshold=config['noise_threshold'],
+                          goodchans=config['goodchans'],
+                          filtering_factor=config['filtering_factor'],
+                          storage_precision=config.get('storage_precision'),
+                          storage_keep_bits=config.get('storage_keep_bits'),
+                          baseline_kind=baseline_kind, **kwargs)
 
 
-chan_re = re.compile(r'^Ch[0-9]+$')
+chan_re = re.compile(r'^Ch[0-9]+(_b[0-9]+)?$')
 
 
 def list_scans(datadir, dirlist):
@@ -387,12 +700,35 @@ def list_scans(datadir, dirlist):
     return scan_list
 
 
+def _compact_coordinates(table):
+    """Only keep the coordinate columns of feed 0 and of the channel feeds.
+
+    Scans written by older versions contain the coordinates of all feeds
+    (one column per feed, see :func:`srttools.io.feed_column`). They are
+    reduced in place to the layout used by :func:`srttools.io.read_data`, so
+    that they can be stacked with newer scans.
+    """
+    if 'feed_columns' in table.meta or table['ra'].ndim < 2:
+        return
+    feeds = set([0])
+    for ch in table.colnames:
+        if chan_re.match(ch) and ch + '_feed' in table.colnames:
+            feeds.update(np.unique(table[ch + '_feed']).tolist())
+    feeds = sorted([int(f) for f in feeds if f < table['ra'].shape[1]])
+    for coord in ['ra', 'dec', 'az', 'el']:
+        col = table[coord]
+        table[coord] = Column(np.array(col[:, feeds]), unit=col.unit,
+                              meta=col.meta)
+    table.meta['feed_columns'] = dict([(f, j) for j, f in enumerate(feeds)])
+
+
 class Scan(Table):
     """Class containing a single scan."""
 
     def __init__(self, data=None, config_file=None, norefilt=True,
                  interactive=False, nosave=False, debug=False,
-                 freqsplat=None, nofilt=False, nosub=False, **kwargs):
+                 freqsplat=None, nofilt=False, nosub=False, writer=None,
+                 baseline_kind='als', **kwargs):
         """Load a Scan object
 
         Parameters
@@ -407,13 +743,24 @@ class Scan(Table):
             directories containing the image and calibration data
         norefilt : bool
             If an HDF5 archive is present with the same basename as the input
-            FITS file, do not re-run the filtering (default True)
+            FITS file, do not re-run the filtering (default True). If a
+            ``cache_directory`` is specified in the config file, the archive
+            is only reused if it was processed from the same raw data and
+            with the same parameters; otherwise, a processed scan is searched
+            for in the cache, and saved there after processing.
         freqsplat : str
             See :class:`srttools.scan.interpret_frequency_range`
         nofilt : bool
             See :class:`srttools.scan.clean_scan_using_variability`
         nosub : bool
             Do not run the baseline subtraction.
+        baseline_kind : str
+            The kind of baseline subtraction. See
+            :func:`srttools.scan.Scan.baseline_subtract`
+        writer : :class:`srttools.io.BackgroundWriter`
+            If not None, the processed scan is saved (and put in the cache)
+            in the background by this writer, so that the caller can go on
+            while the file is written.
 
         Other Parameters
         ----------------
@@ -425,22 +772,60 @@ class Scan(Table):
 
         if isinstance(data, Table):
             Table.__init__(self, data, **kwargs)
+        elif data is not None and not isinstance(data, six.string_types):
+            # E.g. a dictionary of columns, as when unpickling
+            Table.__init__(self, data, **kwargs)
         elif data is None:
             Table.__init__(self, **kwargs)
             self.meta['config_file'] = config_file
             self.meta.update(read_config(self.meta['config_file']))
         else:  # if data is a filename
+            config = read_config(config_file)
+            cache = key = None
+            from_cache = False
+            if config['cache_directory'] is not None and not interactive and \
+                    not data.endswith('hdf5'):
+                cache = ScanCache(config['cache_directory'],
+                                  max_size=config['cache_max_size'])
+                key = _scan_processing_key(data, config,
+                                           checksum=cache.checksum(data),
+                                           baseline_kind=baseline_kind,
+                                           freqsplat=freqsplat,
+                                           nofilt=nofilt, nosub=nosub)
+
+            table = None
             if os.path.exists(root_name(data) + '.hdf5') and norefilt:
-                data = root_name(data) + '.hdf5'
-            if debug:
-                logging.info('Loading file {}'.format(data))
-            table = read_data(data)
+                if debug:
+                    logging.info('Loading file {}'.format(
+                        root_name(data) + '.hdf5'))
+                table = read_data(root_name(data) + '.hdf5')
+                # With the cache active, reuse the processed file only if
+                # it was obtained from the same data and parameters
+                if key is not None and \
+                        table.meta.get('processing_key') != key:
+                    table = None
+                else:
+                    data = root_name(data) + '.hdf5'
+            if table is None and cache is not None and norefilt:
+                cached_file = cache.get(key)
+                if cached_file is not None:
+                    logging.info('Using cached processed scan '
+                                 '{}'.format(cached_file))
+                    table = read_data(cached_file)
+                    table.meta['filename'] = os.path.abspath(data)
+                    from_cache = True
+            if table is None:
+                if debug:
+                    logging.info('Loading file {}'.format(data))
+                table = read_data(data)
+
             Table.__init__(self, table, masked=True, **kwargs)
+            _compact_coordinates(self)
             if not data.endswith('hdf5'):
                 self.meta['filename'] = os.path.abspath(data)
             self.meta['config_file'] = config_file
 
-            self.meta.update(read_config(self.meta['config_file']))
+            self.meta.update(config)
 
             self.check_order()
 
@@ -454,10 +839,25 @@ class Scan(Table):
             if (('backsub' not in self.meta.keys() or
                     not self.meta['backsub'])) and not nosub:
                 logging.info('Subtracting the baseline')
-                self.baseline_subtract()
+                self.baseline_subtract(kind=baseline_kind)
+
+            if key is not None:
+                self.meta['processing_key'] = key
+
+            saved = self
+            if writer is not None and (not nosave or
+                                       (key is not None and not from_cache)):
+                # Write a copy, so that this scan can be modified meanwhile
+                saved = Scan(self)
+
+            if key is not None and not from_cache:
+                if writer is None:
+                    cache.put(key, self)
+                else:
+                    writer.submit(cache.put, key, saved)
 
             if not nosave:
-                self.save()
+                saved.save(writer=writer)
 
     def chan_columns(self):
         """List columns containing samples."""
@@ -466,7 +866,8 @@ class Scan(Table):
 
     def clean_and_splat(self, good_mask=None, freqsplat=None,
                         noise_threshold=5, debug=True,
-                        save_spectrum=False, nofilt=False):
+                        save_spectrum=False, nofilt=False,
+                        chunk_size=None):
         """Clean from RFI.
 
         Very rough now, it will become complicated eventually.
@@ -478,7 +879,10 @@ class Scan(Table):
             RFI, for example because they contain spectral lines
         freqsplat : str
             List of frequencies to be merged into one. See
-            :func:`srttools.scan.interpret_frequency_range`
+            :func:`srttools.scan.interpret_frequency_range`. If more ranges
+            are given (see :func:`srttools.scan.interpret_frequency_ranges`),
+            channel ``ChN`` is replaced by channels ``ChN_b0``, ``ChN_b1``,
+            ..., one for each range
         noise_threshold : float
             The threshold, in sigmas, over which a given channel is
             considered noisy
@@ -498,6 +902,11 @@ class Scan(Table):
         nofilt : bool
             Do not filter noisy channels (see
             :func:`clean_scan_using_variability`)
+        chunk_size : int
+            Process the spectra this number of samples at a time, to limit
+            the memory used (see :func:`clean_scan_using_variability`).
+            Default: the ``rfi_chunk_size`` in the configuration, if any,
+            otherwise ``DEFAULT_RFI_CHUNK_SIZE``
         """
         logging.debug("Noise threshold: {}".format(noise_threshold))
 
@@ -505,20 +914,41 @@ class Scan(Table):
             warnings.warn("Don't use filtering factors > 0.5. Skipping.")
             return
 
+        if chunk_size is None:
+            chunk_size = self.meta.get('rfi_chunk_size', None)
+
         chans = self.chan_columns()
+        # Channels with the same spectral shape and bandwidth are cleaned
+        # together
+        groups = OrderedDict()
         for ic, ch in enumerate(chans):
-            results = \
-                clean_scan_using_variability(
-                    self[ch], self['time'],
-                    self[ch].meta['bandwidth'],
+            if len(self[ch].shape) == 1:
+                continue
+            groupkey = (self[ch].shape[1:], self[ch].meta['bandwidth'])
+            groups.setdefault(groupkey, []).append((ic, ch))
+
+        all_results = {}
+        for group in groups.values():
+            group_results = \
+                clean_spectra_using_variability(
+                    [self[ch] for _, ch in group], self['time'],
+                    self[group[0][1]].meta['bandwidth'],
                     good_mask=good_mask,
                     freqsplat=freqsplat,
                     noise_threshold=noise_threshold,
                     debug=debug, nofilt=nofilt,
                     outfile=root_name(self.meta['filename']),
-                    label="{}".format(ic))
+                    labels=["{}".format(ic) for ic, _ in group],
+                    chunk_size=chunk_size)
+            for (_, ch), results in zip(group, group_results):
+                all_results[ch] = results
 
-            if results is None:
+        for ch in chans:
+            if ch not in all_results:
+                continue
+            results = all_results[ch]
+            if len(results.lcs) > 1:
+                self._split_bands(ch, results, save_spectrum=save_spectrum)
                 continue
             lc_corr = results.lc
             freqmin, freqmax = results.freqmin, results.freqmax
@@ -533,6 +963,31 @@ class Scan(Table):
             self[ch + 'TEMP'].name = ch
             self[ch].meta['bandwidth'] = freqmax - freqmin
 
+    def _split_bands(self, ch, results, save_spectrum=False):
+        """Replace a spectral channel with one channel per frequency band.
+
+        Band ``i`` of channel ``ChN`` is saved in column ``ChN_bi``, with its
+        own ``_feed`` and ``-filt`` columns.
+        """
+        for ib, (lc_corr, (freqmin, freqmax)) in \
+                enumerate(zip(results.lcs, results.freqranges)):
+            name = '{}_b{}'.format(ch, ib)
+            self[name] = Column(lc_corr)
+            self[name].meta.update(self[ch].meta)
+            self[name].meta['bandwidth'] = freqmax - freqmin
+            self[name].meta['band'] = [freqmin, freqmax]
+            for suffix in ['_feed', '-filt']:
+                if ch + suffix in self.colnames:
+                    self[name + suffix] = np.array(self[ch + suffix])
+
+        if save_spectrum:
+            self[ch].name = ch + "_spec"
+            return
+        self.remove_column(ch)
+        for suffix in ['_feed', '-filt']:
+            if ch + suffix in self.colnames:
+                self.remove_column(ch + suffix)
+
     def baseline_subtract(self, kind='als', plot=False):
         """Subtract the baseline.
 
@@ -552,18 +1007,25 @@ class Scan(Table):
             PNG format.
 
         """
-        for ch in self.chan_columns():
+        if kind not in ['als', 'rough']:
+            raise ValueError('Unknown baseline technique')
+
+        chans = self.chan_columns()
+        if kind == 'als' and len(chans) > 0:
+            # Fit all channels at once
+            data = np.array([self[ch] for ch in chans]).T
+            subtracted = baseline_als(self['time'], data)
+
+        for i, ch in enumerate(chans):
             if plot and HAS_MPL:
                 fig = plt.figure("Sub" + ch)
                 plt.plot(self['time'], self[ch] - np.min(self[ch]),
                          alpha=0.5)
 
             if kind == 'als':
-                self[ch] = baseline_als(self['time'], self[ch])
-            elif kind == 'rough':
-                self[ch] = baseline_rough(self['time'], self[ch])
+                self[ch][:] = subtracted[:, i]
             else:
-                raise ValueError('Unknown baseline technique')
+                self[ch] = baseline_rough(self['time'], self[ch])
 
             if plot and HAS_MPL:
                 plt.plot(self['time'], self[ch])
@@ -580,16 +1042,42 @@ class Scan(Table):
         reprstring += repr(Table(self))
         return reprstring
 
-    def write(self, fname, *args, **kwargs):
-        """Same as Table.write, but adds path information for HDF5."""
+    def write(self, fname, **kwargs):
+        """Same as Table.write, but adds path information for HDF5.
+
+        The ``compression``, ``precision`` and ``keep_bits`` keywords (see
+        :func:`srttools.io.write_hdf5_table`) default to the storage options
+        in the configuration file.
+        """
         logging.info('Saving to {}'.format(fname))
         if fname.endswith('.hdf5'):
-            Table.write(self, fname, *args, path='scan', serialize_meta=True,
-                        **kwargs)
+            write_hdf5_table(self, fname, 'scan',
+                             **storage_options(self.meta, **kwargs))
         else:
             raise TypeError("Saving to anything else than HDF5 is not "
                             "supported at the moment")
 
+    def coordinates(self, feed):
+        """Return a dictionary with the ``ra``, ``dec``, ``az``, ``el`` of a
+        feed, in radians.
+
+        The coordinate columns only contain the feeds used by the channels
+        (see :func:`srttools.io.feed_column`). The coordinates of the other
+        feeds are calculated from the boresight pointing, and cached.
+        """
+        column = feed_column(self, feed)
+        if column is not None:
+            return dict([(coord, np.asarray(self[coord][:, column]))
+                         for coord in ['ra', 'dec', 'az', 'el']])
+        if 'feed_xoffsets' not in self.meta:
+            raise ValueError('The coordinates of feed {} are not '
+                             'available'.format(feed))
+        store = getattr(self, '_feed_coordinates', None)
+        if store is None or len(store) != len(self):
+            store = FeedCoordinates.from_table(self)
+            self._feed_coordinates = store
+        return store.feed(int(feed))
+
     def check_order(self):
         """Check that times in a scan are monotonically increasing."""
         if not np.all(self['time'] == np.sort(self['time'])):
@@ -600,13 +1088,14 @@ class Scan(Table):
         for ch in self.chan_columns():
             # Temporary, waiting for AstroPy's metadata handling improvements
             feed = self[ch + '_feed'][0]
+            coords = self.coordinates(feed)
 
-            selection = self['ra'][:, feed]
+            selection = coords['ra']
 
             ravar = np.abs(selection[-1] -
                            selection[0])
 
-            selection = self['dec'][:, feed]
+            selection = coords['dec']
             decvar = np.abs(selection[-1] -
                             selection[0])
 
@@ -617,7 +1106,7 @@ class Scan(Table):
                 dim = 'dec'
 
             # ------- CALL INTERACTIVE FITTER ---------
-            info = select_data(self[dim][:, feed], self[ch],
+            info = select_data(coords[dim], self[ch],
                                xlabel=dim, test=test)
 
             # -----------------------------------------
@@ -632,12 +1121,12 @@ class Scan(Table):
             if len(xs) >= 2:
                 intervals = list(zip(xs[:-1:2], xs[1::2]))
                 for i in intervals:
-                    good[np.logical_and(self[dim][:, feed] >= i[0],
-                                        self[dim][:, feed] <= i[1])] = False
+                    good[np.logical_and(coords[dim] >= i[0],
+                                        coords[dim] <= i[1])] = False
             self['{}-filt'.format(ch)] = good
 
             if len(info['Ch']['fitpars']) > 1:
-                self[ch] -= linear_fun(self[dim][:, feed],
+                self[ch] -= linear_fun(coords[dim],
                                        *info['Ch']['fitpars'])
                 self.meta['backsub'] = True
 
@@ -647,8 +1136,16 @@ class Scan(Table):
             self.save()
         self.meta['ifilt'] = True
 
-    def save(self, fname=None):
-        """Call self.write with a default filename, or specify it."""
+    def save(self, fname=None, writer=None):
+        """Call self.write with a default filename, or specify it.
+
+        If a :class:`srttools.io.BackgroundWriter` is given, the file is
+        written in the background. Do not modify the scan until the writer
+        is flushed.
+        """
         if fname is None:
             fname = root_name(self.meta['filename']) + '.hdf5'
-        self.write(fname, overwrite=True)
+        if writer is None:
+            self.write(fname, overwrite=True)
+        else:
+            writer.submit(self.write, fname, overwrite=True)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division,
+                        print_function)
+
+from srttools.cache import ScanCache, processing_key, file_checksum
+from srttools.scan import Scan
+from srttools.read_config import read_config
+import os
+import time
+import glob
+import shutil
+
+
+class _FakeScan(object):
+    def __init__(self, size):
+        self.size = size
+
+    def write(self, fname, overwrite=True):
+        with open(fname, 'wb') as fobj:
+            fobj.write(b'0' * self.size)
+
+
+class TestScanCache(object):
+    @classmethod
+    def setup_class(klass):
+        klass.cachedir = os.path.abspath('test_cache_dir')
+
+    def test_key_depends_on_parameters(self):
+        key1 = processing_key(__file__, noise_threshold=5)
+        key2 = processing_key(__file__, noise_threshold=3)
+        assert key1 != key2
+        assert key1 == processing_key(__file__, noise_threshold=5)
+
+    def test_checksum_is_remembered(self):
+        cache = ScanCache(self.cachedir)
+        fname = os.path.join(self.cachedir, 'raw.fits')
+        with open(fname, 'wb') as fobj:
+            fobj.write(b'1' * 100)
+        checksum = cache.checksum(fname)
+        assert checksum == file_checksum(fname)
+        # The file is not read again if unchanged
+        cache2 = ScanCache(self.cachedir)
+        record = cache2._read_checksum_record(os.path.abspath(fname))
+        record['checksum'] = 'bogus'
+        cache2._write_checksum_record(os.path.abspath(fname), record)
+        assert cache2.checksum(fname) == 'bogus'
+        # Modified files are read again
+        time.sleep(0.02)
+        with open(fname, 'wb') as fobj:
+            fobj.write(b'2' * 101)
+        assert cache2.checksum(fname) == file_checksum(fname)
+        os.unlink(fname)
+
+    def test_concurrent_checksums_are_all_kept(self):
+        from multiprocessing.pool import ThreadPool
+        cache = ScanCache(self.cachedir + '_concurrent')
+        fnames = []
+        for i in range(20):
+            fname = os.path.join(cache.directory, 'raw{}.fits'.format(i))
+            with open(fname, 'wb') as fobj:
+                fobj.write(str(i).encode() * 100)
+            fnames.append(fname)
+        pool = ThreadPool(4)
+        # Each thread uses its own cache object, as different scans do
+        checksums = pool.map(lambda f: ScanCache(cache.directory).checksum(f),
+                             fnames)
+        pool.close()
+        for fname, checksum in zip(fnames, checksums):
+            record = cache._read_checksum_record(fname)
+            assert record['checksum'] == checksum == file_checksum(fname)
+
+    def test_get_missing(self):
+        cache = ScanCache(self.cachedir)
+        assert cache.get('asdfgh') is None
+
+    def test_put_and_get(self):
+        cache = ScanCache(self.cachedir)
+        fname = cache.put('abcd', _FakeScan(10))
+        assert cache.get('abcd') == fname
+        assert os.path.exists(fname)
+
+    def test_lru_eviction(self):
+        cache = ScanCache(self.cachedir + '_lru', max_size=250)
+        cache.put('first', _FakeScan(100))
+        time.sleep(0.02)
+        cache.put('second', _FakeScan(100))
+        time.sleep(0.02)
+        # Use the first entry: the second becomes the least recently used
+        cache.get('first')
+        time.sleep(0.02)
+        cache.put('third', _FakeScan(100))
+        assert cache.get('first') is not None
+        assert cache.get('second') is None
+        assert cache.get('third') is not None
+        assert cache.size() <= 250
+
+    @classmethod
+    def teardown_class(klass):
+        for d in glob.glob(klass.cachedir + '*'):
+            shutil.rmtree(d)
+
+
+class TestScanWithCache(object):
+    @classmethod
+    def setup_class(klass):
+        klass.curdir = os.path.dirname(__file__)
+        klass.datadir = os.path.join(klass.curdir, 'data')
+        klass.fname = \
+            os.path.abspath(os.path.join(klass.datadir, 'gauss_dec',
+                                         'Dec0.fits'))
+        klass.cachedir = os.path.abspath('test_scan_cache_dir')
+        klass.config_file = os.path.abspath('test_cache_config.ini')
+        with open(klass.config_file, 'w') as fobj:
+            print("[local]\n[analysis]\n"
+                  "cache_directory : {}\n".format(klass.cachedir),
+                  file=fobj)
+        read_config(klass.config_file)
+
+    def test_processed_scan_is_cached(self):
+        scan = Scan(self.fname, config_file=self.config_file, nosave=True)
+        key = scan.meta['processing_key']
+        cache = ScanCache(self.cachedir)
+        assert cache.get(key) is not None
+        scan2 = Scan(self.fname, config_file=self.config_file, nosave=True)
+        assert scan2.meta['processing_key'] == key
+        assert scan2.meta['filename'] == self.fname
+
+    def test_different_parameters_are_reprocessed(self):
+        scan = Scan(self.fname, config_file=self.config_file, nosave=True)
+        scan2 = Scan(self.fname, config_file=self.config_file, nosave=True,
+                     nosub=True)
+        assert scan.meta['processing_key'] != scan2.meta['processing_key']
+        scan3 = Scan(self.fname, config_file=self.config_file, nosave=True,
+                     baseline_kind='rough')
+        assert scan.meta['processing_key'] != scan3.meta['processing_key']
+
+    def test_stale_hdf5_is_ignored(self):
+        h5file = self.fname.replace('.fits', '.hdf5')
+        scan = Scan(self.fname, config_file=self.config_file, nosub=True)
+        assert os.path.exists(h5file)
+        scan2 = Scan(self.fname, config_file=self.config_file)
+        assert scan2.meta['processing_key'] != scan.meta['processing_key']
+        os.unlink(h5file)
+
+    @classmethod
+    def teardown_class(klass):
+        shutil.rmtree(klass.cachedir)
+        os.unlink(klass.config_file)
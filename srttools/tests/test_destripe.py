@@ -8,6 +8,8 @@ except ImportError:
     HAS_MPL = False
 
 from srttools.destripe import basket_weaving, destripe_wrapper
+from srttools.diagnostics import set_diagnostics_level
+import os
 np.random.seed(450720239)
 
 
@@ -62,6 +64,24 @@ class TestScanSet(object):
 
         assert np.all(img_clean == img_clean_w)
 
+    def test_wrapper_no_diagnostics_by_default(self):
+        for f in ['img_hor.png', 'img_destr.png']:
+            if os.path.exists(f):
+                os.unlink(f)
+        destripe_wrapper(self.img_hor, self.img_ver)
+        assert not os.path.exists('img_hor.png')
+        assert not os.path.exists('img_destr.png')
+
+    def test_wrapper_diagnostics(self):
+        set_diagnostics_level('summary', background=False)
+        destripe_wrapper(self.img_hor, self.img_ver)
+        set_diagnostics_level('none')
+        if HAS_MPL:
+            for f in ['img_hor.png', 'img_ver.png', 'img_expoh.png',
+                      'img_expov.png', 'img_initial.png', 'img_destr.png']:
+                assert os.path.exists(f)
+                os.unlink(f)
+
     def test_expo(self):
         img_clean = basket_weaving(self.img_hor, self.img_ver,
                                    expo_hor=self.expo_hor,
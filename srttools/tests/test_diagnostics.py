@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division,
+                        print_function)
+
+import srttools.diagnostics as diagnostics
+from srttools.diagnostics import set_diagnostics_level, diagnostic_plot
+from srttools.diagnostics import wait_for_diagnostics, plot_lines
+from srttools.diagnostics import MAX_PENDING_PLOTS, HAS_MPL
+import numpy as np
+import os
+import pytest
+
+
+class TestDiagnostics(object):
+    def test_level_from_environment(self, monkeypatch):
+        monkeypatch.setenv('SRTTOOLS_DIAGNOSTICS', 'Debug')
+        assert diagnostics._level_from_environment() == 2
+        monkeypatch.setenv('SRTTOOLS_DIAGNOSTICS', '1')
+        assert diagnostics._level_from_environment() == 1
+
+    def test_invalid_level_from_environment(self, monkeypatch):
+        monkeypatch.setenv('SRTTOOLS_DIAGNOSTICS', 'yes')
+        with pytest.warns(UserWarning) as record:
+            assert diagnostics._level_from_environment() == 0
+        assert 'Invalid value of SRTTOOLS_DIAGNOSTICS' in \
+            str(record[0].message)
+
+    @pytest.mark.skipif('not HAS_MPL')
+    def test_plots_in_background(self):
+        set_diagnostics_level('debug')
+        x = np.arange(10)
+        fnames = ['diag_{}.png'.format(i)
+                  for i in range(MAX_PENDING_PLOTS * 2)]
+        for fname in fnames:
+            assert diagnostic_plot('summary', fname, plot_lines, x, x)
+        writer = diagnostics._state['writer']
+        assert writer.queue.maxsize == MAX_PENDING_PLOTS
+        wait_for_diagnostics()
+        set_diagnostics_level('none')
+        for fname in fnames:
+            assert os.path.exists(fname)
+            os.unlink(fname)
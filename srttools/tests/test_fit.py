@@ -4,7 +4,9 @@ from __future__ import (absolute_import, division,
                         print_function)
 from srttools.fit import fit_baseline_plus_bell, purge_outliers, align
 from srttools.fit import baseline_rough, ref_mad, ref_std, _rolling_window
-from srttools.fit import linear_fit, offset_fit
+from srttools.fit import baseline_als
+from srttools.fit import linear_fit, offset_fit, _als
+from srttools.fit import contiguous_regions
 
 import numpy as np
 import pytest
@@ -75,6 +77,31 @@ class TestFit(object):
         np.testing.assert_almost_equal(series2[10],
                                        (series[9] + series[11]) / 2)
 
+    def test_outliers_many_intervals(self):
+        """Test that all outlier intervals are filled as in a simple loop."""
+        series = np.copy(self.series)
+        bad = np.zeros(len(series), dtype=bool)
+        bad[[0, 50, 51, 300, 600, 601, 700, 702, len(series) - 1]] = True
+        series[bad] = 20
+
+        expected = np.copy(series)
+        for b in contiguous_regions(bad):
+            if b[0] == 0:
+                expected[b[0]] = expected[b[1]]
+            elif b[1] >= len(expected):
+                expected[b[0]:] = expected[b[0] - 1]
+            else:
+                previous = expected[b[0] - 1]
+                next_bin = expected[b[1]]
+                dx = b[1] - b[0]
+                expected[b[0]:b[1]] = \
+                    (next_bin - previous)/(dx + 1) * \
+                    np.arange(1, b[1] - b[0] + 1) + previous
+
+        with pytest.warns(UserWarning):
+            series2 = purge_outliers(series)
+        assert np.all(series2 == expected)
+
     def test_outliers_bell_larger(self):
         """Test that outlier detection works."""
         series = np.copy(self.series) + _test_shape(self.t)
@@ -180,3 +207,34 @@ class TestFit(object):
             _, err = offset_fit(x, y, 0, return_err=True)
             assert "return_err not implemented" in record[0].message.args[0]
         assert err is None
+
+    def test_als_banded_same_as_sparse(self):
+        x = np.linspace(0, 10, 1000)
+        y = np.random.normal(0, 0.1, 1000) + 0.3 * x + \
+            10 * np.exp(-(x - 5) ** 2)
+        z_banded = _als(y, 1e3, 0.001, solver='banded')
+        z_sparse = _als(y, 1e3, 0.001, solver='sparse')
+        np.testing.assert_allclose(z_banded, z_sparse, rtol=1e-8)
+
+    def test_als_banded_long_array(self):
+        x = np.linspace(0, 10, 200000)
+        y = 0.3 * x + 2
+        z = _als(y, 1e5, 0.001)
+        np.testing.assert_allclose(z, y, rtol=1e-5)
+
+    def test_als_invalid_solver(self):
+        with pytest.raises(ValueError) as excinfo:
+            _als(np.zeros(10), 1e3, 0.001, solver='bubu')
+        assert "Unknown ALS solver" in str(excinfo.value)
+
+    def test_baseline_als_multichannel(self):
+        x = np.linspace(0, 10, 1000)
+        ys = [np.random.normal(0, 0.1, 1000) + slope * x +
+              10 * np.exp(-(x - 5) ** 2) for slope in [0.3, -0.2, 1]]
+        y2d = np.array(ys).T
+        ysub2d, base2d = baseline_als(x, y2d, return_baseline=True)
+        assert ysub2d.shape == y2d.shape
+        for i, y in enumerate(ys):
+            ysub, base = baseline_als(x, y, return_baseline=True)
+            np.testing.assert_allclose(ysub2d[:, i], ysub, atol=1e-6)
+            np.testing.assert_allclose(base2d[:, i], base, atol=1e-6)
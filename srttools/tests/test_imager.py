@@ -15,6 +15,11 @@ from srttools import CalibratorTable
 from srttools.calibration import HAS_STATSM
 from srttools.read_config import read_config
 from srttools.imager import main_imager, main_preprocess
+from srttools.imager import ObservationFollower, _TableBuilder
+from srttools.imager import _load_calibration
+from srttools.archive import ScanArchive
+from srttools.diagnostics import set_diagnostics_level
+from srttools.diagnostics import wait_for_diagnostics
 from srttools.simulate import simulate_map
 from srttools.global_fit import display_intermediate
 from srttools.io import mkdir_p
@@ -28,6 +33,8 @@ import pytest
 import logging
 import subprocess as sp
 import astropy
+from astropy.table import vstack, Table, MaskedColumn
+import astropy.time
 
 try:
     from tqdm import tqdm
@@ -266,10 +273,42 @@ class TestScanSet(object):
 
         imgsel.on_key(fake_event)
 
+    def test_parallel_load_same_as_serial(self):
+        scanset = ScanSet(self.config_file, nproc=2)
+        assert scanset.scan_list == self.scanset.scan_list
+        assert np.all(scanset['Scan_id'] == self.scanset['Scan_id'])
+        for col in ['time', 'ra', 'dec', 'Ch0', 'Ch1']:
+            assert np.allclose(scanset[col], self.scanset[col])
+
+    def test_table_builder_same_as_vstack(self):
+        scans = [Scan(s) for s in self.scanset.scan_list[:3]]
+        builder = _TableBuilder(ntables=2)
+        for s in scans:
+            builder.append(s)
+        table = builder.table()
+        stacked = vstack(scans)
+        assert table.colnames == stacked.colnames
+        for col in ['time', 'ra', 'dec', 'Ch0', 'Ch1']:
+            assert table[col].shape == stacked[col].shape
+            assert np.all(table[col] == stacked[col])
+            assert table[col].unit == stacked[col].unit
+
+    def test_table_builder_keeps_growing(self):
+        builder = _TableBuilder()
+        builder.append(Table({'a': [1., 2.]}))
+        first = builder.table(trim=False)
+        for i in range(5):
+            builder.append(Table({'a': [3., 4.]}))
+        table = builder.table(trim=False)
+        assert list(first['a']) == [1., 2.]
+        assert len(table) == 12
+        assert list(table['a'][:4]) == [1., 2., 3., 4.]
+
     def test_use_command_line(self):
         main_imager(('test.hdf5 -u Jy/beam ' +
                      '--calibrate {}'.format(self.calfile) +
                      ' -o bubu.hdf5 --debug --scrunch-channels').split(' '))
+        set_diagnostics_level('none')
 
     def test_use_command_line_config(self):
         main_imager(['-c', self.config_file])
@@ -285,6 +324,71 @@ class TestScanSet(object):
         assert sorted(scanset.meta['list_of_directories']) == \
             sorted(list(set(scanset.meta['list_of_directories'])))
 
+    def test_archive_roundtrip(self):
+        self.scanset.write_archive('test_archive.hdf5')
+        scanset = ScanSet('test_archive.hdf5')
+        assert scanset.scan_list == self.scanset.scan_list
+        assert np.all(scanset['Scan_id'] == self.scanset['Scan_id'])
+        for col in ['time', 'ra', 'dec', 'Ch0', 'Ch1', 'x', 'y']:
+            assert np.allclose(scanset[col], self.scanset[col])
+        assert scanset.meta['list_of_directories'] == \
+            self.scanset.meta['list_of_directories']
+        os.unlink('test_archive.hdf5')
+
+    def test_archive_partial_read(self):
+        self.scanset.write_archive('test_archive.hdf5')
+        scanset = ScanSet.from_archive('test_archive.hdf5', scans=[0, 2],
+                                       channels=['Ch0'])
+        assert 'Ch1' not in scanset.colnames
+        assert 'Ch0' in scanset.colnames
+        assert sorted(set(scanset['Scan_id'])) == [0, 2]
+        good = (self.scanset['Scan_id'] == 0) | \
+            (self.scanset['Scan_id'] == 2)
+        assert np.allclose(scanset['Ch0'], self.scanset['Ch0'][good])
+        os.unlink('test_archive.hdf5')
+
+    def test_archive_append(self):
+        self.scanset.write_archive('test_archive.hdf5')
+        scan = Scan(self.scanset.scan_list[0])
+        with ScanArchive('test_archive.hdf5') as archive:
+            nscans = len(archive)
+            index = archive.append(scan, name='new_scan')
+            assert index == nscans
+        with ScanArchive('test_archive.hdf5', mode='r') as archive:
+            assert archive.names[-1] == 'new_scan'
+            assert archive.nrows[-1] == len(scan)
+            table = archive.read('new_scan', columns=['time', 'Ch0'])
+            assert table.colnames == ['time', 'Ch0']
+            assert np.allclose(table['Ch0'], scan['Ch0'])
+            assert table['Ch0'].unit == scan['Ch0'].unit
+        os.unlink('test_archive.hdf5')
+
+    def test_archive_masks_strings_and_meta(self):
+        table = Table()
+        table['a'] = MaskedColumn([1., 2., 3.], mask=[False, True, False])
+        table['name'] = [u'Ch0', u'Ch1', u'caf\xe9']
+        table.meta['info'] = {'feeds': [0, 1], 'receiver': 'CCB'}
+        table.meta['obstime'] = astropy.time.Time(57754, format='mjd')
+        with ScanArchive('test_archive_meta.hdf5', mode='w') as archive:
+            archive.append(table, name='table')
+        with ScanArchive('test_archive_meta.hdf5', mode='r') as archive:
+            read = archive.read('table')
+        assert list(read['a'].mask) == [False, True, False]
+        assert list(read['name']) == [u'Ch0', u'Ch1', u'caf\xe9']
+        assert read['name'].dtype.kind == 'U'
+        assert read.meta['info'] == table.meta['info']
+        assert read.meta['obstime'] == table.meta['obstime']
+        os.unlink('test_archive_meta.hdf5')
+
+    def test_archive_unencodable_meta(self):
+        table = Table({'a': [1., 2.]})
+        table.meta['func'] = np.mean
+        with ScanArchive('test_archive_meta.hdf5', mode='w') as archive:
+            with pytest.raises(TypeError) as excinfo:
+                archive.append(table, name='table')
+        assert "cannot be stored" in str(excinfo)
+        os.unlink('test_archive_meta.hdf5')
+
     def test_barycenter_times(self):
         '''Test image production.'''
 
@@ -348,6 +452,20 @@ class TestScanSet(object):
 
         img = images['Ch0']
 
+    def test_direction_images_from_accumulator(self):
+        '''Test that the images in each direction add up to the total.'''
+
+        scanset = ScanSet('test.hdf5')
+        images = scanset.calculate_images()
+        expo = images['Ch0-EXPO']
+        img_sum = images['Ch0'] * expo
+        images_hor = scanset.calculate_images(direction=0)
+        images_ver = scanset.calculate_images(direction=1)
+        assert np.all(images_hor['Ch0-EXPO'] + images_ver['Ch0-EXPO'] == expo)
+        assert np.allclose(images_hor['Ch0'] * images_hor['Ch0-EXPO'] +
+                           images_ver['Ch0'] * images_ver['Ch0-EXPO'],
+                           img_sum)
+
     def test_ver_images(self):
         '''Test image production.'''
 
@@ -378,7 +496,13 @@ class TestScanSet(object):
 
         scanset = ScanSet('test.hdf5')
 
+        set_diagnostics_level('summary')
         images = scanset.calculate_images(altaz=True)
+        set_diagnostics_level('none')
+        wait_for_diagnostics()
+        if HAS_MPL:
+            assert os.path.exists('delta_altaz.png')
+            assert os.path.exists('altaz_with_src.png')
 
         img = images['Ch0']
 
@@ -565,6 +689,28 @@ class TestScanSet(object):
         assert np.allclose(images['Ch0'][good],
                            images_standard['Ch0'][good], rtol=1e-4)
 
+    def test_calibration_error_uses_imaged_samples(self):
+        scanset = ScanSet('test.hdf5')
+        scanset['Ch0-filt'][:len(scanset) // 3] = False
+        scanset.calculate_images(calibration=self.calfile,
+                                 map_unit="Jy/beam", calibrate_scans=True,
+                                 direction=0)
+        sums = scanset.accumulator.meta['cal_rel_err']
+
+        feed = scanset.accumulator.meta['feeds']['Ch0']
+        caltable, _ = _load_calibration(self.calfile, "Jy/beam")
+        good = np.asarray(scanset['Ch0-filt'], dtype=bool)
+        good &= np.asarray(scanset['direction'], dtype=bool)
+        elevation = scanset.coordinates(feed)['el'][good]
+        Jy_over_counts, Jy_over_counts_err = \
+            caltable.Jy_over_counts(channel='Ch0', map_unit="Jy/beam",
+                                    elevation=elevation)
+        expected = np.mean(np.asarray(Jy_over_counts_err / Jy_over_counts))
+
+        total, nsamples = sums[('Ch0', 0)]
+        assert nsamples == np.count_nonzero(good)
+        assert np.isclose(total / nsamples, expected)
+
     def test_ds9_image(self):
         '''Test image production.'''
 
@@ -611,6 +757,59 @@ class TestScanSet(object):
                                  parfile="out_iter_Ch0_002.txt")
         os.path.exists("out_iter_Ch1_002.png")
 
+    def test_global_fit_gradient(self):
+        '''Test the analytic gradient of the global fit objective.'''
+        from scipy.optimize import approx_fprime
+        from srttools.global_fit import _resample_scans, _get_data_idx, \
+            _pixel_binning, _obj_fun_and_grad
+
+        scanset = ScanSet('test.hdf5')
+        counts = np.array(scanset['Ch0'], dtype=np.float64)
+        counts /= np.max(counts) - np.min(counts)
+        idxs = np.array(scanset['Scan_id'], dtype=int)
+        coords = scanset.coordinates(0)
+        data, bx, by = \
+            _resample_scans([np.array(scanset['time'], dtype=np.float64),
+                             idxs, coords['x'], coords['y'], counts])
+        par = np.random.normal(0, 0.01, len(set(idxs)) * 2)
+        data_idx = _get_data_idx(par, data[1])
+        nx, ny = len(bx) - 1, len(by) - 1
+        pix, expo, allowed = \
+            _pixel_binning(data, bx, by, excluded=[[nx//2, ny//2, nx//4]])
+
+        def stat(par):
+            return _obj_fun_and_grad(par, data, data_idx, pix, expo,
+                                     allowed)[0]
+
+        _, grad = _obj_fun_and_grad(par, data, data_idx, pix, expo, allowed)
+        grad_num = approx_fprime(par, stat, 1e-7)
+        assert np.allclose(grad, grad_num, rtol=1e-3,
+                           atol=1e-3 * np.max(np.abs(grad)))
+
+    def test_global_fit_parallel(self):
+        '''Test that channels fit in parallel give the same results.'''
+        scanset = ScanSet('test.hdf5')
+        scanset.fit_full_images(chans='Ch0,Ch1')
+        serial = dict([(ch, np.array(scanset[ch])) for ch in ['Ch0', 'Ch1']])
+
+        scanset = ScanSet('test.hdf5')
+        scanset.fit_full_images(chans='Ch0,Ch1', nproc=2)
+        for ch in ['Ch0', 'Ch1']:
+            assert np.allclose(scanset[ch], serial[ch])
+
+    def test_global_fitter_outdir(self):
+        '''Test that intermediate results are saved in the output dir.'''
+        import tempfile
+        from srttools.global_fit import GlobalFitter
+        outdir = tempfile.mkdtemp()
+        scanset = ScanSet('test.hdf5')
+        fitter = GlobalFitter.from_scanset(scanset, chan='Ch1',
+                                           outdir=outdir)
+        new_counts = fitter.fit()
+        assert len(new_counts) == len(scanset)
+        assert os.path.exists(os.path.join(outdir, 'out_iter_Ch1_000.txt'))
+        shutil.rmtree(outdir)
+
     def test_global_fit_image_fails_mixup_channels(self):
         '''Test image production.'''
 
@@ -676,9 +875,10 @@ class TestScanSet(object):
         images = scanset.calculate_images()
         ysize, xsize = images['Ch0'].shape
         x, y = xsize // 2, 0
+        coords = scanset.coordinates(0)
         good_entries = np.logical_and(
-                np.abs(scanset['x'][:, 0] - x) < 1,
-                np.abs(scanset['y'][:, 0] - y) < 1)
+                np.abs(coords['x'] - x) < 1,
+                np.abs(coords['y'] - y) < 1)
 
         sids = list(set(scanset['Scan_id'][good_entries]))
         scanset.scan_list[sids[0]] = 'skd'
@@ -755,6 +955,28 @@ class TestScanSet(object):
         assert np.all(after == s['Ch0'])
         os.unlink(sname.replace('fits', 'hdf5'))
 
+    def test_update_scan_updates_accumulator(self):
+        scanset = ScanSet('test.hdf5')
+
+        images = scanset.calculate_images()
+        ysize, xsize = images['Ch0'].shape
+        ra_xs, ra_ys, dec_xs, dec_ys, scan_ids, ra_masks, dec_masks, coord = \
+            scanset.find_scans_through_pixel(xsize//2, 0, test=True)
+
+        sname = list(scan_ids.keys())[0]
+
+        info = {sname: copy.copy(self.stdinfo)}
+        info[sname]['fitpars'] = np.array([0.1, 0.3])
+        scanset.update_scan(sname, scan_ids[sname], coord[sname],
+                            info[sname]['zap'],
+                            info[sname]['fitpars'], info[sname]['FLAG'],
+                            test=True)
+        updated = scanset._images_from_accumulator()
+        recalculated = scanset.calculate_images()
+        for key in ['Ch0', 'Ch0-Sdev', 'Ch0-EXPO']:
+            assert np.allclose(updated[key], recalculated[key])
+        os.unlink(sname.replace('fits', 'hdf5'))
+
     def test_update_scan_zap(self):
         scanset = ScanSet('test.hdf5')
 
@@ -783,6 +1005,61 @@ class TestScanSet(object):
                                                               dtype=bool))
         os.unlink(sname.replace('fits', 'hdf5'))
 
+    def test_follow_observation(self):
+        '''Test that the map is updated as new scans are written.'''
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        config_file = os.path.join(tmpdir, 'follow.ini')
+        sim_config_file(config_file)
+
+        follower = ObservationFollower(config_file, nproc=2)
+        assert follower.update() == 0
+        assert follower.scanset is None
+
+        npix = None
+        for obsdir in [self.obsdir_ra, self.obsdir_dec]:
+            outdir = os.path.join(tmpdir, os.path.basename(obsdir))
+            mkdir_p(outdir)
+            files = sorted(glob.glob(os.path.join(obsdir, '*.fits')))
+            for f in files:
+                shutil.copy(f, outdir)
+            # Files are processed only when they stop growing
+            assert follower.update() == 0
+            assert len(follower.pending) == len(files)
+            assert follower.update() == len(files)
+            assert follower.pending == []
+            # The grid is fixed by the first scans
+            if npix is None:
+                npix = follower.scanset.meta['npix']
+            assert np.all(follower.scanset.meta['npix'] == npix)
+
+        images = follower.scanset._images_from_accumulator()
+        follower.save_images(save_sdev=True)
+        assert os.path.exists(config_file.replace('.ini', '.fits'))
+
+        # Same images as processing all the scans at once on the same grid
+        scanset = ScanSet(config_file)
+        for key in ['min_ra', 'max_ra', 'min_dec', 'max_dec',
+                    'reference_ra', 'reference_dec']:
+            scanset.meta[key] = follower.scanset.meta[key]
+        scanset.convert_coordinates()
+        images_all = scanset.calculate_images()
+        for key in ['Ch0', 'Ch0-Sdev', 'Ch0-EXPO']:
+            assert np.allclose(images[key], images_all[key])
+        shutil.rmtree(tmpdir)
+
+    def test_imager_follow_no_scans(self):
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        config_file = os.path.join(tmpdir, 'follow.ini')
+        sim_config_file(config_file)
+        with pytest.raises(ValueError) as excinfo:
+            main_imager(['-c', config_file, '--follow',
+                         '--follow-interval', '0',
+                         '--follow-timeout', '0'])
+        assert "No scans were found" in str(excinfo)
+        shutil.rmtree(tmpdir)
+
     def test_preprocess_no_config(self):
         with pytest.raises(ValueError) as excinfo:
             main_preprocess([])
@@ -795,6 +1072,10 @@ class TestScanSet(object):
     def test_preprocess_config(self):
         main_preprocess(['-c', self.config_file])
 
+    def test_preprocess_single_files_parallel(self):
+        files = glob.glob(os.path.join(self.obsdir_ra, '*.fits'))
+        main_preprocess(files[:2] + ['--nproc', '2'])
+
     def test_imager_no_config(self):
         with pytest.raises(ValueError) as excinfo:
             main_imager([])
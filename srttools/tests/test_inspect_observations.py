@@ -1,6 +1,8 @@
 from srttools.inspect_observations import split_observation_table
 from srttools.inspect_observations import dump_config_files
 from srttools.inspect_observations import main_inspector
+from srttools.inspect_observations import ObservationCatalog
+from srttools.inspect_observations import inspect_directories
 from astropy.table import Table, Column
 import numpy as np
 import os
@@ -124,6 +126,11 @@ class TestRun(object):
 
         klass.curdir = os.path.dirname(__file__)
         klass.datadir = os.path.join(klass.curdir, 'data')
+        # Catalog used by the tests not building their own
+        klass.catalog_file = 'test_run_catalog.db'
+        catalog = ObservationCatalog(klass.catalog_file)
+        catalog.update(glob.glob(os.path.join(klass.datadir, 'gauss_*/')))
+        catalog.close()
 
     def test_script_is_installed(self):
         sp.check_call('SDTinspect -h'.split(' '))
@@ -154,11 +161,56 @@ class TestRun(object):
                        '--only-before 21000101-000000'.split(' '))
         assert 'Filter out observations after MJD 88069' in caplog.text
 
+    def test_inspect_parallel_same_order(self):
+        dirs = sorted(glob.glob(os.path.join(self.datadir, 'gauss_*/')))
+        dirs = dirs + dirs[::-1]
+        serial = inspect_directories(dirs)
+        parallel = inspect_directories(dirs, jobs=3)
+        assert list(parallel['Dir']) == list(serial['Dir'])
+        assert np.all(parallel['Time'] == serial['Time'])
+
+    def test_run_parallel(self, capsys):
+        main_inspector(glob.glob(os.path.join(self.datadir, 'gauss_*/')) +
+                       ['-j', '2', '--only-after', '20000101-000000'])
+        out, err = capsys.readouterr()
+        assert 'Dummy' in out
+
+    def test_run_catalog(self):
+        dirs = glob.glob(os.path.join(self.datadir, 'gauss_*/'))
+        main_inspector(dirs + ['--catalog', 'catalog.db'])
+        assert os.path.exists('table.csv')
+
+        catalog = ObservationCatalog('catalog.db')
+        # Nothing changed: nothing to inspect
+        assert catalog.update(dirs) == 0
+        info = catalog.query(directories=dirs)
+        assert len(info) == len(dirs)
+        assert np.all(info['Source'] == 'Dummy')
+        assert len(catalog.query(source='Dummy', backend='TP')) == len(dirs)
+        assert len(catalog.query(source='asdfgh')) == 0
+        assert len(catalog.query(only_before='20000101-000000')) == 0
+        groups = split_observation_table(catalog)
+        assert 'Dummy' in groups['CCB,TP']
+        catalog.close()
+
+    def test_run_catalog_only(self, capsys):
+        main_inspector(['--catalog', self.catalog_file, '--source',
+                        'Dummy'])
+        out, err = capsys.readouterr()
+        assert 'gauss_dec' in out
+
+    def test_run_source_without_catalog_fails(self):
+        with pytest.raises(SystemExit):
+            main_inspector(glob.glob(os.path.join(self.datadir, 'gauss_*/')) +
+                           ['--source', 'Dummy'])
+
     @classmethod
     def teardown_class(cls):
         """Cleanup."""
         import os
         os.unlink('TP_Dummy_Obs0.ini')
+        os.unlink('catalog.db')
+        os.unlink(cls.catalog_file)
         os.unlink('CCB_TP_Dummy_Obs0.ini')
         os.unlink('table.csv')
         os.unlink('sample_config_file.ini')
@@ -5,13 +5,21 @@ from __future__ import (absolute_import, division,
 
 from srttools.read_config import read_config
 from astropy.time import Time
+from astropy.table import Table
 from astropy.coordinates import SkyCoord
 import astropy.units as u
 import pytest
 
-from srttools.scan import Scan, HAS_MPL
-from srttools.io import print_obs_info_fitszilla
-from srttools.io import locations
+from srttools.scan import Scan, HAS_MPL, _clean_dyn_spec
+from srttools.scan import _compact_coordinates
+from srttools.scan import clean_scan_using_variability
+from srttools.scan import clean_spectra_using_variability
+from srttools.fit import contiguous_regions
+from srttools.io import print_obs_info_fitszilla, read_data_fitszilla
+from srttools.io import read_obs_info_fitszilla
+from srttools.io import read_spectrum_chunks, BackgroundWriter
+from srttools.io import locations, FeedCoordinates
+from srttools.io import round_mantissa
 import os
 import numpy as np
 import glob
@@ -88,6 +96,124 @@ class Test1_Scan(object):
         for m in scan_from_table.meta.keys():
             assert scan_from_table.meta[m] == scan.meta[m]
 
+    def test_scan_background_save(self):
+        h5file = self.fname.replace('.fits', '.hdf5')
+        if os.path.exists(h5file):
+            os.unlink(h5file)
+        with BackgroundWriter() as writer:
+            scan = Scan(self.fname, norefilt=False, writer=writer)
+            # The scan can be modified while it is being saved
+            scan['Ch0'][:] = 0
+        saved = Scan(h5file)
+        assert not np.all(saved['Ch0'] == 0)
+        assert np.all(saved['time'] == scan['time'])
+
+    def test_background_save_error_is_raised(self):
+        scan = Scan(self.fname)
+        writer = BackgroundWriter()
+        scan.save('scan.hdf5', writer=writer)
+        scan.save('scan.fits', writer=writer)
+        with pytest.raises(TypeError):
+            writer.flush()
+        writer.close()
+        assert os.path.exists('scan.hdf5')
+
+    def test_scan_compressed_single_precision(self):
+        scan = Scan(self.fname)
+        # Only counts in double precision are converted
+        scan['Ch0'] = scan['Ch0'].astype(np.float64)
+        scan.write('scan_compressed.hdf5', overwrite=True, compression='gzip',
+                   precision='single', keep_bits=16)
+        saved = Scan('scan_compressed.hdf5')
+        assert 'reduced_precision_columns' not in saved.meta
+        assert saved['Ch0'].dtype == np.float64
+        assert saved['ra'].dtype == np.float64
+        assert np.all(saved['time'] == scan['time'])
+        assert np.allclose(saved['Ch0'], scan['Ch0'], rtol=2. ** -16)
+        # Coordinates are not rounded
+        assert np.all(saved['ra'] == scan['ra'])
+        os.unlink('scan_compressed.hdf5')
+
+    def test_scan_storage_options_from_meta(self):
+        scan = Scan(self.fname)
+        scan.meta['storage_precision'] = 'single'
+        scan.write('scan_single.hdf5', overwrite=True)
+        raw = Table.read('scan_single.hdf5', path='scan')
+        assert raw['Ch0'].dtype == np.float32
+        assert raw['time'].dtype == np.float64
+        assert raw['ra'].dtype == np.float64
+        saved = Scan('scan_single.hdf5')
+        assert np.allclose(saved['Ch0'], scan['Ch0'], rtol=2. ** -23)
+        os.unlink('scan_single.hdf5')
+
+    def test_round_mantissa(self):
+        values = np.random.uniform(-1e10, 1e10, 1000)
+        for keep_bits in [0, 5, 10, 23]:
+            rounded = round_mantissa(values, keep_bits)
+            assert np.all(np.abs(rounded / values - 1) <=
+                          2. ** -(keep_bits + 1))
+
+    def test_clean_dyn_spec(self):
+        dynspec = np.random.normal(0, 1, (30, 200))
+        bad = np.random.uniform(0, 1, 200) < 0.2
+        bad[:2] = True
+        bad[-3:] = True
+        bad_intervals = contiguous_regions(bad)
+
+        expected = dynspec.copy()
+        for b in bad_intervals:
+            if b[0] == 0:
+                fill_lc = dynspec[:, b[1]]
+            elif b[1] >= dynspec.shape[1]:
+                fill_lc = dynspec[:, b[0]]
+            else:
+                fill_lc = (dynspec[:, b[0] - 1] + dynspec[:, b[1]]) / 2
+            for bsub in range(b[0], min(b[1], dynspec.shape[1])):
+                expected[:, bsub] = fill_lc
+
+        cleaned = _clean_dyn_spec(dynspec, bad_intervals)
+        assert np.all(cleaned == expected)
+        assert np.all(cleaned[:, ~bad] == dynspec[:, ~bad])
+
+    @pytest.mark.parametrize('chunk_size', [1, 37, 1000])
+    def test_clean_scan_in_chunks(self, chunk_size):
+        dynspec = np.random.normal(100, 1, (500, 64))
+        dynspec[:, 20] += np.random.normal(0, 30, 500)
+        dynspec[:, 40:43] += np.random.normal(0, 30, (500, 3))
+        original = dynspec.copy()
+        results = clean_scan_using_variability(dynspec, 50, 1000,
+                                               debug=False)
+        chunked = clean_scan_using_variability(dynspec, 50, 1000,
+                                               debug=False,
+                                               chunk_size=chunk_size)
+        assert np.allclose(results.lc, chunked.lc)
+        assert results.freqmin == chunked.freqmin
+        assert results.freqmax == chunked.freqmax
+        assert np.all(dynspec == original)
+
+    def test_clean_spectra_together(self):
+        dynspecs = np.random.normal(100, 1, (3, 500, 64))
+        dynspecs[0, :, 20] += np.random.normal(0, 30, 500)
+        dynspecs[2, :, 40:43] += np.random.normal(0, 30, (500, 3))
+        batch = clean_spectra_using_variability(dynspecs, 50, 1000,
+                                                debug=False, chunk_size=100)
+        assert len(batch) == 3
+        for dynspec, results in zip(dynspecs, batch):
+            single = clean_scan_using_variability(dynspec, 50, 1000,
+                                                  debug=False)
+            assert np.allclose(single.lc, results.lc)
+            assert single.freqmin == results.freqmin
+            assert single.freqmax == results.freqmax
+
+    def test_scan_pickle(self):
+        '''Test that scans can be sent to other processes.'''
+        import pickle
+        scan = Scan(self.fname)
+        unpickled = pickle.loads(pickle.dumps(scan))
+        assert isinstance(unpickled, Scan)
+        for c in scan.columns:
+            assert np.all(unpickled[c] == scan[c])
+
     @pytest.mark.skipif('not HAS_MPL')
     def test_interactive(self):
         scan = Scan(self.fname)
@@ -99,20 +225,133 @@ class Test1_Scan(object):
         scan = Scan(os.path.join(self.datadir, fname))
         obstimes = Time(scan['time'] * u.day, format='mjd', scale='utc')
         idx = 1 if '_multif' in fname else 0
-        ref_coords = SkyCoord(ra=scan['ra'][:, idx],
-                              dec=scan['dec'][:, idx],
+        coords = scan.coordinates(idx)
+        ref_coords = SkyCoord(ra=coords['ra'] * u.rad,
+                              dec=coords['dec'] * u.rad,
                               obstime=obstimes,
                               location=locations[scan.meta['site']]
                               )
         altaz = ref_coords.altaz
 
         diff = np.abs(
-             (altaz.az.to(u.rad) - scan['az'][:, idx]).to(u.arcsec).value)
+             (altaz.az.to(u.rad) - coords['az'] * u.rad).to(u.arcsec).value)
         assert np.all(diff < 1)
         diff = np.abs(
-            (altaz.alt.to(u.rad) - scan['el'][:, idx]).to(u.arcsec).value)
+            (altaz.alt.to(u.rad) - coords['el'] * u.rad).to(u.arcsec).value)
         assert np.all(diff < 1)
 
+    @pytest.mark.parametrize('fname', ['med_data.fits',
+                                       'srt_data_tp_multif.fits',
+                                       os.path.join('spectrum',
+                                                    'srt_data.fits')])
+    def test_read_obs_info_same_as_read_data(self, fname):
+        fname = os.path.join(self.datadir, fname)
+        data = read_data_fitszilla(fname)
+        info = read_obs_info_fitszilla(fname)
+        for key in ['SOURCE', 'receiver', 'backend']:
+            assert info[key] == data.meta[key]
+        for key in ['frequency', 'bandwidth']:
+            assert info[key] == data['Ch0'].meta[key]
+        assert info['time_start'] == data['time'][0]
+        assert info['time_end'] == data['time'][-1]
+
+    def test_coordinate_modes_agree(self):
+        fname = os.path.join(self.datadir, 'srt_data_tp_multif.fits')
+        stacked = read_data_fitszilla(fname, coord_mode='stacked')
+        per_feed = read_data_fitszilla(fname, coord_mode='feed')
+        for col in ['ra', 'dec', 'az', 'el']:
+            assert np.allclose(stacked[col], per_feed[col], rtol=0,
+                               atol=1e-12)
+
+    def test_feed_coordinates_lazy(self):
+        fname = os.path.join(self.datadir, 'srt_data_tp_multif.fits')
+        data = read_data_fitszilla(fname)
+        xoffsets = np.array([0., 0.01, 0.]) * u.rad
+        yoffsets = np.array([0., 0., 0.01]) * u.rad
+        coords = FeedCoordinates(data['time'], data['ra'][:, 0],
+                                 data['dec'][:, 0], data['az'][:, 0],
+                                 data['el'][:, 0], data['derot_angle'],
+                                 xoffsets, yoffsets, data.meta['site'])
+        assert coords.off_axis == [1, 2]
+        # Feeds with no offsets share the boresight arrays
+        assert coords.feed(0) is coords.boresight
+        assert coords._cache == {}
+        columns, feed_columns = coords.columns([0, 1])
+        assert columns['ra'].shape == (len(data), 2)
+        assert list(coords._cache.keys()) == [1]
+        assert not np.allclose(columns['ra'][:, 1], columns['ra'][:, 0])
+        # Feeds with offsets that were not requested are not stored
+        assert feed_columns == {0: 0, 1: 1}
+        # Feeds with no offsets share the boresight column
+        columns, feed_columns = coords.columns([0, 2])
+        assert columns['ra'].shape == (len(data), 2)
+        assert feed_columns == {0: 0, 2: 1}
+        columns, feed_columns = coords.columns([0, 1])
+        per_feed = FeedCoordinates(data['time'], data['ra'][:, 0],
+                                   data['dec'][:, 0], data['az'][:, 0],
+                                   data['el'][:, 0], data['derot_angle'],
+                                   xoffsets, yoffsets, data.meta['site'],
+                                   mode='feed')
+        for coord in ['ra', 'dec', 'az', 'el']:
+            assert np.allclose(per_feed.feed(1)[coord],
+                               columns[coord][:, 1], rtol=0, atol=1e-12)
+
+    def test_scan_coordinates_of_unstored_feed(self):
+        fname = os.path.join(self.datadir, 'srt_data_tp_multif.fits')
+        scan = Scan(read_data_fitszilla(fname))
+        stored = scan.coordinates(3)
+        del scan.meta['feed_columns'][3]
+        computed = scan.coordinates(3)
+        for coord in ['ra', 'dec', 'az', 'el']:
+            assert np.allclose(computed[coord], stored[coord], rtol=0,
+                               atol=1e-12)
+
+    def test_compact_coordinates_of_old_scans(self):
+        fname = os.path.join(self.datadir, 'srt_data_tp_multif.fits')
+        data = read_data_fitszilla(fname)
+        full = np.array(data['ra'])
+        # Old scans have no column map, and a column for each feed
+        del data.meta['feed_columns']
+        for i in range(4, 14):
+            del data['Ch{}'.format(i)]
+            del data['Ch{}_feed'.format(i)]
+        _compact_coordinates(data)
+        assert data.meta['feed_columns'] == {0: 0, 1: 1}
+        assert data['ra'].shape == (len(data), 2)
+        assert np.all(data['ra'] == full[:, :2])
+
+    def test_coordinate_mode_invalid(self):
+        fname = os.path.join(self.datadir, 'srt_data_tp_multif.fits')
+        with pytest.raises(ValueError) as excinfo:
+            read_data_fitszilla(fname, coord_mode='asdfgh')
+        assert 'Unknown coordinate correction mode' in str(excinfo.value)
+
+    def test_spectrum_chunk_size_does_not_change_data(self):
+        fname = os.path.join(self.datadir, 'spectrum', 'srt_data.fits')
+        full = read_data_fitszilla(fname)
+        chunked = read_data_fitszilla(fname, chunk_size=7)
+        for ch in ['Ch0', 'Ch1']:
+            assert np.all(full[ch] == chunked[ch])
+            assert full[ch].dtype == chunked[ch].dtype
+
+    def test_read_spectrum_chunks(self):
+        fname = os.path.join(self.datadir, 'spectrum', 'srt_data.fits')
+        full = read_data_fitszilla(fname)
+        nrows = 0
+        for start, stop, chunk in read_spectrum_chunks(fname, chunk_size=7):
+            assert stop - start <= 7
+            assert np.all(chunk['time'] == full['time'][start:stop])
+            for ch in ['Ch0', 'Ch1']:
+                assert np.all(chunk[ch] == full[ch][start:stop])
+            nrows += stop - start
+        assert nrows == len(full)
+
+    def test_read_spectrum_chunks_invalid(self):
+        fname = os.path.join(self.datadir, 'srt_data_tp_multif.fits')
+        with pytest.raises(ValueError) as excinfo:
+            list(read_spectrum_chunks(fname))
+        assert 'does not contain spectral data' in str(excinfo.value)
+
     @classmethod
     def teardown_class(klass):
         """Cleanup."""
@@ -181,23 +420,41 @@ class Test2_Scan(object):
                 ["Don't use filtering factors > 0.5" in r.message.args[0]
                  for r in record])
 
+    def test_scan_multiband_splat(self):
+        h5file = self.fname.replace('.fits', '.hdf5')
+        if os.path.exists(h5file):
+            os.unlink(h5file)
+        scan = Scan(self.fname, norefilt=False, nosave=True,
+                    freqsplat='50:150,200:300')
+        chans = list(scan.chan_columns())
+        assert 'Ch0_b0' in chans and 'Ch0_b1' in chans
+        assert 'Ch0' not in scan.colnames
+        assert 'Ch0_feed' not in scan.colnames
+        for ch in chans:
+            assert ch + '_feed' in scan.colnames
+            assert ch + '-filt' in scan.colnames
+            assert scan[ch].meta['bandwidth'] == 100
+        assert scan['Ch0_b1'].meta['band'] == [200, 300]
+        assert not np.all(scan['Ch0_b0'] == scan['Ch0_b1'])
+
     @pytest.mark.parametrize('fname', ['srt_data.fits'])
     def test_coordinate_conversion_works(self, fname):
         scan = Scan(os.path.join(self.datadir, 'spectrum', fname), debug=True)
         obstimes = Time(scan['time'] * u.day, format='mjd', scale='utc')
         idx = 1 if '_multif' in fname else 0
-        ref_coords = SkyCoord(ra=scan['ra'][:, idx],
-                              dec=scan['dec'][:, idx],
+        coords = scan.coordinates(idx)
+        ref_coords = SkyCoord(ra=coords['ra'] * u.rad,
+                              dec=coords['dec'] * u.rad,
                               obstime=obstimes,
                               location=locations[scan.meta['site']]
                               )
         altaz = ref_coords.altaz
 
         diff = np.abs(
-            (altaz.az.to(u.rad) - scan['az'][:, idx]).to(u.arcsec).value)
+            (altaz.az.to(u.rad) - coords['az'] * u.rad).to(u.arcsec).value)
         assert np.all(diff < 1)
         diff = np.abs(
-            (altaz.alt.to(u.rad) - scan['el'][:, idx]).to(u.arcsec).value)
+            (altaz.alt.to(u.rad) - coords['el'] * u.rad).to(u.arcsec).value)
         assert np.all(diff < 1)
 
     @classmethod
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division,
+                        print_function)
+
+from srttools.rolling import rolling_mean, rolling_std, rolling_median
+from srttools.rolling import rolling_mad, median_filter, _rolling_median_mad
+from srttools.rolling import _rolling_rank
+from srttools.fit import _rolling_window, ref_mad, ref_std
+from srttools.utils import mad
+from scipy.ndimage import median_filter as scipy_median_filter
+import numpy as np
+import pytest
+
+
+class TestRolling(object):
+    @classmethod
+    def setup_class(klass):
+        klass.a = np.random.normal(0, 1, 2000)
+        # Many repeated values
+        klass.a_int = np.random.randint(0, 5, 2000).astype(float)
+
+    @pytest.mark.parametrize('window', [1, 2, 7, 20, 101])
+    def test_rolling_mean_std(self, window):
+        rows = _rolling_window(self.a + 1000, window)
+        assert np.allclose(rolling_mean(self.a + 1000, window),
+                           np.mean(rows, axis=1))
+        assert np.allclose(rolling_std(self.a + 1000, window),
+                           np.std(rows, axis=1))
+
+    @pytest.mark.parametrize('window', [1, 2, 7, 20, 101])
+    def test_rolling_median_mad(self, window):
+        for a in [self.a, self.a_int]:
+            rows = _rolling_window(a, window)
+            medians = np.zeros(len(a) - window + 1)
+            mads = np.zeros(len(a) - window + 1)
+            # Test the kernel, whatever the window
+            _rolling_median_mad(a, window, medians, mads, True)
+            assert np.allclose(medians, np.median(rows, axis=1))
+            assert np.allclose(rolling_median(a, window),
+                               np.median(rows, axis=1))
+            expected = np.median(
+                np.abs(rows - np.median(rows, axis=1)[:, np.newaxis]),
+                axis=1)
+            assert np.allclose(mads, expected)
+            assert np.allclose(rolling_mad(a, window), mad(rows, axis=1),
+                               rtol=1e-4)
+
+    @pytest.mark.parametrize('window', [1, 4, 5, 20, 30, 101])
+    def test_median_filter(self, window):
+        assert np.allclose(median_filter(self.a, window),
+                           scipy_median_filter(self.a, window))
+
+    @pytest.mark.parametrize('window', [1, 2, 7, 20])
+    def test_rolling_rank(self, window):
+        for a in [self.a, self.a_int]:
+            rows = np.sort(_rolling_window(a, window), axis=1)
+            for rank in range(window):
+                result = np.zeros(len(a) - window + 1)
+                _rolling_rank(a, window, rank, result)
+                assert np.all(result == rows[:, rank])
+
+    def test_invalid_window(self):
+        with pytest.raises(ValueError):
+            rolling_median(self.a[:10], 11)
+        with pytest.raises(ValueError):
+            rolling_std(self.a[:10], 0)
+
+    def test_ref_mad_ref_std(self):
+        rows = _rolling_window(self.a, 20)
+        assert np.isclose(ref_mad(self.a, 20),
+                          np.median(mad(rows, axis=1)), rtol=1e-4)
+        assert np.isclose(ref_std(self.a, 20), np.min(np.std(rows, axis=1)))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import (absolute_import, division,
+                        print_function)
+
+from srttools.transforms import altaz_to_icrs, source_altaz, utc_to_tdb
+from srttools.transforms import clear_transform_cache, DEFAULT_TOLERANCE
+from srttools.transforms import _node_cache, _unit_vectors, _angle_between
+from srttools.io import locations
+from astropy.time import Time
+from astropy.coordinates import SkyCoord, AltAz, ICRS, Angle
+import astropy.units as u
+import numpy as np
+
+
+class TestTransforms(object):
+    @classmethod
+    def setup_class(klass):
+        # Ten minutes sampled every 40 ms
+        klass.mjd = 57500.3 + np.arange(0, 600, 0.04) / 86400
+        klass.tol = DEFAULT_TOLERANCE.to(u.rad).value
+
+    def test_source_altaz(self):
+        clear_transform_cache()
+        az, el = source_altaz(1.2 * u.rad, 0.5 * u.rad, self.mjd, 'srt')
+        coords = SkyCoord(ra=1.2 * u.rad, dec=0.5 * u.rad,
+                          obstime=Time(self.mjd, format='mjd', scale='utc'),
+                          location=locations['srt']).altaz
+        diff = _angle_between(_unit_vectors(az, el),
+                              _unit_vectors(coords.az.rad, coords.alt.rad))
+        assert np.all(diff < self.tol)
+
+    def test_source_altaz_grid_is_cached(self):
+        clear_transform_cache()
+        source_altaz(1.2, 0.5, self.mjd[:1000], 'srt')
+        nodes = sum([len(v) for v in _node_cache.values()])
+        source_altaz(1.2, 0.5, self.mjd[:1000], 'srt')
+        assert sum([len(v) for v in _node_cache.values()]) == nodes
+        source_altaz(1.2, 0.5, self.mjd, 'srt')
+        assert sum([len(v) for v in _node_cache.values()]) > nodes
+
+    def test_cache_forgets_least_recently_used(self, monkeypatch):
+        import srttools.transforms as transforms
+        clear_transform_cache()
+        source_altaz(1.2, 0.5, self.mjd[:1000], 'srt')
+        nodes = sum([len(v) for v in _node_cache.values()])
+        monkeypatch.setattr(transforms, 'MAX_CACHED_NODES', nodes + 1)
+        source_altaz(1.0, 0.5, self.mjd[:1000], 'srt')
+        assert len(_node_cache) == 1
+        assert sum([len(v) for v in _node_cache.values()]) == nodes
+        # The remaining grid is the most recently used
+        assert list(_node_cache.keys())[0][2] == 1.0
+        clear_transform_cache()
+
+    def test_utc_to_tdb(self):
+        tdb = utc_to_tdb(self.mjd, site='srt')
+        exact = Time(self.mjd, format='mjd', scale='utc',
+                     location=locations['srt']).tdb.mjd
+        assert np.allclose(tdb, exact, rtol=0, atol=1e-6 / 86400)
+
+    def test_utc_to_tdb_leap_second(self):
+        # A leap second was added at the end of 2016
+        mjd = 57754 + np.arange(-3600, 3600, 0.5) / 86400
+        tdb = utc_to_tdb(mjd)
+        exact = Time(mjd, format='mjd', scale='utc').tdb.mjd
+        assert np.allclose(tdb, exact, rtol=0, atol=1e-6 / 86400)
+
+    def test_altaz_to_icrs(self):
+        n = len(self.mjd)
+        az = np.radians(np.stack([np.linspace(30, 32, n),
+                                  np.linspace(30.1, 32.1, n)], axis=-1))
+        el = np.radians(np.stack([np.zeros(n) + 50,
+                                  np.zeros(n) + 50.1], axis=-1))
+        # Add a turnaround: the interpolation is not valid everywhere
+        az[n // 2:] = az[n // 2] - (az[n // 2:] - az[n // 2])
+        ra, dec = altaz_to_icrs(az, el, self.mjd, 'srt')
+        assert ra.shape == az.shape
+        for f in range(2):
+            coords = AltAz(az=Angle(az[:, f] * u.rad),
+                           alt=Angle(el[:, f] * u.rad),
+                           location=locations['srt'],
+                           obstime=Time(self.mjd, format='mjd', scale='utc'))
+            coords = coords.transform_to(ICRS())
+            diff = _angle_between(_unit_vectors(ra[:, f], dec[:, f]),
+                                  _unit_vectors(coords.ra.rad,
+                                                coords.dec.rad))
+            assert np.all(diff < self.tol)
+
+    def test_altaz_to_icrs_exact(self):
+        az = np.radians(np.linspace(30, 32, 100))
+        el = np.radians(np.zeros(100) + 50)
+        ra, dec = altaz_to_icrs(az, el, self.mjd[:100], 'srt',
+                                tolerance=None)
+        coords = AltAz(az=Angle(az * u.rad), alt=Angle(el * u.rad),
+                       location=locations['srt'],
+                       obstime=Time(self.mjd[:100], format='mjd',
+                                    scale='utc')).transform_to(ICRS())
+        assert np.allclose(ra, coords.ra.rad, rtol=0, atol=1e-12)
+        assert np.allclose(dec, coords.dec.rad, rtol=0, atol=1e-12)
@@ -0,0 +1,379 @@
+"""Fast coordinate and time transformations for long series of samples.
+
+Full astropy frame and time scale transformations are expensive, and they
+are often needed for every sample of a scan. The quantities involved vary
+smoothly in time, so here the exact transformation is calculated on a coarse
+time grid and interpolated linearly at the sample times.
+
+Time-only quantities (the horizontal coordinates of a fixed source and the
+TDB time scale) are calculated on grids aligned to multiples of the step,
+and the values at the grid nodes are cached by site and source, so that the
+grids are shared by all the scans (and feeds) of an observation. When the
+cache holds more than ``MAX_CACHED_NODES`` nodes, the least recently used
+grids are forgotten.
+The step is chosen from the required tolerance, using a bound on the second
+derivative of the transformation.
+
+The transformation of arbitrary horizontal coordinates (e.g., the pointing
+of a feed) is calculated exactly on a subset of samples and interpolated;
+the result is checked against the exact transformation in the middle of
+each interval, and the intervals not satisfying the tolerance are
+transformed exactly.
+"""
+from __future__ import (absolute_import, division,
+                        print_function)
+import threading
+from collections import OrderedDict
+import numpy as np
+import astropy.units as u
+from astropy.time import Time
+from astropy.coordinates import AltAz, ICRS, SkyCoord, Angle
+
+__all__ = ["altaz_to_icrs", "source_altaz", "utc_to_tdb",
+           "clear_transform_cache", "DEFAULT_TOLERANCE"]
+
+DEFAULT_TOLERANCE = 0.01 * u.arcsec
+
+# Angular velocity of the Earth, in rad/s
+_EARTH_OMEGA = 7.292115e-5
+# Largest step of the grids (s), to limit the effect of slower terms (e.g.
+# annual aberration and precession) that are not in the bound
+_MAX_STEP = 60.
+_DAY = 86400.
+
+# Maximum number of grid nodes in the cache
+MAX_CACHED_NODES = 100000
+
+# Grid nodes by grid, from the least to the most recently used
+_node_cache = OrderedDict()
+_node_cache_lock = threading.Lock()
+
+
+def clear_transform_cache():
+    """Forget all the cached grid nodes."""
+    with _node_cache_lock:
+        _node_cache.clear()
+
+
+def _evict_nodes(current, nodes):
+    """Forget the least recently used grids, if the cache is too large.
+
+    The ``current`` grid is kept; if it is too large by itself, only its
+    ``nodes`` are kept. Must be called with the lock held.
+    """
+    total = sum([len(v) for v in _node_cache.values()])
+    for key in list(_node_cache.keys()):
+        if total <= MAX_CACHED_NODES:
+            return
+        if key != current:
+            total -= len(_node_cache.pop(key))
+    if total > MAX_CACHED_NODES:
+        store = _node_cache[current]
+        _node_cache[current] = dict([(n, store[n]) for n in nodes])
+
+
+def _to_rad(angle):
+    if hasattr(angle, 'unit'):
+        return angle.to(u.rad).value
+    return np.asarray(angle, dtype=float)
+
+
+def _unit_vectors(lon, lat):
+    """Cartesian unit vectors, with the xyz components on the last axis."""
+    coslat = np.cos(lat)
+    return np.stack([coslat * np.cos(lon), coslat * np.sin(lon),
+                     np.sin(lat)], axis=-1)
+
+
+def _lonlat(vectors):
+    """Inverse of :func:`_unit_vectors` (vectors need not be normalized)."""
+    x, y, z = vectors[..., 0], vectors[..., 1], vectors[..., 2]
+    lon = np.arctan2(y, x) % (2 * np.pi)
+    lat = np.arctan2(z, np.sqrt(x ** 2 + y ** 2))
+    return lon, lat
+
+
+def _angle_between(v1, v2):
+    """Angle between (not necessarily normalized) vectors."""
+    cross = np.sqrt(np.sum(np.cross(v1, v2) ** 2, axis=-1))
+    return np.arctan2(cross, np.sum(v1 * v2, axis=-1))
+
+
+def _rotation_step(tolerance):
+    """Grid step (s) for quantities rotating with the Earth.
+
+    The linear interpolation of a unit vector rotating at angular velocity
+    :math:`\\omega` over a step :math:`h` has a maximum error of
+    :math:`h^2\\omega^2/8`.
+    """
+    tol = _to_rad(tolerance)
+    return min(np.sqrt(8 * tol) / _EARTH_OMEGA, _MAX_STEP)
+
+
+def _interpolate_on_grid(key, mjd, step, exact_func):
+    """Interpolate a function of time, calculated on a cached grid.
+
+    Parameters
+    ----------
+    key : tuple
+        Identifies the function (e.g. site and source coordinates)
+    mjd : array-like
+        The times where the function is needed (MJD)
+    step : float
+        The step of the grid, in seconds
+    exact_func : function
+        Calculates the exact function, given an array of MJDs. Returns an
+        array with time on the first axis
+
+    Returns
+    -------
+    values : array
+        The interpolated values, with time on the first axis
+    node_values : array
+        The values at the grid nodes
+    """
+    mjd = np.asarray(mjd, dtype=float)
+    step = step / _DAY
+    key = key + (step,)
+
+    first = int(np.floor(np.min(mjd) / step))
+    last = int(np.ceil(np.max(mjd) / step))
+    nodes = np.arange(first, last + 1)
+    with _node_cache_lock:
+        # Move the grid to the end, as the most recently used
+        store = _node_cache.pop(key, {})
+        _node_cache[key] = store
+        known = dict([(n, store[n]) for n in nodes if n in store])
+    missing = [n for n in nodes if n not in known]
+    if len(missing) > 0:
+        # Calculated without holding the lock
+        values = exact_func(np.array(missing) * step)
+        known.update(zip(missing, values))
+        with _node_cache_lock:
+            _node_cache.setdefault(key, {}).update(zip(missing, values))
+            _evict_nodes(key, nodes)
+
+    node_values = np.array([known[n] for n in nodes])
+    node_times = nodes * step
+    shape = node_values.shape[1:]
+    flat = node_values.reshape(len(nodes), -1)
+    values = np.array([np.interp(mjd, node_times, flat[:, i])
+                       for i in range(flat.shape[1])]).T
+    return values.reshape((len(mjd),) + shape), node_values
+
+
+def source_altaz(ra, dec, mjd, site, tolerance=DEFAULT_TOLERANCE):
+    """Horizontal coordinates of a fixed source at many times.
+
+    Parameters
+    ----------
+    ra, dec : float or ``astropy.units.Quantity``
+        The equatorial coordinates of the source (radians if float)
+    mjd : array-like
+        The times (MJD, UTC)
+    site : str
+        The observing site (a key of ``srttools.io.locations``)
+
+    Other Parameters
+    ----------------
+    tolerance : ``astropy.units.Quantity``
+        Maximum interpolation error
+
+    Returns
+    -------
+    az, el : arrays
+        Horizontal coordinates, in radians
+
+    Examples
+    --------
+    >>> from srttools.io import locations
+    >>> times = 57000 + np.arange(0, 0.001, 1e-6)
+    >>> az, el = source_altaz(0.3, 0.7, times, 'srt')
+    >>> coords = SkyCoord(ra=0.3 * u.rad, dec=0.7 * u.rad,
+    ...                   obstime=Time(times, format='mjd', scale='utc'),
+    ...                   location=locations['srt']).altaz
+    >>> exact = _unit_vectors(coords.az.rad, coords.alt.rad)
+    >>> diff = _angle_between(_unit_vectors(az, el), exact)
+    >>> np.all(diff < DEFAULT_TOLERANCE.to(u.rad).value)
+    True
+    """
+    from .io import locations
+    ra, dec = float(_to_rad(ra)), float(_to_rad(dec))
+
+    def exact_func(times):
+        coords = SkyCoord(ra=ra * u.rad, dec=dec * u.rad,
+                          obstime=Time(times, format='mjd', scale='utc'),
+                          location=locations[site]).altaz
+        return _unit_vectors(coords.az.to(u.rad).value,
+                             coords.alt.to(u.rad).value)
+
+    vectors, _ = _interpolate_on_grid(('altaz', site, ra, dec), mjd,
+                                      _rotation_step(tolerance), exact_func)
+    return _lonlat(vectors)
+
+
+def utc_to_tdb(mjd, site=None, tolerance=1e-9 * u.s):
+    """Convert UTC MJDs to TDB.
+
+    The difference TDB - UTC is interpolated on a grid. Its largest periodic
+    terms (annual, 1.7 ms, and daily, a few microseconds depending on the
+    location) give an interpolation error well below the tolerance with the
+    default step. Intervals containing a leap second are converted exactly.
+
+    Parameters
+    ----------
+    mjd : array-like
+        The times (MJD, UTC)
+
+    Other Parameters
+    ----------------
+    site : str
+        The observing site (a key of ``srttools.io.locations``), for the
+        topocentric terms. Default: geocenter
+    tolerance : ``astropy.units.Quantity``
+        Maximum interpolation error
+
+    Returns
+    -------
+    tdb : array
+        The times (MJD, TDB)
+    """
+    from .io import locations
+    mjd = np.asarray(mjd, dtype=float)
+    location = None if site is None else locations[site]
+
+    def exact_func(times):
+        t = Time(times, format='mjd', scale='utc', location=location)
+        return t.tdb.mjd - times
+
+    # The daily term, a few microseconds, dominates the second derivative
+    amplitude = 4e-6
+    step = np.sqrt(8 * tolerance.to(u.s).value / amplitude) / _EARTH_OMEGA
+    offset, node_offsets = \
+        _interpolate_on_grid(('tdb', site), mjd, min(step, 3600.),
+                             exact_func)
+    tdb = mjd + offset
+
+    # Around leap seconds, the offset is not continuous.
+    if np.any(np.abs(np.diff(node_offsets)) > 0.5 / _DAY):
+        step = min(step, 3600.) / _DAY
+        jumps = np.where(np.abs(np.diff(node_offsets)) > 0.5 / _DAY)[0]
+        first = np.floor(np.min(mjd) / step)
+        bad = np.zeros(len(mjd), dtype=bool)
+        for j in jumps:
+            start, stop = (first + j) * step, (first + j + 1) * step
+            bad |= (mjd >= start) & (mjd <= stop)
+        tdb[bad] = exact_func(mjd[bad]) + mjd[bad]
+    return tdb
+
+
+def _exact_altaz_to_icrs(az, el, mjd, site):
+    from .io import locations
+    coords = AltAz(az=Angle(az * u.rad), alt=Angle(el * u.rad),
+                   location=locations[site],
+                   obstime=Time(mjd, format='mjd', scale='utc'))
+    coords = coords.transform_to(ICRS())
+    return _unit_vectors(coords.ra.to(u.rad).value,
+                         coords.dec.to(u.rad).value)
+
+
+def altaz_to_icrs(az, el, mjd, site, tolerance=DEFAULT_TOLERANCE,
+                  step=1.):
+    """Convert horizontal coordinates to ICRS, interpolating in time.
+
+    The exact transformation is only calculated on samples about ``step``
+    seconds apart (plus a check in the middle of each interval), in a single
+    astropy transformation for all the columns. Intervals where the
+    interpolation error is larger than half the ``tolerance`` are
+    transformed exactly, so that the result is within the tolerance unless
+    the coordinates change direction more than once within a step.
+
+    Parameters
+    ----------
+    az, el : arrays
+        Horizontal coordinates, in radians, with shape ``(nsamples,)`` or
+        ``(nsamples, ncolumns)`` (e.g. one column per feed)
+    mjd : array-like
+        The times of the samples (MJD, UTC), in increasing order
+    site : str
+        The observing site (a key of ``srttools.io.locations``)
+
+    Other Parameters
+    ----------------
+    tolerance : ``astropy.units.Quantity``
+        Maximum interpolation error. If None, transform all samples exactly
+    step : float
+        Step between the exactly transformed samples, in seconds
+
+    Returns
+    -------
+    ra, dec : arrays
+        Equatorial coordinates, in radians, with the same shape as ``az``
+    """
+    az = np.asarray(az, dtype=float)
+    el = np.asarray(el, dtype=float)
+    mjd = np.asarray(mjd, dtype=float)
+    shape = az.shape
+    if az.ndim == 1:
+        az, el = az[:, np.newaxis], el[:, np.newaxis]
+    nsamples, ncols = az.shape
+
+    def exact(rows, cols=None):
+        """Exact transform of the given rows (and columns, if not all)."""
+        if cols is None:
+            rows, cols = np.repeat(rows, ncols), np.tile(np.arange(ncols),
+                                                          len(rows))
+        vectors = _exact_altaz_to_icrs(az[rows, cols], el[rows, cols],
+                                       mjd[rows], site)
+        return rows, cols, vectors
+
+    times = (mjd - mjd[0]) * _DAY
+    sorted_times = np.all(np.diff(times) > 0)
+    if tolerance is None or nsamples < 3 or not sorted_times:
+        rows, cols, vectors = exact(np.arange(nsamples))
+        result = np.zeros((nsamples, ncols, 3))
+        result[rows, cols] = vectors
+        ra, dec = _lonlat(result)
+        return ra.reshape(shape), dec.reshape(shape)
+
+    tol = _to_rad(tolerance)
+
+    # Nodes: first sample after each multiple of the step, plus the last
+    nodes = np.unique(np.concatenate(
+        [np.searchsorted(times, np.arange(0, times[-1], step)),
+         [nsamples - 1]]))
+    mids = (nodes[:-1] + nodes[1:]) // 2
+    check = mids[mids > nodes[:-1]]
+
+    rows, cols, vectors = exact(np.concatenate([nodes, check]))
+    exact_values = np.zeros((nsamples, ncols, 3))
+    is_exact = np.zeros((nsamples, ncols), dtype=bool)
+    exact_values[rows, cols] = vectors
+    is_exact[rows, cols] = True
+
+    result = np.zeros((nsamples, ncols, 3))
+    for c in range(ncols):
+        for i in range(3):
+            result[:, c, i] = np.interp(times, times[nodes],
+                                        exact_values[nodes, c, i])
+
+    # Check the interpolation in the middle of the intervals. For a smooth
+    # function the error is largest there; if the coordinates have a kink
+    # (e.g. a turnaround) inside the interval, the error in the middle is at
+    # least half the largest error.
+    errors = _angle_between(result[check], exact_values[check])
+    bad_rows, bad_cols = np.where(errors > tol / 2)
+    if len(bad_rows) > 0:
+        interval = np.searchsorted(nodes, check[bad_rows]) - 1
+        rows = np.concatenate([np.arange(nodes[i] + 1, nodes[i + 1])
+                               for i in interval])
+        cols = np.concatenate([np.zeros(nodes[i + 1] - nodes[i] - 1,
+                                        dtype=int) + c
+                               for i, c in zip(interval, bad_cols)])
+        rows, cols, vectors = exact(rows, cols)
+        exact_values[rows, cols] = vectors
+        is_exact[rows, cols] = True
+
+    result[is_exact] = exact_values[is_exact]
+    ra, dec = _lonlat(result)
+    return ra.reshape(shape), dec.reshape(shape)
@@ -4,6 +4,9 @@ Random utilities
 import sys
 import numpy as np
 import warnings
+import logging
+import functools
+from .diagnostics import wait_for_diagnostics
 
 
 DEFAULT_MPL_BACKEND = 'TKAgg'
@@ -47,14 +50,16 @@ def _generic_dummy_decorator(*args, **kwargs):
 
 try:
     from numba import jit, vectorize
+    HAS_NUMBA = True
 except ImportError:
     warnings.warn("Numba not installed. Faking it")
+    HAS_NUMBA = False
 
     jit = vectorize = _generic_dummy_decorator
 
 
 __all__ = ["mad", "standard_string", "standard_byte", "compare_strings",
-           "tqdm", "jit", "vectorize"]
+           "tqdm", "jit", "vectorize", "parallel_imap"]
 
 
 try:
@@ -150,3 +155,94 @@ def compare_strings(s1, s2):
     s1 = standard_string(s1)
     s2 = standard_string(s2)
     return s1 == s2
+
+
+class _RecordingHandler(logging.Handler):
+    """Logging handler storing the records, to be re-emitted elsewhere."""
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        # Make the record picklable: format the message and drop the
+        # (possibly unpicklable) arguments and traceback objects
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+def _run_recording_messages(func, arg):
+    """Run ``func(arg)``, recording warnings and log records.
+
+    Used in worker processes, so that the messages can be re-emitted by the
+    parent process in the right order.
+    """
+    handler = _RecordingHandler()
+    root = logging.getLogger()
+    old_handlers = root.handlers
+    root.handlers = [handler]
+    try:
+        with warnings.catch_warnings(record=True) as recorded:
+            warnings.simplefilter("always")
+            result = func(arg)
+            # Pool workers exit without running the atexit handlers
+            wait_for_diagnostics()
+    finally:
+        root.handlers = old_handlers
+
+    warning_list = [(str(w.message), w.category) for w in recorded]
+    return result, warning_list, handler.records
+
+
+def parallel_imap(func, iterable, nproc=1):
+    """Apply ``func`` to all elements of ``iterable``, possibly in parallel.
+
+    Results are yielded in the same order as the input, each as soon as it
+    (and all the previous ones) are available. With ``nproc > 1``, a pool of
+    processes is used; warnings and log messages produced in the workers are
+    re-emitted in the main process, and exceptions are propagated.
+
+    Parameters
+    ----------
+    func : function
+        Function accepting a single argument. It has to be picklable (e.g. a
+        module-level function or a ``functools.partial`` of one) if
+        ``nproc > 1``
+    iterable : iterable
+        The inputs to ``func``
+
+    Other Parameters
+    ----------------
+    nproc : int
+        Number of processes. If None or 1, run serially in this process
+
+    Examples
+    --------
+    >>> list(parallel_imap(abs, [-1, 2, -3]))
+    [1, 2, 3]
+    >>> list(parallel_imap(abs, [-1, 2, -3], nproc=2))
+    [1, 2, 3]
+    """
+    if nproc is None or nproc <= 1:
+        for arg in iterable:
+            yield func(arg)
+        return
+
+    import multiprocessing as mp
+    pool = mp.Pool(nproc)
+    try:
+        for result, warning_list, records in \
+                pool.imap(functools.partial(_run_recording_messages, func),
+                          iterable):
+            for message, category in warning_list:
+                warnings.warn(message, category)
+            for record in records:
+                logging.getLogger(record.name).handle(record)
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()